@@ -2,19 +2,43 @@
 FastAPI application for retina analyzer service with health check endpoint.
 This file is intended to be deployed to Azure Web App or run in a Docker container.
 """
+import time
+
+# Start of the startup timing breakdown; the imports below are its first entry
+_import_start = time.perf_counter()
+
 import os
 import logging
-from fastapi import FastAPI, HTTPException
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, TypeAdapter, ValidationError, model_validator
+from typing import Awaitable, Callable, List, Optional, Dict, Any, Tuple, Union
 from datetime import datetime
 from dotenv import load_dotenv
 from retina_processor import RetinaProcessor
+from extraction_profiles import ExtractionProfile, get_profile
 from cosmos_db import CosmosDBClient
-from blob_storage import BlobStorageClient
+from blob_storage import AsyncBlobStorageClient, BlobStorageClient
+from template_cache import TemplateCache
+from probe_cache import ProbeCache
+from feature_set import FeatureSet
+from template_gallery import TemplateGallery
+from gallery_snapshot import SnapshotFormatError, open_snapshot
+from gallery_sync import GallerySync, create_gallery_sync
+from single_flight import SingleFlight, make_key
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 import asyncio
+import json
+import base64
+import hashlib
+import mimetypes
+import cv2
+import numpy as np
 
 # Configure logging
 logging.basicConfig(
@@ -26,11 +50,219 @@ logger = logging.getLogger("RetinaAnalyzerAPI")
 # Load environment variables
 load_dotenv()
 
+# Components are created by the lifespan hook after the server starts listening
+retina_processor: Optional[RetinaProcessor] = None
+cosmos_client: Optional[CosmosDBClient] = None
+blob_client: Optional[BlobStorageClient] = None
+async_blob_client: Optional[AsyncBlobStorageClient] = None
+template_cache: Optional[TemplateCache] = None
+probe_cache: Optional[ProbeCache] = None
+template_gallery: Optional[TemplateGallery] = None
+gallery_sync: Optional[GallerySync] = None
+startup_timings: Dict[str, float] = {"imports": time.perf_counter() - _import_start}
+startup_error: Optional[str] = None
+ready = False
+
+# Admission control for /validate. Each worker process admits MAX_CONCURRENT_VALIDATIONS
+# validations at a time (default: RETINA_CONCURRENCY, the number of images the processor
+# is sized for); up to VALIDATION_QUEUE_SIZE more wait VALIDATION_QUEUE_TIMEOUT seconds.
+MAX_CONCURRENT_VALIDATIONS = max(1, int(os.getenv("MAX_CONCURRENT_VALIDATIONS", os.getenv("RETINA_CONCURRENCY", "1"))))
+VALIDATION_QUEUE_SIZE = int(os.getenv("VALIDATION_QUEUE_SIZE", str(MAX_CONCURRENT_VALIDATIONS * 4)))
+VALIDATION_QUEUE_TIMEOUT = float(os.getenv("VALIDATION_QUEUE_TIMEOUT", "5"))
+VALIDATION_RETRY_AFTER = os.getenv("VALIDATION_RETRY_AFTER", "2")
+validation_slots = asyncio.Semaphore(MAX_CONCURRENT_VALIDATIONS)
+validation_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_VALIDATIONS, thread_name_prefix="validation")
+queued_validations = 0
+
+# Identical concurrent validations (client retries) share one computation;
+# successful results are reused for SINGLE_FLIGHT_TTL seconds
+validation_flight = SingleFlight()
+
+# Largest image accepted by the upload routes, and room for the other form fields of a multipart upload
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_UPLOAD_FORM_BYTES = int(os.getenv("MAX_UPLOAD_FORM_BYTES", str(1024 * 1024)))
+
+# Batch routes: items per request, images processed in parallel per batch, and batches at once
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "500"))
+BATCH_CONCURRENCY = max(1, int(os.getenv("BATCH_CONCURRENCY", str(MAX_CONCURRENT_VALIDATIONS))))
+BATCH_WRITE_SIZE = max(1, int(os.getenv("BATCH_WRITE_SIZE", "25")))
+MAX_CONCURRENT_BATCHES = max(1, int(os.getenv("MAX_CONCURRENT_BATCHES", "1")))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+running_batches = 0
+
+def _warm_up_executor(executor: ThreadPoolExecutor, workers: int, profiles: Optional[List[str]]) -> Dict[str, float]:
+    """
+    Warm up every thread of an executor.
+    
+    The processor's buffers belong to the thread that sizes them, so each of
+    the executor's threads runs its own warm-up; the barrier keeps a thread
+    from taking a second warm-up before all of them have started one.
+    
+    Args:
+        executor: Executor whose threads serve requests
+        workers: Number of threads of the executor
+        profiles: Profile names to warm up (None for the processor's profile)
+    
+    Returns:
+        Dictionary mapping profile names to the warm-up time of the first thread in seconds
+    """
+    barrier = threading.Barrier(workers)
+    
+    def warm_up() -> Dict[str, float]:
+        barrier.wait(timeout=60)
+        return retina_processor.warm_up(profiles)
+    
+    futures = [executor.submit(warm_up) for _ in range(workers)]
+    return [future.result() for future in futures][0]
+
+def _initialize_components() -> None:
+    """
+    Create the service clients and warm up the retina processor.
+    
+    Runs in a worker thread; each step's duration is added to startup_timings.
+    """
+    global retina_processor, cosmos_client, blob_client, async_blob_client, template_cache, probe_cache, template_gallery, gallery_sync
+    
+    start_time = time.perf_counter()
+    retina_processor = RetinaProcessor()
+    startup_timings["retina_processor"] = time.perf_counter() - start_time
+    
+    start_time = time.perf_counter()
+    cosmos_client = CosmosDBClient()
+    startup_timings["cosmos_db"] = time.perf_counter() - start_time
+    
+    start_time = time.perf_counter()
+    blob_client = BlobStorageClient()
+    # Used from the event loop; its connection pool is created on first use
+    async_blob_client = AsyncBlobStorageClient()
+    startup_timings["blob_storage"] = time.perf_counter() - start_time
+    
+    # Shared by all worker processes when TEMPLATE_CACHE_DIR is set
+    template_cache = TemplateCache()
+    
+    # Features of validated blobs by ETag, per worker process
+    probe_cache = ProbeCache()
+    
+    # Memory-mapped, so all worker processes share one copy of the templates
+    snapshot_path = os.getenv("GALLERY_SNAPSHOT")
+    if snapshot_path and os.path.exists(snapshot_path):
+        start_time = time.perf_counter()
+        try:
+            template_gallery = open_snapshot(snapshot_path, retina_processor)
+        except (SnapshotFormatError, OSError) as e:
+            # Templates are read from the cache and Cosmos DB instead
+            logger.error(f"Failed to open gallery snapshot {snapshot_path}: {str(e)}")
+        startup_timings["gallery"] = time.perf_counter() - start_time
+        
+        if template_gallery is not None:
+            logger.info(f"Opened gallery snapshot {snapshot_path} with {len(template_gallery)} templates")
+            # Applies enrollments and deletions made after the snapshot was built
+            gallery_sync = create_gallery_sync(template_gallery, snapshot_path)
+            if gallery_sync is not None:
+                gallery_sync.start()
+    
+    if os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true":
+        start_time = time.perf_counter()
+        profile = os.getenv("VALIDATION_PROFILE")
+        # On the threads that run validations and batch items, not on this startup thread
+        _warm_up_executor(validation_executor, MAX_CONCURRENT_VALIDATIONS, [profile] if profile else None)
+        _warm_up_executor(batch_executor, BATCH_CONCURRENCY, [profile] if profile else None)
+        startup_timings["warm_up"] = time.perf_counter() - start_time
+
+async def _startup() -> None:
+    """Initialize the components in the background and mark the service ready."""
+    global ready, startup_error
+    try:
+        await asyncio.to_thread(_initialize_components)
+        ready = True
+    except Exception as e:
+        startup_error = str(e)
+        logger.error(f"Failed to initialize Retina Analyzer API: {startup_error}")
+        return
+    
+    startup_timings["total"] = time.perf_counter() - _import_start
+    breakdown = ", ".join(f"{step}={seconds * 1000:.0f}ms" for step, seconds in startup_timings.items())
+    logger.info(f"Retina Analyzer API ready. Startup timing: {breakdown}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start component initialization without blocking the server.
+    
+    The health check answers immediately; /ready reports when the
+    components are initialized and warmed up.
+    """
+    startup_task = asyncio.create_task(_startup())
+    yield
+    if not startup_task.done():
+        startup_task.cancel()
+    validation_executor.shutdown(wait=False)
+    batch_executor.shutdown(wait=False)
+    if gallery_sync is not None:
+        gallery_sync.stop()
+    if async_blob_client is not None:
+        await async_blob_client.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Retina Analyzer API", 
     description="API for retina image processing service",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects oversized request bodies of the upload routes before they are parsed.
+    
+    Starlette spools a multipart body to a temporary file while parsing the
+    form, before the route runs, so a size check in the route comes after the
+    whole body was received. A declared Content-Length over the limit is
+    answered with 413 right away; otherwise the body is counted as it arrives
+    and parsing stops with 413 once it exceeds the limit.
+    """
+    def __init__(self, app, paths: Tuple[str, ...], max_bytes: int):
+        """
+        Initialize the middleware.
+        
+        Args:
+            app: ASGI application to wrap
+            paths: Request paths whose bodies are limited
+            max_bytes: Largest accepted request body
+        """
+        self.app = app
+        self.paths = paths
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        
+        detail = f"Request body exceeds {self.max_bytes} bytes"
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Passed through by FastAPI's form parsing and answered by its exception handler
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    paths=("/validate/upload",),
+    max_bytes=MAX_UPLOAD_BYTES + MAX_UPLOAD_FORM_BYTES
 )
 
 # Add CORS middleware
@@ -42,11 +274,6 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Initialize components
-retina_processor = RetinaProcessor()
-cosmos_client = CosmosDBClient()
-blob_client = BlobStorageClient()
-
 # Define request models
 class EmployeeReference(BaseModel):
     employeeId: str
@@ -57,6 +284,33 @@ class RetinaValidationRequest(BaseModel):
     employees: List[EmployeeReference]
     messageId: str
     originatingInstance: Optional[str] = None
+    profile: Optional[str] = None  # Extraction profile; defaults to VALIDATION_PROFILE
+
+class BatchImage(BaseModel):
+    image_path: Optional[str] = None  # Path in Blob Storage
+    image_data: Optional[str] = None  # Base64-encoded image, instead of image_path
+    
+    @model_validator(mode="after")
+    def check_image_source(self):
+        if bool(self.image_path) == bool(self.image_data):
+            raise ValueError("Exactly one of image_path and image_data is required")
+        return self
+
+class BatchEnrollmentItem(BatchImage):
+    employeeId: str
+    imgId: Optional[str] = None
+
+class BatchEnrollmentRequest(BaseModel):
+    items: List[BatchEnrollmentItem]
+    profile: Optional[str] = None  # Extraction profile; defaults to ENROLLMENT_PROFILE
+
+class BatchValidationItem(BatchImage):
+    employees: List[EmployeeReference]
+    messageId: str
+
+class BatchValidationRequest(BaseModel):
+    items: List[BatchValidationItem]
+    profile: Optional[str] = None  # Extraction profile; defaults to VALIDATION_PROFILE
 
 @app.get("/")
 async def health_check():
@@ -74,6 +328,211 @@ async def health_check():
         "environment": os.getenv("ENVIRONMENT", "production")
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness endpoint reporting whether the service can handle requests.
+    
+    Returns:
+        Dict: Readiness status with the startup timing breakdown in milliseconds
+    
+    Raises:
+        HTTPException: 503 while the components are still initializing or failed to
+    """
+    timings_ms = {step: round(seconds * 1000, 1) for step, seconds in startup_timings.items()}
+    if not ready:
+        detail = {
+            "status": "failed" if startup_error else "starting",
+            "error": startup_error,
+            "startup_timings_ms": timings_ms
+        }
+        raise HTTPException(status_code=503, detail=detail)
+    
+    return {
+        "status": "ready",
+        "timestamp": datetime.utcnow().isoformat(),
+        "startup_timings_ms": timings_ms,
+        "single_flight": validation_flight.stats(),
+        "gallery_sync": gallery_sync.stats() if gallery_sync is not None else None,
+        "cosmos_writes": cosmos_client.write_stats() if cosmos_client is not None else None,
+        "probe_cache": probe_cache.stats() if probe_cache is not None else None
+    }
+
+def _gallery_get(document_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Get a template from the gallery snapshot, unless it fell behind Cosmos DB.
+    
+    Args:
+        document_id: Cosmos DB document ID of the features
+    
+    Returns:
+        Dict: The template, or None if it is not in the gallery or the gallery is stale
+    """
+    if template_gallery is None or not template_gallery.is_fresh():
+        return None
+    return template_gallery.get(document_id)
+
+def _get_template(document_id: str, person_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get an employee's retina features, from the gallery snapshot or the shared template cache if possible.
+    
+    Args:
+        document_id: Cosmos DB document ID of the features
+        person_id: Employee the document belongs to (allows a point read with the /person_id layout)
+    
+    Returns:
+        Dict: The feature document
+    """
+    document = _gallery_get(document_id)
+    if document is None:
+        document = template_cache.get(document_id)
+    if document is None:
+        document = cosmos_client.get_features(document_id, person_id)
+        if document is not None:
+            template_cache.put(document_id, document)
+    return document
+
+def _match_image(probe: Union[np.ndarray, FeatureSet], employees: List[Dict[str, str]], message_id: str,
+                 profile: ExtractionProfile, templates: Optional[Dict[str, Dict[str, Any]]] = None,
+                 blob_version: Optional[Tuple[str, Optional[str]]] = None) -> Dict[str, Any]:
+    """
+    Extract features from a decoded image and compare them with the employees' templates.
+    
+    Args:
+        probe: Decoded BGR retina image, or the features cached for it
+        employees: Employee references with employeeId and documentId
+        message_id: ID of the validation request
+        profile: Extraction profile for the input image
+        templates: Optional preloaded templates by document ID; templates are fetched one by one otherwise
+        blob_version: Optional (blob path, ETag) of the image, to cache its features under
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    """
+    # Extract features from the input image
+    if isinstance(probe, FeatureSet):
+        input_features = probe
+    else:
+        input_features = retina_processor.extract_features(probe, profile=profile)
+        if blob_version is not None:
+            probe_cache.put(*blob_version, input_features)
+    
+    def get_template(document_id: str, employee_id: Optional[str]) -> Dict[str, Any]:
+        # Preloaded batch templates, or each employee's template from the gallery, cache or Cosmos DB
+        if templates is None:
+            return _get_template(document_id, employee_id)
+        if document_id in templates:
+            return templates[document_id]
+        raise ValueError(f"Item with ID {document_id} not found")
+    
+    # Score the packed gallery rows when it holds every employee's template,
+    # else compare with each employee's retina features
+    result = None
+    if template_gallery is not None and template_gallery.is_fresh():
+        result = template_gallery.match_employees(input_features, employees)
+    if result is None:
+        result = retina_processor.match_employees(input_features, employees, get_template)
+    response = {**result, "messageId": message_id}
+    
+    logger.info(f"Validation response: {response}")
+    return response
+
+def _employee_key(employees: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """Order-independent form of an employee list for single-flight keys."""
+    return sorted((emp.get("employeeId") or "", emp.get("documentId") or "") for emp in employees)
+
+def _is_success(result: Dict[str, Any]) -> bool:
+    """Only successful validation results are reused by the single-flight window."""
+    return result.get("status") == "success"
+
+def _resolve_profile(name: Optional[str]) -> ExtractionProfile:
+    """
+    Check that the service is ready and resolve the extraction profile of a validation.
+    
+    Args:
+        name: Requested profile name (defaults to VALIDATION_PROFILE)
+    
+    Returns:
+        ExtractionProfile: The profile to extract the input image with
+    
+    Raises:
+        HTTPException: 503 while the service is starting, 400 for an unknown profile
+    """
+    if not ready:
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
+    
+    try:
+        return get_profile(name or os.getenv("VALIDATION_PROFILE"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _run_admitted(message_id: str, func, *args) -> Dict[str, Any]:
+    """
+    Run a blocking validation function on the validation executor under admission control.
+    
+    Args:
+        message_id: ID of the validation request, for logging
+        func: Blocking function performing the validation
+        *args: Arguments for func
+    
+    Returns:
+        Dict: Result of func
+    
+    Raises:
+        HTTPException: 429 if the queue is full, 503 if no slot frees up in time
+    """
+    await _acquire_validation_slot(message_id)
+    return await _run_on_slot(func, *args)
+
+async def _acquire_validation_slot(message_id: str) -> None:
+    """
+    Wait for a validation slot under admission control.
+    
+    Args:
+        message_id: ID of the validation request, for logging
+    
+    Raises:
+        HTTPException: 429 if the queue is full, 503 if no slot frees up in time
+    """
+    global queued_validations
+    
+    # Admission control: reject at once when the queue is full, or after waiting too long for a slot
+    if queued_validations >= VALIDATION_QUEUE_SIZE:
+        logger.warning(f"Rejecting validation {message_id}: {queued_validations} validations queued")
+        raise HTTPException(status_code=429, detail="Too many validations queued",
+                            headers={"Retry-After": VALIDATION_RETRY_AFTER})
+    
+    queued_validations += 1
+    try:
+        await asyncio.wait_for(validation_slots.acquire(), timeout=VALIDATION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Rejecting validation {message_id}: no slot free within {VALIDATION_QUEUE_TIMEOUT}s")
+        raise HTTPException(status_code=503, detail="Validation capacity exhausted",
+                            headers={"Retry-After": VALIDATION_RETRY_AFTER})
+    finally:
+        queued_validations -= 1
+
+async def _run_on_slot(func, *args) -> Dict[str, Any]:
+    """
+    Run a blocking function on the validation executor with an acquired validation slot.
+    
+    Args:
+        func: Blocking function performing the validation
+        *args: Arguments for func
+    
+    Returns:
+        Dict: Result of func
+    """
+    # Blocking work runs on the executor so the event loop keeps serving other requests.
+    # The slot is released when the work finishes, even if the client disconnects first.
+    try:
+        future = asyncio.get_running_loop().run_in_executor(validation_executor, func, *args)
+    except Exception:
+        validation_slots.release()
+        raise
+    future.add_done_callback(lambda _: validation_slots.release())
+    return await asyncio.shield(future)
+
 @app.post("/validate")
 async def validate_retina(request: RetinaValidationRequest):
     """
@@ -85,101 +544,484 @@ async def validate_retina(request: RetinaValidationRequest):
     Returns:
         Dict: Validation results including matching employee ID if found
     """
+    profile = _resolve_profile(request.profile)
+    
+    logger.info(f"Received validation request: {request}")
+    
+    # Extract data from request
+    blob_path = request.image_path
+    employees = [{"employeeId": emp.employeeId, "documentId": emp.documentId} for emp in request.employees]
+    message_id = request.messageId
+    
+    key = make_key("validate", blob_path, _employee_key(employees), profile.name)
+    result = await validation_flight.do(
+        key,
+        lambda: _validate_blob(blob_path, employees, message_id, profile),
+        cacheable=_is_success
+    )
+    return {**result, "messageId": message_id}
+
+async def _validate_blob(blob_path: str, employees: List[Dict[str, str]], message_id: str,
+                         profile: ExtractionProfile) -> Dict[str, Any]:
+    """
+    Download a retina image from Blob Storage and validate it.
+    
+    The download runs on the event loop with the asynchronous Blob client, so
+    only decoding, extraction and comparison occupy the validation executor.
+    
+    Args:
+        blob_path: Path of the image in Blob Storage
+        employees: Employee references with employeeId and documentId
+        message_id: ID of the validation request
+        profile: Extraction profile for the input image
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    
+    Raises:
+        HTTPException: 404 if the image cannot be downloaded, or as raised by _run_admitted
+    """
+    logger.info(f"Validating retina image from blob: {blob_path} against {len(employees)} employees")
+    
+    # An unchanged blob that was validated before is matched with its cached features,
+    # at the cost of a properties request instead of a download and extraction
+    etag = await async_blob_client.get_blob_etag(blob_path) if probe_cache.is_enabled() else None
+    cached_features = probe_cache.get(blob_path, etag, profile.name)
+    
+    await _acquire_validation_slot(message_id)
+    if cached_features is not None:
+        logger.info(f"Using cached features of unchanged blob: {blob_path}")
+        return await _run_on_slot(_run_cached_validation, cached_features, employees, message_id, profile)
+    
     try:
-        logger.info(f"Received validation request: {request}")
-        
-        # Extract data from request
-        blob_path = request.image_path
-        employees = [{"employeeId": emp.employeeId, "documentId": emp.documentId} for emp in request.employees]
-        message_id = request.messageId
-        
-        if not blob_path:
-            logger.error("Request missing required field: image_path")
-            raise HTTPException(status_code=400, detail="Missing required field: image_path")
-        
-        if not employees:
-            logger.error("Request missing required field: employees")
-            raise HTTPException(status_code=400, detail="Missing required field: employees")
-        
-        logger.info(f"Validating retina image from blob: {blob_path} against {len(employees)} employees")
-        
-        # Download the image from Blob Storage
-        temp_image_path = blob_client.download_blob_to_temp(blob_path)
-        if not temp_image_path:
-            logger.error(f"Failed to download image from blob: {blob_path}")
-            raise HTTPException(status_code=404, detail=f"Failed to download image from blob: {blob_path}")
-        
-        try:
-            # Read the image
-            import cv2
-            image = cv2.imread(temp_image_path)
-            if image is None:
-                logger.error(f"Could not read image from path: {temp_image_path}")
-                raise HTTPException(status_code=400, detail=f"Could not read image from path: {temp_image_path}")
-            
-            # Extract features from the input image
-            input_features = retina_processor.extract_features(image)
-            
-            # Compare with each employee's retina features
-            matching_employee_id = None
-            highest_similarity = 0.0
-            
-            for employee in employees:
-                employee_id = employee.get('employeeId')
-                document_id = employee.get('documentId')
-                
-                if not document_id:
-                    logger.warning(f"Missing documentId for employee: {employee_id}")
-                    continue
-                
-                try:
-                    # Get employee's retina features from Cosmos DB
-                    employee_features = cosmos_client.get_features(document_id)
-                    
-                    # Compare features
-                    comparison_result = retina_processor.compare_features(
-                        input_features, 
-                        employee_features
-                    )
-                    
-                    similarity = comparison_result.get('overall_similarity', 0.0)
-                    is_match = comparison_result.get('is_match', False)
-                    
-                    logger.info(f"Comparison with employee {employee_id}: similarity={similarity}, is_match={is_match}")
-                    
-                    # If it's a match and has higher similarity than previous matches
-                    if is_match and similarity > highest_similarity:
-                        highest_similarity = similarity
-                        matching_employee_id = employee_id
-                
-                except Exception as e:
-                    logger.warning(f"Error comparing with employee {employee_id}: {str(e)}")
-                    continue
-            
-            # Prepare response
-            response = {
-                "status": "success",
-                "matchingEmployeeId": matching_employee_id,
-                "similarity": highest_similarity if matching_employee_id else 0.0,
-                "messageId": message_id
-            }
-            
-            logger.info(f"Validation response: {response}")
-            return response
-            
-        finally:
-            # Clean up the temporary file
-            try:
-                if os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
-                    logger.info(f"Removed temporary file: {temp_image_path}")
-            except Exception as e:
-                logger.warning(f"Failed to remove temporary file {temp_image_path}: {str(e)}")
-        
+        data = await async_blob_client.download_blob_bytes(blob_path)
+    except BaseException:
+        validation_slots.release()
+        raise
+    if data is None:
+        validation_slots.release()
+        logger.error(f"Failed to download image from blob: {blob_path}")
+        raise HTTPException(status_code=404, detail=f"Failed to download image from blob: {blob_path}")
+    
+    return await _run_on_slot(_run_upload_validation, data, employees, message_id, profile, f"image from blob {blob_path}",
+                              (blob_path, etag))
+
+def _run_cached_validation(features: FeatureSet, employees: List[Dict[str, str]], message_id: str,
+                           profile: ExtractionProfile) -> Dict[str, Any]:
+    """
+    Validate the cached features of an unchanged blob; runs on the validation executor.
+    
+    Args:
+        features: Features cached for the blob's current version
+        employees: Employee references with employeeId and documentId
+        message_id: ID of the validation request
+        profile: Extraction profile for the input image
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    """
+    try:
+        return _match_image(features, employees, message_id, profile)
     except Exception as e:
         logger.error(f"Error validating retina: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error validating retina: {str(e)}")
 
+def _run_upload_validation(data: bytes, employees: List[Dict[str, str]], message_id: str, profile: ExtractionProfile,
+                           source: str = "uploaded image",
+                           blob_version: Optional[Tuple[str, Optional[str]]] = None) -> Dict[str, Any]:
+    """
+    Decode an uploaded or downloaded image and validate it; runs on the validation executor.
+    
+    Args:
+        data: Encoded image bytes from the request body or Blob Storage
+        employees: Employee references with employeeId and documentId
+        message_id: ID of the validation request
+        profile: Extraction profile for the input image
+        source: Description of the image for error messages
+        blob_version: Optional (blob path, ETag) of a downloaded image, to cache its features under
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        logger.error(f"Could not decode {source} for request {message_id}")
+        raise HTTPException(status_code=400, detail=f"Could not decode {source}")
+    
+    try:
+        return _match_image(image, employees, message_id, profile, blob_version=blob_version)
+    except Exception as e:
+        logger.error(f"Error validating retina: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error validating retina: {str(e)}")
+
+def _persist_upload(background_tasks: BackgroundTasks, data: bytes, message_id: str, content_type: Optional[str]) -> None:
+    """
+    Schedule an uploaded image to be stored in Blob Storage after the response is sent.
+    
+    Does nothing unless UPLOAD_BLOB_PREFIX is set. The blob name is generated
+    by the server, never taken from the client's messageId, and existing
+    blobs are never overwritten.
+    
+    Args:
+        background_tasks: Background tasks of the request
+        data: Encoded image bytes
+        message_id: ID of the validation request, logged with the blob name
+        content_type: Content type of the upload
+    """
+    prefix = os.getenv("UPLOAD_BLOB_PREFIX")
+    if not prefix:
+        return
+    
+    extension = mimetypes.guess_extension(content_type or "") or ".jpg"
+    blob_path = f"{prefix.rstrip('/')}/{uuid.uuid4().hex}{extension}"
+    logger.info(f"Storing the image of validation request {message_id} as blob {blob_path}")
+    background_tasks.add_task(async_blob_client.upload_blob_bytes, data, blob_path, content_type, overwrite=False)
+
+@app.post("/validate/upload")
+async def validate_retina_upload(
+    background_tasks: BackgroundTasks,
+    image: UploadFile = File(...),
+    employees: str = Form(...),
+    messageId: str = Form(...),
+    profile: Optional[str] = Form(None)
+):
+    """
+    Validate a retina image uploaded as multipart form data.
+    
+    Args:
+        background_tasks: Background tasks used to persist the image after responding
+        image: Image file
+        employees: JSON list of {"employeeId", "documentId"} references
+        messageId: ID of the validation request
+        profile: Optional extraction profile (defaults to VALIDATION_PROFILE)
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    """
+    extraction_profile = _resolve_profile(profile)
+    
+    try:
+        references = TypeAdapter(List[EmployeeReference]).validate_json(employees)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid employees field: {str(e)}")
+    if not references:
+        raise HTTPException(status_code=400, detail="Missing required field: employees")
+    
+    # Read at most one byte past the limit to detect oversized uploads
+    data = await image.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    
+    logger.info(f"Received upload validation request {messageId}: {len(data)} bytes, {len(references)} employees")
+    
+    employee_list = [{"employeeId": emp.employeeId, "documentId": emp.documentId} for emp in references]
+    key = make_key("upload", hashlib.sha256(data).hexdigest(), _employee_key(employee_list), extraction_profile.name)
+    response = await validation_flight.do(
+        key,
+        lambda: _run_admitted(messageId, _run_upload_validation, data, employee_list, messageId, extraction_profile),
+        cacheable=_is_success
+    )
+    _persist_upload(background_tasks, data, messageId, image.content_type)
+    return {**response, "messageId": messageId}
+
+@app.post("/validate/raw")
+async def validate_retina_raw(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    messageId: str,
+    employee: List[str] = Query(..., description="Employee reference as employeeId:documentId; repeat for each employee"),
+    profile: Optional[str] = None
+):
+    """
+    Validate a retina image sent as the raw request body (e.g. Content-Type: image/jpeg).
+    
+    Args:
+        request: Request whose body is the encoded image
+        background_tasks: Background tasks used to persist the image after responding
+        messageId: ID of the validation request
+        employee: Employee references as employeeId:documentId
+        profile: Optional extraction profile (defaults to VALIDATION_PROFILE)
+    
+    Returns:
+        Dict: Validation results including matching employee ID if found
+    """
+    extraction_profile = _resolve_profile(profile)
+    
+    employees = []
+    for reference in employee:
+        employee_id, _, document_id = reference.partition(":")
+        if not employee_id or not document_id:
+            raise HTTPException(status_code=400, detail=f"Invalid employee reference: {reference}")
+        employees.append({"employeeId": employee_id, "documentId": document_id})
+    
+    # Reject declared oversized bodies before reading them, and enforce the limit while streaming
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    if not body:
+        raise HTTPException(status_code=400, detail="Empty request body")
+    data = bytes(body)
+    
+    logger.info(f"Received raw validation request {messageId}: {len(data)} bytes, {len(employees)} employees")
+    
+    key = make_key("upload", hashlib.sha256(data).hexdigest(), _employee_key(employees), extraction_profile.name)
+    response = await validation_flight.do(
+        key,
+        lambda: _run_admitted(messageId, _run_upload_validation, data, employees, messageId, extraction_profile),
+        cacheable=_is_success
+    )
+    _persist_upload(background_tasks, data, messageId, request.headers.get("content-type"))
+    return {**response, "messageId": messageId}
+
+def _load_batch_image(item: BatchImage) -> np.ndarray:
+    """
+    Load the image of a batch item from Blob Storage or its inline data.
+    
+    Args:
+        item: Batch item with image_path or image_data
+    
+    Returns:
+        np.ndarray: Decoded BGR image
+    
+    Raises:
+        ValueError: If the image cannot be downloaded or decoded
+    """
+    if item.image_data:
+        data = base64.b64decode(item.image_data)
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise ValueError(f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image data")
+        return image
+    
+    temp_image_path = blob_client.download_blob_to_temp(item.image_path)
+    if not temp_image_path:
+        raise ValueError(f"Failed to download image from blob: {item.image_path}")
+    try:
+        image = cv2.imread(temp_image_path)
+        if image is None:
+            raise ValueError(f"Could not read image from blob: {item.image_path}")
+        return image
+    finally:
+        try:
+            os.remove(temp_image_path)
+        except OSError as e:
+            logger.warning(f"Failed to remove temporary file {temp_image_path}: {str(e)}")
+
+def _ndjson(record: Dict[str, Any]) -> str:
+    """Serialize one result record as an NDJSON line."""
+    return json.dumps(record, default=str) + "\n"
+
+async def _stream_batch(items: List[BatchImage], func, flush=None, release=None):
+    """
+    Run a blocking function for every batch item on the batch executor and stream the results.
+    
+    Args:
+        items: Batch items
+        func: Blocking function called as func(index, item), returning a result record
+        flush: Optional blocking function receiving the list of finished records
+               (at most BATCH_WRITE_SIZE) before they are sent, e.g. to write them in bulk;
+               it runs in its own thread while the extractions continue
+        release: Optional coroutine function awaited once the stream ends, fails or is closed
+    
+    Yields:
+        str: One NDJSON line per item, in completion order
+    """
+    loop = asyncio.get_running_loop()
+    
+    def run_item(index: int, item: BatchImage) -> Dict[str, Any]:
+        try:
+            return func(index, item)
+        except Exception as e:
+            return {"index": index, "status": "error", "message": str(e)}
+    
+    tasks = [loop.run_in_executor(batch_executor, run_item, index, item) for index, item in enumerate(items)]
+    pending_records = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            record = await next_done
+            if flush is None:
+                yield _ndjson(record)
+                continue
+            pending_records.append(record)
+            if len(pending_records) >= BATCH_WRITE_SIZE:
+                # Not on the batch executor, where the write would queue behind every pending extraction
+                await asyncio.to_thread(flush, pending_records)
+                for pending in pending_records:
+                    yield _ndjson(pending)
+                pending_records = []
+        
+        if pending_records:
+            await asyncio.to_thread(flush, pending_records)
+            for pending in pending_records:
+                yield _ndjson(pending)
+    finally:
+        # Drop items not started yet if the client went away
+        for task in tasks:
+            task.cancel()
+        if release is not None:
+            await release()
+
+def _admit_batch(item_count: int) -> Callable[[], Awaitable[None]]:
+    """
+    Check the size of a batch and reserve one of the batch slots for it.
+    
+    Args:
+        item_count: Number of items in the batch
+    
+    Returns:
+        Function releasing the slot; calls after the first have no effect
+    
+    Raises:
+        HTTPException: 400 for empty or oversized batches, 429 if all batch slots are taken
+    """
+    global running_batches
+    
+    if item_count == 0:
+        raise HTTPException(status_code=400, detail="Missing required field: items")
+    if item_count > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_ITEMS} items")
+    if running_batches >= MAX_CONCURRENT_BATCHES:
+        raise HTTPException(status_code=429, detail="Too many batches in progress",
+                            headers={"Retry-After": VALIDATION_RETRY_AFTER})
+    running_batches += 1
+    released = False
+    
+    async def release() -> None:
+        global running_batches
+        nonlocal released
+        if not released:
+            released = True
+            running_batches -= 1
+    
+    return release
+
+@app.post("/enroll/batch")
+async def enroll_batch(request: BatchEnrollmentRequest):
+    """
+    Enroll many retina images, streaming one NDJSON result line per image as it finishes.
+    
+    Images are extracted in parallel; the resulting templates are written to
+    Cosmos DB in bulk, BATCH_WRITE_SIZE at a time.
+    
+    Args:
+        request: Batch enrollment request
+    
+    Returns:
+        StreamingResponse: NDJSON lines with the item index, status and Cosmos DB ID
+    """
+    if not ready:
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
+    try:
+        profile = get_profile(request.profile or os.getenv("ENROLLMENT_PROFILE"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    release = _admit_batch(len(request.items))
+    logger.info(f"Received batch enrollment of {len(request.items)} images")
+    
+    def extract(index: int, item: BatchEnrollmentItem) -> Dict[str, Any]:
+        features = retina_processor.extract_features(_load_batch_image(item), use_cache=False, profile=profile)
+        return {
+            "index": index,
+            "status": "pending",
+            "employeeId": item.employeeId,
+            "originalImage": item.image_path,
+            "imgId": item.imgId,
+            "profile": features["profile"],
+            "features": features
+        }
+    
+    def store(records: List[Dict[str, Any]]) -> None:
+        extracted = [record for record in records if record["status"] == "pending"]
+        if not extracted:
+            return
+        # Re-enrolling the same image replaces its document instead of duplicating it
+        item_ids = [
+            CosmosDBClient.enrollment_id(record["employeeId"], record["imgId"] or record["originalImage"], record["profile"])
+            if record["imgId"] or record["originalImage"] else None
+            for record in extracted
+        ]
+        cosmos_ids = retina_processor.export_features_many(
+            [record.pop("features") for record in extracted],
+            [record["employeeId"] for record in extracted],
+            item_ids
+        )
+        for record, cosmos_id in zip(extracted, cosmos_ids):
+            if cosmos_id:
+                record.update({"status": "success", "id": cosmos_id})
+            else:
+                record.update({"status": "error", "message": "Failed to store features in Cosmos DB"})
+    
+    # The stream releases the slot when it ends; the background task covers a stream
+    # that never started because the client disconnected first
+    return StreamingResponse(_stream_batch(request.items, extract, flush=store, release=release),
+                             media_type="application/x-ndjson", background=BackgroundTask(release))
+
+@app.post("/validate/batch")
+async def validate_batch(request: BatchValidationRequest):
+    """
+    Validate many retina images, streaming one NDJSON result line per image as it finishes.
+    
+    All referenced templates are read from Cosmos DB up front in bulk; the
+    images are then extracted and compared in parallel.
+    
+    Args:
+        request: Batch validation request
+    
+    Returns:
+        StreamingResponse: NDJSON lines with the item index and validation result
+    """
+    profile = _resolve_profile(request.profile)
+    release = _admit_batch(len(request.items))
+    logger.info(f"Received batch validation of {len(request.items)} images")
+    
+    def load_templates() -> Dict[str, Dict[str, Any]]:
+        document_ids = {emp.documentId for item in request.items for emp in item.employees if emp.documentId}
+        templates = {}
+        for document_id in document_ids:
+            cached = _gallery_get(document_id)
+            if cached is None:
+                cached = template_cache.get(document_id)
+            if cached is not None:
+                templates[document_id] = cached
+        missing = [document_id for document_id in document_ids if document_id not in templates]
+        if missing:
+            fetched = cosmos_client.get_features_many(missing)
+            for document_id, document in fetched.items():
+                if document is not None:
+                    template_cache.put(document_id, document)
+            templates.update(fetched)
+        return templates
+    
+    templates = None
+    try:
+        templates = await asyncio.get_running_loop().run_in_executor(batch_executor, load_templates)
+    except Exception as e:
+        logger.error(f"Error loading templates for batch validation: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error loading templates: {str(e)}")
+    finally:
+        # Also when the request is cancelled while the templates load
+        if templates is None:
+            await release()
+    
+    def validate(index: int, item: BatchValidationItem) -> Dict[str, Any]:
+        employees = [{"employeeId": emp.employeeId, "documentId": emp.documentId} for emp in item.employees]
+        result = _match_image(_load_batch_image(item), employees, item.messageId, profile, templates)
+        return {"index": index, **result}
+    
+    return StreamingResponse(_stream_batch(request.items, validate, release=release),
+                             media_type="application/x-ndjson", background=BackgroundTask(release))
+
 # This is used when running the app directly with Python
 # In Docker, we'll use uvicorn through supervisord
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""
+Benchmark script for the retina processor.
+This script measures feature extraction latency and allocator churn on a directory of retina images.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from retina_processor import RetinaProcessor
+from template_gallery import TemplateGallery, drift_report
+
+
+def load_images(image_dir: str) -> list:
+    """
+    Load all images from a directory.
+
+    Args:
+        image_dir: Directory containing retina images
+
+    Returns:
+        List of (filename, image) tuples
+    """
+    images = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        image = cv2.imread(path)
+        if image is not None:
+            images.append((os.path.basename(path), image))
+    return images
+
+
+def run_extraction(processor: RetinaProcessor, images: list, iterations: int) -> list:
+    """
+    Extract features from every image repeatedly, bypassing the feature cache.
+
+    Args:
+        processor: Retina processor to benchmark
+        images: List of (filename, image) tuples
+        iterations: Number of passes over the images
+
+    Returns:
+        List of per-extraction latencies in seconds
+    """
+    latencies = []
+    for _ in range(iterations):
+        for _, image in images:
+            start_time = time.perf_counter()
+            processor.extract_features(image, use_cache=False)
+            latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def measure_allocations(processor: RetinaProcessor, images: list) -> dict:
+    """
+    Measure Python/NumPy allocator churn of steady-state extraction with tracemalloc.
+
+    Args:
+        processor: Retina processor to benchmark (already warmed up)
+        images: List of (filename, image) tuples
+
+    Returns:
+        Dictionary with mean retained bytes and mean peak transient bytes per extraction
+    """
+    retained = []
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _, image in images:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            processor.extract_features(image, use_cache=False)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            # Net growth per file still allocated after the extraction; memory allocated
+            # and freed again during it only shows in the peak
+            diff = after.compare_to(before, "filename")
+            retained.append(sum(stat.size_diff for stat in diff if stat.size_diff > 0))
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+    return {
+        "mean_retained_bytes": float(np.mean(retained)),
+        "mean_peak_transient_bytes": float(np.mean(peaks))
+    }
+
+
+def measure_gallery_drift(processor: RetinaProcessor, images: list, dtype: str) -> dict:
+    """
+    Compare quantized gallery scores with full precision, using each image as a
+    template and a noisy copy of it as a probe.
+
+    Args:
+        processor: Retina processor
+        images: List of (filename, image) tuples
+        dtype: Gallery storage type (int8, int4 or float16)
+
+    Returns:
+        Drift report of template_gallery.drift_report
+    """
+    rng = np.random.default_rng(0)
+    templates = {name: processor.extract_features(image, use_cache=False) for name, image in images}
+    probes = [
+        processor.extract_features(
+            np.clip(image.astype(np.int16) + rng.integers(-8, 9, image.shape), 0, 255).astype(np.uint8),
+            use_cache=False
+        )
+        for _, image in images
+    ]
+    gallery = TemplateGallery(processor, dtype=dtype)
+    gallery.add_many(templates.items())
+    return drift_report(gallery, probes, templates)
+
+
+def main():
+    """Main function to run the benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark retina feature extraction")
+    parser.add_argument("--image-dir", default="../../retinal_images", help="Directory with retina images")
+    parser.add_argument("--iterations", type=int, default=5, help="Number of passes over the images")
+    parser.add_argument("--profile", default=None, help="Extraction profile (fast, standard, high_accuracy)")
+    parser.add_argument("--gallery-dtype", default=None, help="Also report quantized gallery drift (int8, int4 or float16)")
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir)
+    if not images:
+        print(f"Error: No readable images found in {args.image_dir}")
+        return
+
+    processor = RetinaProcessor(profile=args.profile)
+
+    # Silence the per-call cache and performance prints of the processor
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Warm-up pass: sizes the per-worker buffers and loads OpenCV code paths
+        run_extraction(processor, images, 1)
+        ctx = processor._get_context()
+        allocations_before = ctx.allocations
+
+        processor.stage_metrics.reset()
+        latencies = run_extraction(processor, images, args.iterations)
+        allocation_stats = measure_allocations(processor, images)
+        drift = measure_gallery_drift(processor, images, args.gallery_dtype) if args.gallery_dtype else None
+
+    latencies_ms = np.array(latencies) * 1000
+    context_stats = ctx.stats()
+
+    print(f"\nBenchmark Results ({len(images)} images x {args.iterations} iterations, profile '{processor.profile.name}'):")
+    print(f"Mean latency: {latencies_ms.mean():.2f} ms")
+    print(f"P50 latency: {np.percentile(latencies_ms, 50):.2f} ms")
+    print(f"P95 latency: {np.percentile(latencies_ms, 95):.2f} ms")
+    print(f"Throughput: {1000 / latencies_ms.mean():.1f} images/s")
+    print(f"Stage workers: {processor.stage_workers}, OpenCV threads: {processor.opencv_threads}")
+    print("\nStage Timings:")
+    for stage, stats in processor.get_stage_metrics().items():
+        print(f"{stage}: mean {stats['mean_ms']:.2f} ms, max {stats['max_ms']:.2f} ms")
+    print("\nAllocator Churn (per extraction):")
+    print(f"Peak transient allocation: {allocation_stats['mean_peak_transient_bytes'] / 1024:.1f} KiB")
+    print(f"Retained allocation: {allocation_stats['mean_retained_bytes'] / 1024:.1f} KiB")
+    print(f"Context buffers: {context_stats['buffers']} ({context_stats['buffer_bytes'] / 1024:.1f} KiB)")
+    print(f"Context buffer reallocations after warm-up: {ctx.allocations - allocations_before}")
+    if drift:
+        print(f"\nGallery Drift ({drift['dtype']}, {drift['probes']} probes x {drift['templates']} templates):")
+        print(f"Max similarity error: {drift['max_abs_error']:.6f}, mean: {drift['mean_abs_error']:.6f}")
+        print(f"Match decision flips: {drift['decision_flips']}, rank-1 agreement: {drift['rank1_agreement']:.1%}")
+        print(f"Memory per template: {drift['bytes_per_template']:.0f} bytes "
+              f"(float64: {drift['float64_bytes_per_template']} bytes)")
+
+
+if __name__ == "__main__":
+    main()
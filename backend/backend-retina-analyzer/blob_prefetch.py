@@ -0,0 +1,217 @@
+"""
+Prefetching of blob images for the Service Bus consumer.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, Optional
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from probe_cache import ProbeCache
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger("BlobPrefetcher")
+
+# Size assumed of a decoded image before any was prefetched (a 2048x2048 BGR image)
+INITIAL_IMAGE_BYTES = 2048 * 2048 * 3
+
+
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    """
+    Decode an encoded image like cv2.imread reads an image file.
+
+    Args:
+        data: Encoded image (JPEG, PNG, ...)
+
+    Returns:
+        BGR image, or None if the data is not a readable image
+    """
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class BlobPrefetcher:
+    """
+    Downloads and decodes blob images before the handlers that need them run.
+
+    The consumer calls prefetch for every message as soon as it is received,
+    which starts downloading and decoding its image in the background, and
+    release once the message is settled. Handlers call get, which returns the
+    prefetched image, waiting for it if it is still on its way, or loads the
+    image itself if it was not prefetched. Decoded images held or expected
+    count against a budget in bytes; messages arriving while it is used up
+    are not prefetched, so their handlers download the image when they run.
+
+    With a probe cache, the blob's ETag is read first and an image whose
+    current version already has cached features is not downloaded.
+    """
+    def __init__(self, blob_client: Any, max_bytes: Optional[int] = None,
+                 probe_cache: Optional[ProbeCache] = None):
+        """
+        Initialize the prefetcher.
+
+        Args:
+            blob_client: AsyncBlobStorageClient to download with
+            max_bytes: Budget of the prefetched images in bytes (defaults to the BLOB_PREFETCH_BYTES
+                       environment variable, then 256 MiB; 0 disables prefetching)
+            probe_cache: Optional cache of extracted probe features by blob version
+        """
+        self.blob_client = blob_client
+        self.probe_cache = probe_cache
+        self.max_bytes = (max_bytes if max_bytes is not None
+                          else int(os.getenv("BLOB_PREFETCH_BYTES", str(256 * 1024 * 1024))))
+        self.held_bytes = 0
+        self._expected_bytes = INITIAL_IMAGE_BYTES
+        # Blob path -> [load task, references, bytes counted against the budget, ETag task]
+        self._entries: Dict[str, list] = {}
+        self.prefetched = 0
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, blob_path: Optional[str]) -> bool:
+        """
+        Start loading an image in the background; every call must be paired with a release.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+
+        Returns:
+            True if the image is prefetched, False if the budget is used up
+        """
+        if not blob_path or self.max_bytes <= 0:
+            return False
+        entry = self._entries.get(blob_path)
+        if entry is not None:
+            # Duplicate messages for the same image share one download
+            entry[1] += 1
+            return True
+        # One image is always prefetched, however large, so the pipeline never stalls
+        if self._entries and self.held_bytes + self._expected_bytes > self.max_bytes:
+            self.skipped += 1
+            return False
+
+        entry = [None, 1, self._expected_bytes, None]
+        self.held_bytes += entry[2]
+        if self._uses_probe_cache():
+            entry[3] = asyncio.create_task(self.blob_client.get_blob_etag(blob_path))
+        entry[0] = asyncio.create_task(self._prefetch(blob_path, entry))
+        self._entries[blob_path] = entry
+        self.prefetched += 1
+        return True
+
+    def release(self, blob_path: Optional[str]) -> None:
+        """
+        Drop a reference taken by prefetch, freeing the image once no message needs it.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+        """
+        entry = self._entries.get(blob_path) if blob_path else None
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del self._entries[blob_path]
+        entry[0].cancel()
+        if entry[3] is not None:
+            entry[3].cancel()
+        self.held_bytes -= entry[2]
+
+    async def get(self, blob_path: str) -> Optional[np.ndarray]:
+        """
+        Get an image, prefetched or loaded now.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+
+        Returns:
+            BGR image, or None if it could not be downloaded or decoded
+        """
+        entry = self._entries.get(blob_path)
+        if entry is None:
+            self.misses += 1
+            return await self.load(blob_path)
+        # Shielded, so a cancelled handler does not cancel the download other messages share
+        image = await asyncio.shield(entry[0])
+        if image is None and entry[2] == 0:
+            # Not downloaded because features were cached, but not for the handler's profile
+            self.misses += 1
+            return await self.load(blob_path)
+        self.hits += 1
+        return image
+
+    async def get_etag(self, blob_path: str) -> Optional[str]:
+        """
+        Get the ETag of a blob, read when its message arrived or now.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+
+        Returns:
+            ETag of the blob, or None if there is no probe cache or it could not be read
+        """
+        if not self._uses_probe_cache():
+            return None
+        entry = self._entries.get(blob_path)
+        if entry is None or entry[3] is None:
+            return await self.blob_client.get_blob_etag(blob_path)
+        return await asyncio.shield(entry[3])
+
+    def _uses_probe_cache(self) -> bool:
+        """Check if blob versions are looked up in a probe cache."""
+        return self.probe_cache is not None and self.probe_cache.is_enabled()
+
+    async def load(self, blob_path: str) -> Optional[np.ndarray]:
+        """
+        Download and decode an image without prefetching it.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+
+        Returns:
+            BGR image, or None if it could not be downloaded or decoded
+        """
+        data = await self.blob_client.download_blob_bytes(blob_path)
+        if data is None:
+            return None
+        # Decoding takes tens of milliseconds for a large image, so it runs in a worker thread
+        image = await asyncio.to_thread(decode_image, data)
+        if image is None:
+            logger.error(f"Could not decode image from blob: {blob_path}")
+        return image
+
+    async def _prefetch(self, blob_path: str, entry: list) -> Optional[np.ndarray]:
+        """Load a prefetched image and count its actual size against the budget."""
+        if entry[3] is not None and self.probe_cache.contains(blob_path, await entry[3]):
+            # The handler gets the cached features, so the image is neither transferred nor decoded
+            if self._entries.get(blob_path) is entry:
+                self.held_bytes -= entry[2]
+                entry[2] = 0
+            return None
+        image = await self.load(blob_path)
+        if image is not None and self._entries.get(blob_path) is entry:
+            self.held_bytes += image.nbytes - entry[2]
+            entry[2] = image.nbytes
+            self._expected_bytes = int(0.8 * self._expected_bytes + 0.2 * image.nbytes)
+        return image
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get prefetch statistics.
+
+        Returns:
+            Dictionary with the buffered images and bytes, and prefetch, hit and miss counts
+        """
+        return {
+            "buffered": len(self._entries),
+            "held_bytes": self.held_bytes,
+            "max_bytes": self.max_bytes,
+            "prefetched": self.prefetched,
+            "skipped": self.skipped,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -2,9 +2,11 @@
 Azure Blob Storage integration for retina image retrieval.
 """
 import os
+import asyncio
 import tempfile
 from typing import Optional
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from dotenv import load_dotenv
 import logging
 
@@ -142,6 +144,37 @@ class BlobStorageClient:
             logger.error(f"Error uploading file {file_path}: {str(e)}")
             return None
     
+    def upload_blob_bytes(self, data: bytes, blob_path: str, content_type: Optional[str] = None) -> Optional[str]:
+        """
+        Upload in-memory data to Blob Storage.
+        
+        Args:
+            data: Content to upload
+            blob_path: Path to use in Blob Storage
+            content_type: Optional content type stored with the blob
+        
+        Returns:
+            Path to the uploaded blob, or None if upload failed
+        """
+        if not self.is_configured() or self.container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return None
+        
+        try:
+            # Get the blob client
+            blob_client = self.container_client.get_blob_client(blob_path)
+        
+            # Upload the data
+            content_settings = ContentSettings(content_type=content_type) if content_type else None
+            blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+        
+            logger.info(f"Uploaded {len(data)} bytes to blob {blob_path}")
+            return blob_path
+        
+        except Exception as e:
+            logger.error(f"Error uploading data to blob {blob_path}: {str(e)}")
+            return None
+        
     def delete_blob(self, blob_path: str) -> bool:
         """
         Delete a blob from storage.
@@ -169,3 +202,270 @@ class BlobStorageClient:
         except Exception as e:
             logger.error(f"Error deleting blob {blob_path}: {str(e)}")
             return False
+
+class AsyncBlobStorageClient:
+    """
+    Asynchronous client for Azure Blob Storage operations, for use from the event loop.
+    
+    All requests share one aiohttp connection pool, created on first use in
+    the running event loop, so downloads reuse connections instead of opening
+    one per blob. Blobs larger than BLOB_SINGLE_GET_SIZE are downloaded in
+    ranges of BLOB_CHUNK_SIZE, BLOB_MAX_CONCURRENCY at a time. Every operation
+    is bounded by the connection, read and operation timeouts, and local file
+    I/O runs in a worker thread, so the event loop never waits on storage.
+    """
+    def __init__(self):
+        """Initialize the asynchronous Blob Storage client."""
+        self.connection_string = os.getenv("BLOB_CONNECTION_STRING")
+        self.container_name = os.getenv("BLOB_CONTAINER_NAME")
+        self.max_concurrency = max(1, int(os.getenv("BLOB_MAX_CONCURRENCY", "4")))
+        self.single_get_size = int(os.getenv("BLOB_SINGLE_GET_SIZE", str(4 * 1024 * 1024)))
+        self.chunk_size = int(os.getenv("BLOB_CHUNK_SIZE", str(4 * 1024 * 1024)))
+        self.pool_size = int(os.getenv("BLOB_POOL_SIZE", "100"))
+        self.connection_timeout = float(os.getenv("BLOB_CONNECTION_TIMEOUT", "10"))
+        self.read_timeout = float(os.getenv("BLOB_READ_TIMEOUT", "30"))
+        self.operation_timeout = float(os.getenv("BLOB_OPERATION_TIMEOUT", "120"))
+        self.blob_service_client = None
+        self.container_client = None
+        self._session = None
+        self._lock = asyncio.Lock()
+    
+    def is_configured(self) -> bool:
+        """Check if Blob Storage is configured."""
+        return (
+            self.connection_string is not None and
+            self.connection_string != "your-blob-connection-string" and
+            self.container_name is not None
+        )
+    
+    async def _get_container_client(self):
+        """
+        Get the container client, creating the shared connection pool on first use.
+        
+        Returns:
+            The asynchronous container client, or None if Blob Storage is not configured or the connection failed
+        """
+        if self.container_client is not None or not self.is_configured():
+            return self.container_client
+        
+        async with self._lock:
+            if self.container_client is None:
+                try:
+                    # aiohttp is only needed once the asynchronous client is used
+                    import aiohttp
+                    from azure.core.pipeline.transport import AioHttpTransport
+                    
+                    self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+                    self.blob_service_client = AsyncBlobServiceClient.from_connection_string(
+                        self.connection_string,
+                        transport=AioHttpTransport(session=self._session, session_owner=False),
+                        connection_timeout=self.connection_timeout,
+                        read_timeout=self.read_timeout,
+                        max_single_get_size=self.single_get_size,
+                        max_chunk_get_size=self.chunk_size
+                    )
+                    self.container_client = self.blob_service_client.get_container_client(self.container_name)
+                    logger.info(f"Connected to Blob Storage container (async): {self.container_name}")
+                except Exception as e:
+                    logger.error(f"Failed to connect to Blob Storage: {str(e)}")
+                    await self.close()
+        return self.container_client
+    
+    async def download_blob_bytes(self, blob_path: str) -> Optional[bytes]:
+        """
+        Download a blob into memory.
+        
+        Args:
+            blob_path: Path to the blob in the container
+            
+        Returns:
+            Content of the blob, or None if download failed
+        """
+        container_client = await self._get_container_client()
+        if container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return None
+        
+        try:
+            blob_client = container_client.get_blob_client(blob_path)
+            
+            async def download() -> bytes:
+                downloader = await blob_client.download_blob(max_concurrency=self.max_concurrency)
+                return await downloader.readall()
+            
+            data = await asyncio.wait_for(download(), timeout=self.operation_timeout)
+            logger.info(f"Downloaded blob {blob_path} ({len(data)} bytes)")
+            return data
+        except Exception as e:
+            logger.error(f"Error downloading blob {blob_path}: {str(e)}")
+            return None
+    
+    async def get_blob_etag(self, blob_path: str) -> Optional[str]:
+        """
+        Get the version of a blob with a properties request, without downloading it.
+        
+        Args:
+            blob_path: Path to the blob in the container
+        
+        Returns:
+            ETag of the blob (its last-modified time if it has none), or None if the request failed
+        """
+        container_client = await self._get_container_client()
+        if container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return None
+        
+        try:
+            blob_client = container_client.get_blob_client(blob_path)
+            properties = await asyncio.wait_for(blob_client.get_blob_properties(), timeout=self.operation_timeout)
+            if properties.etag:
+                return properties.etag
+            return properties.last_modified.isoformat() if properties.last_modified else None
+        except Exception as e:
+            logger.error(f"Error reading properties of blob {blob_path}: {str(e)}")
+            return None
+    
+    async def download_blob_to_temp(self, blob_path: str) -> Optional[str]:
+        """
+        Download a blob to a temporary file.
+        
+        Args:
+            blob_path: Path to the blob in the container
+            
+        Returns:
+            Path to the downloaded temporary file, or None if download failed
+        """
+        data = await self.download_blob_bytes(blob_path)
+        if data is None:
+            return None
+        
+        def write() -> str:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(blob_path)[1]) as temp_file:
+                temp_file.write(data)
+                return temp_file.name
+        
+        try:
+            temp_file_path = await asyncio.to_thread(write)
+            logger.info(f"Downloaded blob {blob_path} to {temp_file_path}")
+            return temp_file_path
+        except OSError as e:
+            logger.error(f"Error writing blob {blob_path} to a temporary file: {str(e)}")
+            return None
+    
+    async def list_blobs(self, prefix: Optional[str] = None) -> list:
+        """
+        List blobs in the container.
+        
+        Args:
+            prefix: Optional prefix to filter blobs
+            
+        Returns:
+            List of blob names
+        """
+        container_client = await self._get_container_client()
+        if container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return []
+        
+        try:
+            async def collect() -> list:
+                return [blob.name async for blob in container_client.list_blobs(name_starts_with=prefix)]
+            
+            return await asyncio.wait_for(collect(), timeout=self.operation_timeout)
+        except Exception as e:
+            logger.error(f"Error listing blobs: {str(e)}")
+            return []
+    
+    async def upload_blob(self, file_path: str, blob_path: Optional[str] = None) -> Optional[str]:
+        """
+        Upload a file to Blob Storage.
+        
+        Args:
+            file_path: Path to the local file
+            blob_path: Optional path to use in Blob Storage (default: filename)
+            
+        Returns:
+            Path to the uploaded blob, or None if upload failed
+        """
+        if not os.path.exists(file_path):
+            logger.error(f"File not found: {file_path}")
+            return None
+        
+        def read() -> bytes:
+            with open(file_path, "rb") as file:
+                return file.read()
+        
+        try:
+            data = await asyncio.to_thread(read)
+        except OSError as e:
+            logger.error(f"Error reading file {file_path}: {str(e)}")
+            return None
+        
+        return await self.upload_blob_bytes(data, blob_path if blob_path is not None else os.path.basename(file_path))
+    
+    async def upload_blob_bytes(self, data: bytes, blob_path: str, content_type: Optional[str] = None,
+                                overwrite: bool = True) -> Optional[str]:
+        """
+        Upload in-memory data to Blob Storage.
+        
+        Args:
+            data: Content to upload
+            blob_path: Path to use in Blob Storage
+            content_type: Optional content type stored with the blob
+            overwrite: Whether an existing blob is replaced (otherwise the upload fails)
+        
+        Returns:
+            Path to the uploaded blob, or None if upload failed
+        """
+        container_client = await self._get_container_client()
+        if container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return None
+        
+        try:
+            blob_client = container_client.get_blob_client(blob_path)
+            content_settings = ContentSettings(content_type=content_type) if content_type else None
+            await asyncio.wait_for(
+                blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings,
+                                        max_concurrency=self.max_concurrency),
+                timeout=self.operation_timeout
+            )
+            logger.info(f"Uploaded {len(data)} bytes to blob {blob_path}")
+            return blob_path
+        except Exception as e:
+            logger.error(f"Error uploading data to blob {blob_path}: {str(e)}")
+            return None
+    
+    async def delete_blob(self, blob_path: str) -> bool:
+        """
+        Delete a blob from storage.
+        
+        Args:
+            blob_path: Path to the blob in the container
+            
+        Returns:
+            True if deletion was successful, False otherwise
+        """
+        container_client = await self._get_container_client()
+        if container_client is None:
+            logger.error("Blob Storage not configured or not connected")
+            return False
+        
+        try:
+            blob_client = container_client.get_blob_client(blob_path)
+            await asyncio.wait_for(blob_client.delete_blob(), timeout=self.operation_timeout)
+            logger.info(f"Deleted blob {blob_path}")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting blob {blob_path}: {str(e)}")
+            return False
+    
+    async def close(self) -> None:
+        """Close the service client and the shared connection pool."""
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
+        if self._session is not None:
+            await self._session.close()
+        self.blob_service_client = None
+        self.container_client = None
+        self._session = None
@@ -2,31 +2,85 @@
 Azure Cosmos DB integration for storing and retrieving retina features.
 """
 import os
-from typing import Dict, Any, List, Optional
+import threading
+import time
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Union
 from azure.cosmos import CosmosClient, PartitionKey, exceptions
 from dotenv import load_dotenv
+from feature_set import FeatureSet
+from ru_limiter import shared_limiter
 import uuid
 import json
+import re
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Field names usable in query projections
+FIELD_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Supported partition key layouts of the features container
+PARTITION_KEY_PATHS = ("/id", "/person_id")
+
+# Indexing policy of the features container: only the fields queries filter or sort on are
+# indexed, so writes do not pay for indexing every element of the feature arrays
+FEATURES_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [
+        {"path": "/id/?"},
+        {"path": "/person_id/?"},
+        {"path": "/timestamp/?"},
+        {"path": "/_ts/?"},
+        {"path": "/profile/?"},
+        {"path": "/extractor_version/?"}
+    ],
+    "excludedPaths": [
+        {"path": "/*"},
+        {"path": "/\"_etag\"/?"}
+    ]
+}
+
 class CosmosDBClient:
-    """Client for interacting with Azure Cosmos DB."""
+    """
+    Client for interacting with Azure Cosmos DB.
+    
+    The features container is partitioned either by /id (the original layout)
+    or by /person_id, which makes a person's templates a single-partition read.
+    The layout of an existing container is detected when connecting.
+    """
     
-    def __init__(self):
-        """Initialize the Cosmos DB client with connection parameters from environment variables."""
+    def __init__(self, container_name: Optional[str] = None, partition_key_path: Optional[str] = None):
+        """
+        Initialize the Cosmos DB client with connection parameters from environment variables.
+        
+        Args:
+            container_name: Optional container name (defaults to the COSMOS_CONTAINER environment variable)
+            partition_key_path: Partition key path of a newly created container, "/id" or "/person_id"
+                (defaults to the COSMOS_PARTITION_KEY environment variable, then "/id")
+        """
         # Get connection parameters from environment variables
         self.endpoint = os.getenv("COSMOS_ENDPOINT")
         self.key = os.getenv("COSMOS_KEY")
         self.database_name = os.getenv("COSMOS_DATABASE", "retina_database")
-        self.container_name = os.getenv("COSMOS_CONTAINER", "retina_features")
+        self.container_name = container_name or os.getenv("COSMOS_CONTAINER", "retina_features")
+        self.partition_key_path = partition_key_path or os.getenv("COSMOS_PARTITION_KEY", "/id")
+        if not self.partition_key_path.startswith("/"):
+            self.partition_key_path = f"/{self.partition_key_path}"
+        if self.partition_key_path not in PARTITION_KEY_PATHS:
+            raise ValueError(f"Unsupported partition key: {self.partition_key_path}. Use /id or /person_id")
         
         # Initialize the client
         self.client = None
         self.database = None
         self.container = None
         
+        # Writes are paced to this process's share of the container's throughput and retried
+        # when throttled; all clients of the container in this process share one budget
+        self.limiter = shared_limiter(self.endpoint or "", self.database_name, self.container_name)
+        self.bulk_stats: Dict[str, Any] = {"batches": 0, "items": 0, "stored": 0, "failed": 0, "last_batch": None}
+        self._bulk_lock = threading.Lock()
+        
         # Initialize connection if credentials are available
         if self.endpoint and self.key:
             self._initialize_connection()
@@ -43,17 +97,104 @@ class CosmosDBClient:
             # Get or create the container
             self.container = self.database.create_container_if_not_exists(
                 id=self.container_name,
-                partition_key=PartitionKey(path="/id"),
+                partition_key=PartitionKey(path=self.partition_key_path),
+                indexing_policy=FEATURES_INDEXING_POLICY,
                 offer_throughput=400  # Minimum throughput
             )
             
-            print(f"Connected to Cosmos DB: {self.database_name}/{self.container_name}")
+            # An existing container keeps the layout it was created with
+            properties = self.container.read()
+            existing_path = properties["partitionKey"]["paths"][0]
+            if existing_path != self.partition_key_path:
+                print(f"Container {self.container_name} is partitioned by {existing_path}, not {self.partition_key_path}")
+                self.partition_key_path = existing_path
+            
+            # On request, containers created with the default policy are switched over; Cosmos DB
+            # rebuilds the index in the background while the container stays usable
+            if os.getenv("COSMOS_UPDATE_INDEXING_POLICY", "false").lower() == "true":
+                self._update_indexing_policy(properties)
+            
+            print(f"Connected to Cosmos DB: {self.database_name}/{self.container_name} (partition key {self.partition_key_path})")
         except exceptions.CosmosHttpResponseError as e:
             print(f"Failed to connect to Cosmos DB: {str(e)}")
             self.client = None
             self.database = None
             self.container = None
     
+    def _update_indexing_policy(self, properties: Dict[str, Any]) -> None:
+        """
+        Replace the container's indexing policy with FEATURES_INDEXING_POLICY if it differs.
+        
+        Args:
+            properties: Current container properties
+        """
+        def paths(policy: Dict[str, Any], key: str) -> set:
+            return {entry["path"] for entry in policy.get(key, [])}
+        
+        current = properties.get("indexingPolicy", {})
+        if (paths(current, "includedPaths") == paths(FEATURES_INDEXING_POLICY, "includedPaths") and
+                paths(current, "excludedPaths") == paths(FEATURES_INDEXING_POLICY, "excludedPaths")):
+            return
+        
+        print(f"Updating the indexing policy of container {self.container_name}: "
+              f"included paths {sorted(paths(current, 'includedPaths'))} -> "
+              f"{sorted(paths(FEATURES_INDEXING_POLICY, 'includedPaths'))}, "
+              f"excluded paths {sorted(paths(current, 'excludedPaths'))} -> "
+              f"{sorted(paths(FEATURES_INDEXING_POLICY, 'excludedPaths'))}")
+        try:
+            self.container = self.database.replace_container(
+                self.container,
+                partition_key=PartitionKey(path=self.partition_key_path),
+                indexing_policy=FEATURES_INDEXING_POLICY,
+                default_ttl=properties.get("defaultTtl")
+            )
+            print(f"Updated the indexing policy of container {self.container_name}; Cosmos DB rebuilds the index in the background")
+        except exceptions.CosmosHttpResponseError as e:
+            print(f"Failed to update the indexing policy of container {self.container_name}: {str(e)}")
+    
+    @staticmethod
+    def enrollment_id(person_id: str, image_id: str, profile: str) -> str:
+        """
+        Get the deterministic document ID of an enrollment.
+        
+        Enrolling the same image of a person with the same profile again (e.g. a
+        redelivered message) maps to the same document.
+        
+        Args:
+            person_id: Person identifier
+            image_id: Image identifier or blob path
+            profile: Extraction profile name
+            
+        Returns:
+            UUID string derived from the arguments
+        """
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"retina-enrollment:{person_id}:{image_id}:{profile}"))
+    
+    def get_container(self, container_name: str, default_ttl: Optional[int] = None):
+        """
+        Get or create another container in the database, partitioned by /id.
+        
+        Args:
+            container_name: Name of the container
+            default_ttl: Optional time to live of the container's items in seconds
+            
+        Returns:
+            The container proxy
+        """
+        if self.database is None:
+            raise ConnectionError("Not connected to Cosmos DB")
+        
+        return self.database.create_container_if_not_exists(
+            id=container_name,
+            partition_key=PartitionKey(path="/id"),
+            default_ttl=default_ttl
+        )
+    
+    @property
+    def partitioned_by_person(self) -> bool:
+        """Whether the features container is partitioned by /person_id."""
+        return self.partition_key_path == "/person_id"
+    
     def is_connected(self) -> bool:
         """
         Check if the client is connected to Cosmos DB.
@@ -63,13 +204,19 @@ class CosmosDBClient:
         """
         return self.container is not None
     
-    def store_features(self, features: Dict[str, Any], person_id: Optional[str] = None) -> Dict[str, Any]:
+    def store_features(self, features: Union[FeatureSet, Dict[str, Any]], person_id: Optional[str] = None,
+                       item_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Store retina features in Cosmos DB.
         
+        The write goes through the client's request unit limiter, so it waits
+        for the RU budget and is retried when Cosmos DB throttles it.
+        
         Args:
-            features: Dictionary of retina features
+            features: FeatureSet or dictionary of retina features
             person_id: Optional person identifier
+            item_id: Optional deterministic document ID; the item is upserted, so
+                storing the same ID again replaces the document instead of duplicating it
             
         Returns:
             The stored item with Cosmos DB metadata
@@ -78,104 +225,297 @@ class CosmosDBClient:
             raise ConnectionError("Not connected to Cosmos DB")
         
         # Create a copy of the features to avoid modifying the original
-        item = features.copy()
+        item = features.to_document() if isinstance(features, FeatureSet) else features.copy()
         
         # Add required fields for Cosmos DB
-        item["id"] = str(uuid.uuid4())
+        item["id"] = item_id or str(uuid.uuid4())
         
         if person_id:
             item["person_id"] = person_id
+        if self.partitioned_by_person and not item.get("person_id"):
+            raise ValueError("A person ID is required to store features in a container partitioned by /person_id")
         
         # Store the item
         try:
-            result = self.container.create_item(body=item)
+            if item_id:
+                result = self.limiter.execute(self.container.upsert_item, body=item)
+            else:
+                result = self.limiter.execute(self.container.create_item, body=item)
             print(f"Stored features in Cosmos DB with ID: {result['id']}")
             return result
         except exceptions.CosmosHttpResponseError as e:
             print(f"Failed to store features in Cosmos DB: {str(e)}")
             raise
     
-    def get_features(self, item_id: str) -> Dict[str, Any]:
+    def get_features(self, item_id: str, person_id: Optional[str] = None) -> FeatureSet:
         """
         Get retina features from Cosmos DB by ID.
         
         Args:
             item_id: ID of the item to retrieve
+            person_id: Person the item belongs to; with the /person_id layout it allows a
+                point read, otherwise (or if it is not found there) the item is looked up
+                with a cross-partition query
             
         Returns:
-            The retrieved item
+            FeatureSet of the retrieved item
         """
         if not self.is_connected():
             raise ConnectionError("Not connected to Cosmos DB")
         
         try:
-            result = self.container.read_item(item=item_id, partition_key=item_id)
-            return result
-        except exceptions.CosmosResourceNotFoundError:
-            raise ValueError(f"Item with ID {item_id} not found")
+            if person_id or not self.partitioned_by_person:
+                try:
+                    return FeatureSet.from_document(
+                        self.container.read_item(item=item_id, partition_key=self._partition_key(item_id, person_id))
+                    )
+                except exceptions.CosmosResourceNotFoundError:
+                    if not self.partitioned_by_person:
+                        raise ValueError(f"Item with ID {item_id} not found")
+                    # The item may have been stored under another person ID
+            
+            items = list(self.container.query_items(
+                query="SELECT * FROM c WHERE c.id = @id",
+                parameters=[{"name": "@id", "value": item_id}],
+                enable_cross_partition_query=True
+            ))
+            if not items:
+                raise ValueError(f"Item with ID {item_id} not found")
+            return FeatureSet.from_document(items[0])
         except exceptions.CosmosHttpResponseError as e:
             print(f"Failed to get features from Cosmos DB: {str(e)}")
             raise
     
-    def get_features_by_person_id(self, person_id: str) -> List[Dict[str, Any]]:
+    def _partition_key(self, item_id: str, person_id: Optional[str]) -> str:
+        """Get the partition key value of an item in the container's layout."""
+        return person_id if self.partitioned_by_person else item_id
+    
+    def count_features(self) -> int:
         """
-        Get all retina features for a specific person.
+        Count the items in the container.
+        
+        Returns:
+            Number of items
+        """
+        if not self.is_connected():
+            raise ConnectionError("Not connected to Cosmos DB")
+        
+        try:
+            return next(iter(self.container.query_items(
+                query="SELECT VALUE COUNT(1) FROM c",
+                enable_cross_partition_query=True
+            )))
+        except exceptions.CosmosHttpResponseError as e:
+            print(f"Failed to count features in Cosmos DB: {str(e)}")
+            raise
+    
+    def get_features_many(self, item_ids: List[str], chunk_size: int = 100) -> Dict[str, FeatureSet]:
+        """
+        Get several retina feature documents by ID with as few queries as possible.
         
         Args:
-            person_id: Person identifier
+            item_ids: IDs of the items to retrieve
+            chunk_size: Maximum number of IDs per query
             
         Returns:
-            List of items for the person
+            Dictionary mapping IDs to FeatureSets of the items; IDs that were not found are missing
         """
         if not self.is_connected():
             raise ConnectionError("Not connected to Cosmos DB")
         
-        query = f"SELECT * FROM c WHERE c.person_id = @person_id"
-        parameters = [{"name": "@person_id", "value": person_id}]
+        unique_ids = list(dict.fromkeys(item_ids))
+        items = {}
         
         try:
-            items = list(self.container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+            for start in range(0, len(unique_ids), chunk_size):
+                chunk = unique_ids[start:start + chunk_size]
+                for item in self.container.query_items(
+                    query="SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)",
+                    parameters=[{"name": "@ids", "value": chunk}],
+                    enable_cross_partition_query=True
+                ):
+                    items[item["id"]] = FeatureSet.from_document(item)
             return items
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Failed to query features from Cosmos DB: {str(e)}")
+            print(f"Failed to get features from Cosmos DB: {str(e)}")
             raise
     
-    def list_all_features(self) -> List[Dict[str, Any]]:
+    def store_features_many(self, entries: List[Tuple[Dict[str, Any], Optional[str], Optional[str]]]) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        Store several retina feature sets in Cosmos DB.
+        
+        The items are written concurrently, as many at once as the request unit
+        limiter allows. A failed item does not stop the others; its exception is
+        returned in its place. Transactional batches would need one partition per
+        batch and an SDK version supporting them, so every item is its own write.
+        
+        Args:
+            entries: List of (features, person_id, item_id) tuples; item_id may be None (see store_features)
+            
+        Returns:
+            List aligned with entries holding the stored item or the exception raised for it
+        """
+        if not self.is_connected():
+            raise ConnectionError("Not connected to Cosmos DB")
+        
+        start_time = time.perf_counter()
+        results = self.limiter.map(lambda entry: self.store_features(*entry), entries)
+        elapsed = time.perf_counter() - start_time
+        
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        with self._bulk_lock:
+            self.bulk_stats["batches"] += 1
+            self.bulk_stats["items"] += len(results)
+            self.bulk_stats["stored"] += len(results) - failed
+            self.bulk_stats["failed"] += failed
+            self.bulk_stats["last_batch"] = {
+                "items": len(results),
+                "failed": failed,
+                "seconds": round(elapsed, 3),
+                "items_per_second": round(len(results) / elapsed, 1) if elapsed > 0 else None
+            }
+        print(f"Stored {len(results) - failed}/{len(results)} feature sets in {elapsed:.2f}s")
+        return results
+    
+    def write_stats(self) -> Dict[str, Any]:
+        """
+        Get write throughput statistics.
+        
+        Returns:
+            Dictionary with the request unit limiter's statistics and the bulk write counters,
+            including the duration and items per second of the last bulk write
+        """
+        with self._bulk_lock:
+            bulk = {**self.bulk_stats}
+        return {**self.limiter.stats(), "bulk": bulk}
+    
+    def get_features_by_person_id(self, person_id: str, fields: Optional[List[str]] = None) -> List[FeatureSet]:
+        """
+        Get all retina features for a specific person.
+        
+        With the /person_id layout this reads a single partition instead of all of them.
+        
+        Args:
+            person_id: Person identifier
+            fields: Optional fields to return (see iter_features)
+            
+        Returns:
+            List of FeatureSets of the person's items
+        """
+        return [FeatureSet.from_document(document) for document in self.iter_features(
+            where="c.person_id = @person_id",
+            parameters=[{"name": "@person_id", "value": person_id}],
+            fields=fields,
+            partition_key=person_id if self.partitioned_by_person else None
+        )]
+    
+    def list_all_features(self, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """
         List all retina features in the container.
         
+        Loads every item at once; use iter_features to go through the
+        container in constant memory.
+        
+        Args:
+            fields: Optional fields to return (see iter_features)
+            
         Returns:
             List of all items
         """
+        return list(self.iter_features(fields=fields))
+    
+    def iter_features(self, where: Optional[str] = None, parameters: Optional[List[Dict[str, Any]]] = None,
+                      fields: Optional[List[str]] = None, page_size: Optional[int] = None,
+                      continuation: Optional[str] = None, partition_key: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over retina features page by page.
+        
+        Only one page is held in memory at a time. See iter_feature_pages for the arguments.
+        
+        Yields:
+            Items in ID order
+        """
+        for items, _ in self.iter_feature_pages(where, parameters, fields, page_size, continuation, partition_key):
+            yield from items
+    
+    def iter_feature_pages(self, where: Optional[str] = None, parameters: Optional[List[Dict[str, Any]]] = None,
+                           fields: Optional[List[str]] = None, page_size: Optional[int] = None,
+                           continuation: Optional[str] = None,
+                           partition_key: Optional[str] = None) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Iterate over pages of retina features with resumable continuation tokens.
+        
+        Pages are read in ID order, each with its own query starting after the
+        last ID of the previous page. Unlike the SDK's continuation headers,
+        which are not usable across partitions, the token therefore stays valid
+        across processes and restarts.
+        
+        Args:
+            where: Optional filter condition on the item alias c (e.g. "c.person_id = @person_id")
+            parameters: Parameters of the filter condition
+            fields: Optional fields to return instead of whole documents; "id" is always included
+            page_size: Items per page (defaults to the COSMOS_PAGE_SIZE environment variable, then 100)
+            continuation: Token of a previous page to resume after
+            partition_key: Optional partition key value restricting the query to one partition
+            
+        Yields:
+            Tuples of (items, continuation token resuming after this page, or None after the last page)
+            
+        Raises:
+            ValueError: If a field name is not a plain identifier
+        """
         if not self.is_connected():
             raise ConnectionError("Not connected to Cosmos DB")
         
-        try:
-            items = list(self.container.query_items(
-                query="SELECT * FROM c",
-                enable_cross_partition_query=True
-            ))
-            return items
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Failed to list features from Cosmos DB: {str(e)}")
-            raise
+        page_size = page_size or int(os.getenv("COSMOS_PAGE_SIZE", "100"))
+        if fields:
+            invalid = [field for field in fields if not FIELD_NAME_PATTERN.match(field)]
+            if invalid:
+                raise ValueError(f"Invalid field names: {', '.join(invalid)}")
+            projection = ", ".join(f"c.{field}" for field in dict.fromkeys(["id"] + list(fields)))
+        else:
+            projection = "*"
+        
+        conditions = ["c.id > @after"] + ([f"({where})"] if where else [])
+        query = f"SELECT TOP @limit {projection} FROM c WHERE {' AND '.join(conditions)} ORDER BY c.id"
+        after = continuation or ""
+        
+        while True:
+            try:
+                items = list(self.container.query_items(
+                    query=query,
+                    parameters=[{"name": "@limit", "value": page_size}, {"name": "@after", "value": after}] +
+                               (parameters or []),
+                    enable_cross_partition_query=partition_key is None,
+                    partition_key=partition_key,
+                    max_item_count=page_size
+                ))
+            except exceptions.CosmosHttpResponseError as e:
+                print(f"Failed to query features from Cosmos DB: {str(e)}")
+                raise
+            
+            if len(items) < page_size:
+                yield items, None
+                return
+            after = items[-1]["id"]
+            yield items, after
     
-    def delete_features(self, item_id: str) -> None:
+    def delete_features(self, item_id: str, person_id: Optional[str] = None) -> None:
         """
         Delete retina features from Cosmos DB by ID.
         
         Args:
             item_id: ID of the item to delete
+            person_id: Person the item belongs to; required with the /person_id layout
         """
         if not self.is_connected():
             raise ConnectionError("Not connected to Cosmos DB")
+        if self.partitioned_by_person and not person_id:
+            raise ValueError("A person ID is required to delete features from a container partitioned by /person_id")
         
         try:
-            self.container.delete_item(item=item_id, partition_key=item_id)
+            self.limiter.execute(self.container.delete_item, item=item_id,
+                                 partition_key=self._partition_key(item_id, person_id))
             print(f"Deleted features with ID: {item_id}")
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError(f"Item with ID {item_id} not found")
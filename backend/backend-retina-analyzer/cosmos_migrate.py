@@ -0,0 +1,123 @@
+"""
+Copy retina feature documents between Cosmos DB containers, e.g. from the /id
+layout to a container partitioned by /person_id.
+
+The source stays in use while copying. Documents are upserted, so the copy
+can be resumed from its last printed continuation or re-run to pick up
+documents changed in the meantime, before switching COSMOS_CONTAINER.
+
+Usage:
+    python cosmos_migrate.py --source retina_features --target retina_features_by_person \
+        --target-partition-key /person_id --workers 8 --max-ru 1000
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from azure.cosmos import exceptions
+from cosmos_db import CosmosDBClient
+from ru_limiter import RequestUnitLimiter
+
+# System properties Cosmos DB adds to every document
+SYSTEM_FIELDS = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+
+def copy_document(target: CosmosDBClient, document: Dict[str, Any], limiter: RequestUnitLimiter) -> None:
+    """
+    Upsert one document into the target container.
+
+    Args:
+        target: Client of the target container
+        document: Source document
+        limiter: Shared request unit limiter
+    """
+    item = {key: value for key, value in document.items() if key not in SYSTEM_FIELDS}
+    limiter.execute(target.container.upsert_item, body=item)
+
+
+def migrate(source: CosmosDBClient, target: CosmosDBClient, workers: int = 8, max_ru: float = 0,
+            page_size: int = 100, continuation: Optional[str] = None) -> Dict[str, int]:
+    """
+    Copy all documents of the source container into the target container.
+
+    Args:
+        source: Client of the source container
+        target: Client of the target container
+        workers: Number of concurrent upserts
+        max_ru: Request units per second the upserts may consume (0 for no limit)
+        page_size: Documents read per page
+        continuation: Continuation printed by an interrupted run, to resume after
+
+    Returns:
+        Dictionary with the numbers of copied, skipped and failed documents and of throttled requests
+    """
+    limiter = RequestUnitLimiter(max_ru, concurrency=workers)
+    stats = {"copied": 0, "skipped": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for documents, token in source.iter_feature_pages(page_size=page_size, continuation=continuation):
+            copyable = []
+            for document in documents:
+                if target.partitioned_by_person and not document.get("person_id"):
+                    print(f"Skipping document {document['id']} without person_id")
+                    stats["skipped"] += 1
+                else:
+                    copyable.append(document)
+
+            futures = [pool.submit(copy_document, target, document, limiter) for document in copyable]
+            for document, future in zip(copyable, futures):
+                try:
+                    future.result()
+                    stats["copied"] += 1
+                except exceptions.CosmosHttpResponseError as e:
+                    print(f"Failed to copy document {document['id']}: {str(e)}")
+                    stats["failed"] += 1
+
+            limiter_stats = limiter.stats()
+            print(f"Copied {stats['copied']} documents ({limiter_stats['achieved_ru_per_second']} RU/s, "
+                  f"{limiter_stats['throttles']} throttled), continuation: {token}")
+
+    stats["throttled"] = limiter.throttles
+    return stats
+
+
+def main():
+    """Main function of the migration command line."""
+    parser = argparse.ArgumentParser(description="Copy retina feature documents between Cosmos DB containers")
+    parser.add_argument("--source", required=True, help="Source container")
+    parser.add_argument("--target", required=True, help="Target container, created if it does not exist")
+    parser.add_argument("--target-partition-key", default="/person_id", help="Partition key of a new target container")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent upserts")
+    parser.add_argument("--max-ru", type=float, default=0, help="Request units per second for the upserts (0: no limit)")
+    parser.add_argument("--page-size", type=int, default=100, help="Documents read per page")
+    parser.add_argument("--continuation", default=None, help="Resume after the continuation printed by a previous run")
+    parser.add_argument("--verify-only", action="store_true", help="Only compare the document counts")
+    args = parser.parse_args()
+
+    source = CosmosDBClient(container_name=args.source)
+    target = CosmosDBClient(container_name=args.target, partition_key_path=args.target_partition_key)
+    if not source.is_connected() or not target.is_connected():
+        print("Error: Not connected to Cosmos DB. Check your connection settings.")
+        return 1
+
+    skipped = 0
+    if not args.verify_only:
+        start_time = time.perf_counter()
+        stats = migrate(source, target, args.workers, args.max_ru, args.page_size, args.continuation)
+        skipped = stats["skipped"]
+        print(f"Migration finished in {time.perf_counter() - start_time:.1f} s: {stats['copied']} copied, "
+              f"{stats['skipped']} skipped, {stats['failed']} failed, {stats['throttled']} throttled requests")
+
+    # Documents written to the source meanwhile make the counts differ until the copy is re-run
+    source_count = source.count_features()
+    target_count = target.count_features()
+    print(f"Source {args.source}: {source_count} documents, target {args.target}: {target_count} documents")
+    if target_count + skipped < source_count:
+        print("Verification failed: the target is missing documents")
+        return 1
+    print("Verification passed")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,199 @@
+"""
+Named feature extraction profiles bundling the retina processor's size and detail parameters.
+"""
+import os
+import numpy as np
+from typing import Any, Dict, Optional, Tuple
+
+# Version of the feature extraction algorithm; bump the major version when
+# templates extracted by older versions can no longer be compared.
+EXTRACTOR_VERSION = "1.1"
+
+# Profile assumed for templates stored before profiles were introduced
+LEGACY_PROFILE = "standard"
+LEGACY_EXTRACTOR_VERSION = "1.0"
+
+
+class ProfileMismatchError(ValueError):
+    """Raised when two feature sets were extracted with incompatible profiles."""
+
+
+class ExtractionProfile:
+    """
+    Named set of feature extraction parameters.
+
+    Profiles with the same compatibility key extract vectors of the same
+    layout, so their templates can be compared once pixel measurements are
+    rescaled to one resolution (see convert_features). Profiles with other
+    grids, HOG layouts or field-of-view handling extract different vectors,
+    so their templates cannot.
+    """
+    def __init__(self, name: str, standard_size: Tuple[int, int], grid_size: Tuple[int, int] = (8, 8),
+                 hog_cells: Tuple[int, int] = (8, 8), hog_orientations: int = 6,
+                 max_bifurcation_points: int = 50, max_compare_points: int = 30,
+                 bifurcation_distance_threshold: int = 10, fov_crop: bool = False):
+        """
+        Initialize an extraction profile.
+
+        Args:
+            name: Profile name stored with every template
+            standard_size: (width, height) images are resized to before processing
+            grid_size: Grid size for spatial vessel distribution analysis
+            hog_cells: Number of HOG cells per (row, column); the cell size follows from standard_size
+            hog_orientations: Number of HOG orientation bins
+            max_bifurcation_points: Maximum number of bifurcation points detected
+            max_compare_points: Maximum number of bifurcation points used in comparisons
+            bifurcation_distance_threshold: Max distance in pixels for matching bifurcation points
+            fov_crop: Crop to the retina's field of view and mask the background
+        """
+        self.name = name
+        self.standard_size = standard_size
+        self.grid_size = grid_size
+        self.hog_cells = hog_cells
+        self.hog_orientations = hog_orientations
+        self.max_bifurcation_points = max_bifurcation_points
+        self.max_compare_points = max_compare_points
+        self.bifurcation_distance_threshold = bifurcation_distance_threshold
+        self.fov_crop = fov_crop
+
+    @property
+    def hog_pixels_per_cell(self) -> Tuple[int, int]:
+        """HOG cell size in pixels (rows, columns)."""
+        width, height = self.standard_size
+        return (height // self.hog_cells[0], width // self.hog_cells[1])
+
+    def compatibility_key(self) -> Tuple[Any, ...]:
+        """
+        Get the key identifying the feature layout of this profile.
+
+        Returns:
+            Tuple that is equal for profiles whose templates can be compared
+        """
+        return (self.grid_size, self.hog_cells, self.hog_orientations, self.fov_crop)
+
+    def is_compatible(self, other: "ExtractionProfile") -> bool:
+        """
+        Check whether templates of this and another profile can be compared.
+
+        Args:
+            other: Other extraction profile
+
+        Returns:
+            True if both profiles extract vectors of the same layout
+        """
+        return self.compatibility_key() == other.compatibility_key()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert the profile to a dictionary.
+
+        Returns:
+            Dictionary of profile parameters
+        """
+        return {
+            "name": self.name,
+            "standard_size": list(self.standard_size),
+            "grid_size": list(self.grid_size),
+            "hog_cells": list(self.hog_cells),
+            "hog_orientations": self.hog_orientations,
+            "max_bifurcation_points": self.max_bifurcation_points,
+            "max_compare_points": self.max_compare_points,
+            "bifurcation_distance_threshold": self.bifurcation_distance_threshold,
+            "fov_crop": self.fov_crop
+        }
+
+
+PROFILES: Dict[str, ExtractionProfile] = {
+    # Half resolution for latency-critical validations; comparable with "standard"
+    "fast": ExtractionProfile(
+        "fast", standard_size=(128, 128), max_bifurcation_points=30, max_compare_points=20,
+        bifurcation_distance_threshold=5
+    ),
+    # The original parameters; templates without a profile tag were extracted with it
+    "standard": ExtractionProfile("standard", standard_size=(256, 256)),
+    # Full resolution, finer grids and field-of-view cropping; only comparable with itself
+    "high_accuracy": ExtractionProfile(
+        "high_accuracy", standard_size=(512, 512), grid_size=(16, 16), hog_cells=(16, 16),
+        hog_orientations=8, max_bifurcation_points=100, max_compare_points=60,
+        bifurcation_distance_threshold=20, fov_crop=True
+    )
+}
+
+
+def get_profile(name: Optional[str] = None) -> ExtractionProfile:
+    """
+    Get an extraction profile by name.
+
+    Args:
+        name: Profile name (defaults to the RETINA_PROFILE environment variable, then "standard")
+
+    Returns:
+        The extraction profile
+    """
+    name = name or os.getenv("RETINA_PROFILE", LEGACY_PROFILE)
+    if name not in PROFILES:
+        raise ValueError(f"Unknown extraction profile: {name}. Available profiles: {', '.join(PROFILES)}")
+    return PROFILES[name]
+
+
+def get_template_profile(features: Dict[str, Any]) -> Tuple[ExtractionProfile, str]:
+    """
+    Get the profile and extractor version a template was extracted with.
+
+    Args:
+        features: Dictionary of retina features
+
+    Returns:
+        Tuple of (profile, extractor version)
+    """
+    profile = get_profile(features.get("profile") or LEGACY_PROFILE)
+    return profile, features.get("extractor_version") or LEGACY_EXTRACTOR_VERSION
+
+
+def convert_features(features: Dict[str, Any], source: ExtractionProfile, target: ExtractionProfile) -> Dict[str, Any]:
+    """
+    Convert a template to another compatible profile.
+
+    Compatible profiles extract vectors of the same layout; only pixel
+    measurements (bifurcation points, vessel length and width, optic disc)
+    depend on the resolution, so they are rescaled to the target's
+    standard_size. Bifurcation points beyond the target's maximum are dropped,
+    and the target profile's matching parameters then apply.
+
+    Args:
+        features: Dictionary of retina features extracted with the source profile
+        source: Profile the features were extracted with
+        target: Profile to convert to
+
+    Returns:
+        Converted copy of the features
+
+    Raises:
+        ProfileMismatchError: If the profiles extract different features
+    """
+    if not source.is_compatible(target):
+        raise ProfileMismatchError(
+            f"Features of profile '{source.name}' cannot be compared with profile '{target.name}'"
+        )
+
+    converted = features.copy()
+    converted["profile"] = target.name
+    if source.standard_size == target.standard_size:
+        return converted
+
+    scale_x = target.standard_size[0] / source.standard_size[0]
+    scale_y = target.standard_size[1] / source.standard_size[1]
+    points = np.asarray(features.get("bifurcation_points", []), dtype=np.float64).reshape(-1, 2)
+    converted["bifurcation_points"] = np.rint(
+        points[:target.max_bifurcation_points] * (scale_x, scale_y)
+    ).astype(np.int64)
+    # Vessel regions are elongated, so their axes scale with the image
+    for key in ("avg_vessel_length", "avg_vessel_width"):
+        if key in features:
+            converted[key] = float(features[key]) * (scale_x + scale_y) / 2
+    if features.get("optic_disc_center") is not None:
+        x, y = features["optic_disc_center"]
+        converted["optic_disc_center"] = (int(round(x * scale_x)), int(round(y * scale_y)))
+    if features.get("optic_disc_radius") is not None:
+        converted["optic_disc_radius"] = int(round(features["optic_disc_radius"] * (scale_x + scale_y) / 2))
+    return converted
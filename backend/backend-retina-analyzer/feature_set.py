@@ -0,0 +1,194 @@
+"""
+Typed container of the features extracted from one retina image.
+"""
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, Optional, Union
+import numpy as np
+import orjson
+
+# Vector features, held as float64 arrays (the precision comparisons compute in)
+VECTOR_FIELDS = ("lbp_histogram", "hog_features", "vessel_spatial_distribution")
+
+# Fields of a feature document, in the order they are serialized
+FIELDS = (
+    "id",
+    "lbp_histogram",
+    "hog_features",
+    "blood_vessel_density",
+    "avg_vessel_length",
+    "avg_vessel_width",
+    "vessel_count",
+    "optic_disc_center",
+    "optic_disc_radius",
+    "optic_disc_confidence",
+    "bifurcation_points",
+    "vessel_spatial_distribution",
+    "profile",
+    "extractor_version",
+    "timestamp"
+)
+
+_FIELD_SET = frozenset(FIELDS)
+
+# orjson writes numpy arrays and scalars itself; tuples become lists
+_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(obj: Any) -> Any:
+    """Convert values orjson cannot serialize natively (feature sets, float16 or non-contiguous arrays)."""
+    if isinstance(obj, FeatureSet):
+        return dict(obj.items())
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class FeatureSet(MutableMapping):
+    """
+    Features of one retina image.
+
+    The vector features and bifurcation points are numpy arrays, so they are
+    converted once when a feature set is created instead of on every
+    comparison, and serialized by orjson without walking Python lists. Any
+    other document fields (person_id, Cosmos DB metadata, ...) are kept as
+    they are. Feature sets behave like the dictionaries they replace:
+    features["hog_features"], get, keys, items, copy and update all work.
+    """
+    __slots__ = FIELDS + ("_extra",)
+
+    def __init__(self, fields: Optional[Mapping] = None, **kwargs):
+        """
+        Initialize a feature set.
+
+        Args:
+            fields: Optional mapping of feature fields
+            **kwargs: Further feature fields
+        """
+        self._extra: Dict[str, Any] = {}
+        if fields is not None:
+            self.update(fields)
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def from_document(cls, document: Union[Mapping, bytes, str]) -> "FeatureSet":
+        """
+        Create a feature set from a feature document.
+
+        Args:
+            document: Document dictionary (e.g. read from Cosmos DB) or its JSON encoding
+
+        Returns:
+            The feature set
+        """
+        if isinstance(document, (bytes, bytearray, memoryview, str)):
+            document = orjson.loads(document)
+        return cls(document)
+
+    def to_json(self) -> bytes:
+        """
+        Serialize the feature set.
+
+        Returns:
+            UTF-8 JSON encoding of the feature document
+        """
+        return dumps(dict(self.items()))
+
+    def to_document(self) -> Dict[str, Any]:
+        """
+        Convert the feature set to a document of JSON types, e.g. to store it in Cosmos DB.
+
+        Returns:
+            Dictionary with lists in place of the arrays
+        """
+        # orjson's round trip is much faster than converting the arrays element by element
+        return orjson.loads(self.to_json())
+
+    def copy(self) -> "FeatureSet":
+        """
+        Get a shallow copy; the arrays are shared like a dictionary copy shares its lists.
+
+        Returns:
+            The copy
+        """
+        copied = FeatureSet.__new__(FeatureSet)
+        for field in FIELDS:
+            if hasattr(self, field):
+                object.__setattr__(copied, field, getattr(self, field))
+        copied._extra = dict(self._extra)
+        return copied
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self._extra[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _FIELD_SET:
+            if key in VECTOR_FIELDS and value is not None:
+                # Copied, as extraction results may live in reused buffers
+                value = np.array(value, dtype=np.float64).ravel()
+            elif key == "bifurcation_points" and value is not None:
+                value = np.array(value, dtype=np.int64).reshape(-1, 2)
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key: object) -> bool:
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return key in self._extra
+
+    def __iter__(self) -> Iterator[str]:
+        for field in FIELDS:
+            if hasattr(self, field):
+                yield field
+        yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for field in FIELDS if hasattr(self, field)) + len(self._extra)
+
+    def __repr__(self) -> str:
+        return f"FeatureSet(id={self.get('id')!r}, profile={self.get('profile')!r})"
+
+
+def as_feature_set(features: Union[Mapping, bytes, str]) -> FeatureSet:
+    """
+    Get a feature set for features that may still be a plain document.
+
+    Args:
+        features: FeatureSet, feature document or its JSON encoding
+
+    Returns:
+        The features as a FeatureSet (the argument itself if it already is one)
+    """
+    if isinstance(features, FeatureSet):
+        return features
+    return FeatureSet.from_document(features)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize a document or message that may contain feature sets and numpy values.
+
+    Args:
+        obj: Object to serialize
+
+    Returns:
+        UTF-8 JSON encoding of the object
+    """
+    return orjson.dumps(obj, default=_default, option=_JSON_OPTIONS)
@@ -0,0 +1,320 @@
+"""
+Memory-mapped snapshot files of the template gallery.
+
+A snapshot is one file: an 8-byte magic, a little-endian uint32 format
+version and uint32 header length, a JSON header describing the gallery and
+the position of every column, and the columns themselves, each aligned to
+64 bytes. Workers open it with np.memmap, so all processes of a host share
+one copy of the templates through the OS page cache.
+
+Build a snapshot from Cosmos DB with:
+    python gallery_snapshot.py build --output gallery.snapshot
+"""
+import argparse
+import calendar
+import json
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+from dotenv import load_dotenv
+from extraction_profiles import EXTRACTOR_VERSION, get_profile
+from template_gallery import TEMPLATE_FIELDS, TemplateGallery, TemplateIndex
+
+# Load environment variables from .env file
+load_dotenv()
+
+SNAPSHOT_MAGIC = b"RTNGALRY"
+SNAPSHOT_FORMAT_VERSION = 3
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 64
+CREATED_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class SnapshotFormatError(ValueError):
+    """Raised when a file is not a readable gallery snapshot."""
+
+
+class SnapshotIndex(TemplateIndex):
+    """
+    Template index backed by the snapshot's ID columns.
+
+    Lookups binary-search the memory-mapped sorted IDs instead of building a
+    dictionary, so opening a snapshot costs no per-template work or memory.
+    Templates added or removed after opening are tracked in memory.
+    """
+    def __init__(self, row_ids: np.ndarray, sorted_ids: np.ndarray, sorted_rows: np.ndarray):
+        """
+        Initialize the index.
+
+        Args:
+            row_ids: Fixed-width byte string ID of each stored row
+            sorted_ids: The same IDs, sorted
+            sorted_rows: Row of each sorted ID
+        """
+        super().__init__()
+        self.row_ids = row_ids
+        self.sorted_ids = sorted_ids
+        self.sorted_rows = sorted_rows
+        self._removed = set()
+
+    def __len__(self) -> int:
+        """Number of indexed templates."""
+        return len(self.row_ids) - len(self._removed) + len(self._rows)
+
+    def get(self, template_id: str) -> Optional[int]:
+        """Get the row of a template, or None if it is not indexed."""
+        row = self._rows.get(template_id)
+        if row is not None or template_id in self._removed:
+            return row
+        return self._find(template_id)
+
+    def remove(self, template_id: str) -> Optional[int]:
+        """Remove a template and return its former row, or None if it was not indexed."""
+        if template_id in self._rows:
+            return super().remove(template_id)
+        row = self.get(template_id)
+        if row is not None:
+            self._removed.add(template_id)
+        return row
+
+    def id_at(self, row: int) -> Optional[str]:
+        """Get the ID of the template stored in a row, or None if the row was removed."""
+        if row >= len(self.row_ids):
+            return super().id_at(row)
+        template_id = self.row_ids[row].decode("utf-8")
+        return None if template_id in self._removed else template_id
+
+    def removed_ids(self) -> List[str]:
+        """Get the IDs of stored templates removed (or replaced by overlay templates) since opening."""
+        return sorted(self._removed)
+
+    def _find(self, template_id: str) -> Optional[int]:
+        """Binary-search the stored IDs."""
+        key = template_id.encode("utf-8")
+        if len(key) > self.sorted_ids.dtype.itemsize:
+            return None
+        position = int(np.searchsorted(self.sorted_ids, key))
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == key:
+            return int(self.sorted_rows[position])
+        return None
+
+
+def write_snapshot(gallery: TemplateGallery, path: str, continuation: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Write a gallery to a snapshot file.
+
+    The file is written under a temporary name and renamed into place, so
+    workers opening the path always see a complete snapshot.
+
+    Args:
+        gallery: Gallery to write
+        path: Snapshot file path
+        continuation: Optional change feed continuation the gallery is up to date with
+
+    Returns:
+        The snapshot header
+    """
+    ids, columns = gallery.to_columns()
+    encoded_ids = np.array([template_id.encode("utf-8") for template_id in ids], dtype=np.bytes_)
+    if not len(encoded_ids):
+        encoded_ids = encoded_ids.astype("S1")
+    order = np.argsort(encoded_ids, kind="stable")
+    columns["row_ids"] = encoded_ids
+    columns["sorted_ids"] = encoded_ids[order]
+    columns["sorted_rows"] = order.astype(np.int64)
+
+    header = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "profile": gallery.profile.name,
+        "extractor_version": EXTRACTOR_VERSION,
+        "dtype": gallery.dtype,
+        "count": len(ids),
+        "created": time.strftime(CREATED_FORMAT, time.gmtime()),
+        "continuation": continuation,
+        "columns": {}
+    }
+
+    # Column offsets depend on the header length, so lay the columns out after a header of fixed size
+    def layout(header_size: int) -> int:
+        offset = _align(PREAMBLE.size + header_size)
+        for name, array in columns.items():
+            header["columns"][name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset = _align(offset + array.nbytes)
+        return offset
+
+    header_size = 0
+    while True:
+        layout(header_size)
+        encoded_header = json.dumps(header).encode("utf-8")
+        if len(encoded_header) <= header_size:
+            break
+        header_size = len(encoded_header) + 256
+    encoded_header = encoded_header.ljust(header_size, b" ")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, header_size))
+            file.write(encoded_header)
+            for name, array in columns.items():
+                file.seek(header["columns"][name]["offset"])
+                file.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return header
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """
+    Read and check the header of a snapshot file.
+
+    Args:
+        path: Snapshot file path
+
+    Returns:
+        The snapshot header
+
+    Raises:
+        SnapshotFormatError: If the file is not a snapshot or has an unsupported format or extractor version
+    """
+    with open(path, "rb") as file:
+        preamble = file.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            raise SnapshotFormatError(f"{path} is not a gallery snapshot")
+        magic, format_version, header_size = PREAMBLE.unpack(preamble)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotFormatError(f"{path} is not a gallery snapshot")
+        if format_version != SNAPSHOT_FORMAT_VERSION:
+            raise SnapshotFormatError(
+                f"Unsupported snapshot format version {format_version} (expected {SNAPSHOT_FORMAT_VERSION})"
+            )
+        header = json.loads(file.read(header_size))
+
+    if header["extractor_version"].split(".")[0] != EXTRACTOR_VERSION.split(".")[0]:
+        raise SnapshotFormatError(
+            f"Snapshot templates were extracted with version {header['extractor_version']}, "
+            f"incompatible with {EXTRACTOR_VERSION}"
+        )
+    return header
+
+
+def snapshot_identity(header: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the fields of a snapshot header that tell snapshots apart.
+
+    Args:
+        header: Snapshot header
+
+    Returns:
+        Dictionary with the snapshot's creation time, change feed continuation, profile and template count
+    """
+    return {key: header.get(key) for key in ("created", "continuation", "profile", "count")}
+
+
+def open_snapshot(path: str, processor) -> TemplateGallery:
+    """
+    Open a snapshot file as a memory-mapped gallery.
+
+    Columns are mapped read-only, so their pages are shared between
+    processes; templates added later are kept in the gallery's overlay.
+    The gallery counts as up to date at the snapshot's creation time until
+    a sync catches it up with the change feed.
+
+    Args:
+        path: Snapshot file path
+        processor: RetinaProcessor providing the match threshold and bifurcation point matching
+
+    Returns:
+        The gallery
+
+    Raises:
+        SnapshotFormatError: If the file is not a readable snapshot
+    """
+    header = read_header(path)
+    columns = {}
+    for name, column in header["columns"].items():
+        shape = tuple(column["shape"])
+        if 0 in shape:
+            # Empty arrays cannot be memory-mapped
+            columns[name] = np.zeros(shape, dtype=column["dtype"])
+        else:
+            columns[name] = np.memmap(path, dtype=column["dtype"], mode="r", offset=column["offset"], shape=shape)
+
+    index = SnapshotIndex(columns.pop("row_ids"), columns.pop("sorted_ids"), columns.pop("sorted_rows"))
+    gallery = TemplateGallery.from_columns(processor, get_profile(header["profile"]), header["dtype"], columns, index)
+    gallery.updated = calendar.timegm(time.strptime(header["created"], CREATED_FORMAT))
+    return gallery
+
+
+def _align(offset: int) -> int:
+    """Round an offset up to the column alignment."""
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def build_snapshot(output: str, profile: Optional[str] = None, dtype: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Build a snapshot of all templates stored in Cosmos DB.
+
+    Templates are read in pages with only the fields the gallery uses.
+
+    Args:
+        output: Snapshot file path
+        profile: Gallery profile (defaults to the VALIDATION_PROFILE environment variable, then RETINA_PROFILE)
+        dtype: Vector storage type (defaults to GALLERY_DTYPE)
+
+    Returns:
+        The snapshot header
+    """
+    from cosmos_db import CosmosDBClient
+    from gallery_sync import CosmosChangeFeed
+    from retina_processor import RetinaProcessor
+
+    processor = RetinaProcessor(profile=profile or os.getenv("VALIDATION_PROFILE"))
+    gallery = TemplateGallery(processor, dtype=dtype)
+    cosmos_client = CosmosDBClient()
+    # Taken before listing, so changes made while listing are applied again by the sync
+    continuation = CosmosChangeFeed(cosmos_client.container).current()
+    # Streams projected pages, so only the gallery grows with the number of templates
+    documents = cosmos_client.iter_features(fields=TEMPLATE_FIELDS)
+    added = gallery.add_many((document["id"], document) for document in documents)
+    print(f"Added {added} templates to the gallery")
+    return write_snapshot(gallery, output, continuation)
+
+
+def main():
+    """Main function of the snapshot command line."""
+    parser = argparse.ArgumentParser(description="Build and inspect template gallery snapshots")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build a snapshot of all templates in Cosmos DB")
+    build_parser.add_argument("--output", default=os.getenv("GALLERY_SNAPSHOT", "gallery.snapshot"),
+                              help="Snapshot file path")
+    build_parser.add_argument("--profile", default=None, help="Extraction profile (fast, standard, high_accuracy)")
+    build_parser.add_argument("--dtype", default=None, help="Vector storage type (int8, int4 or float16)")
+
+    info_parser = subparsers.add_parser("info", help="Print the header of a snapshot")
+    info_parser.add_argument("path", help="Snapshot file path")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        header = build_snapshot(args.output, args.profile, args.dtype)
+        size = os.path.getsize(args.output)
+        print(f"Wrote {header['count']} templates ({header['profile']}, {header['dtype']}) "
+              f"to {args.output}: {size / 1024 / 1024:.1f} MiB")
+    else:
+        header = read_header(args.path)
+        columns = header.pop("columns")
+        print(json.dumps(header, indent=2))
+        for name, column in columns.items():
+            print(f"{name}: {column['dtype']} {column['shape']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+Incremental sync of the template gallery with the Cosmos DB change feed.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from azure.cosmos import exceptions
+from dotenv import load_dotenv
+from extraction_profiles import ProfileMismatchError
+from gallery_snapshot import open_snapshot, read_header, snapshot_identity, write_snapshot
+from template_gallery import TemplateGallery
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the sync state is not persisted
+    fcntl = None
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger("GallerySync")
+
+
+class CosmosChangeFeed:
+    """
+    Change feed of a Cosmos DB container.
+
+    The change feed reports the latest version of inserted and updated items
+    but not deletions; deleted templates are found by reconciling with the
+    container's IDs (list_ids), or immediately if they are soft-deleted with
+    a "deleted": true field.
+    """
+    def __init__(self, container, max_item_count: int = 100):
+        """
+        Initialize the change feed.
+
+        Args:
+            container: Container proxy; use one of a dedicated CosmosClient, as the continuation
+                       is read from the client's last response headers
+            max_item_count: Items per change feed page
+        """
+        self.container = container
+        self.max_item_count = max_item_count
+
+    def read(self, continuation: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Read the changes after a continuation.
+
+        Args:
+            continuation: Continuation returned by the previous read, or None to read from the beginning
+
+        Returns:
+            Tuple of (changed items, continuation to read the next changes from)
+        """
+        items = list(self.container.query_items_change_feed(
+            is_start_from_beginning=continuation is None,
+            continuation=continuation,
+            max_item_count=self.max_item_count
+        ))
+        headers = self.container.client_connection.last_response_headers
+        return items, headers.get("etag") or continuation
+
+    def current(self) -> Optional[str]:
+        """
+        Get the continuation of the current end of the feed, skipping all existing changes.
+
+        Returns:
+            Continuation from which only later changes are read
+        """
+        list(self.container.query_items_change_feed(is_start_from_beginning=False, max_item_count=1))
+        return self.container.client_connection.last_response_headers.get("etag")
+
+    def list_ids(self) -> List[str]:
+        """
+        List the IDs of all items in the container.
+
+        Returns:
+            List of item IDs
+        """
+        return list(self.container.query_items(
+            query="SELECT VALUE c.id FROM c",
+            enable_cross_partition_query=True
+        ))
+
+
+class LocalChangeFeed:
+    """
+    In-memory stand-in for a container's change feed, for tests and local runs.
+
+    Like Cosmos DB, it reports the latest version of each item changed after
+    a continuation, and deletions are only visible through list_ids.
+    """
+    def __init__(self):
+        """Initialize an empty feed."""
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._sequence: Dict[str, int] = {}
+        self._lsn = 0
+        self._lock = threading.Lock()
+
+    def upsert(self, item: Dict[str, Any]) -> None:
+        """Insert or replace an item."""
+        with self._lock:
+            self._lsn += 1
+            self._items[item["id"]] = {**item, "_ts": int(time.time()), "_lsn": self._lsn}
+            self._sequence[item["id"]] = self._lsn
+
+    def delete(self, item_id: str) -> None:
+        """Delete an item."""
+        with self._lock:
+            self._items.pop(item_id, None)
+            self._sequence.pop(item_id, None)
+
+    def read(self, continuation: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Read the changes after a continuation (None reads from the beginning)."""
+        with self._lock:
+            after = int(continuation) if continuation else 0
+            changed = sorted((lsn, item_id) for item_id, lsn in self._sequence.items() if lsn > after)
+            return [dict(self._items[item_id]) for _, item_id in changed], str(self._lsn)
+
+    def current(self) -> Optional[str]:
+        """Get the continuation of the current end of the feed."""
+        with self._lock:
+            return str(self._lsn)
+
+    def list_ids(self) -> List[str]:
+        """List the IDs of all items."""
+        with self._lock:
+            return list(self._items)
+
+
+class GallerySync:
+    """
+    Keeps a template gallery up to date from a change feed.
+
+    A background thread polls the feed every poll_interval seconds and applies
+    inserts, updates and soft deletes to the gallery; every reconcile_interval
+    seconds it also removes templates whose documents were deleted.
+
+    For a gallery opened from a snapshot, the changes applied since the
+    snapshot live in its in-memory overlay, so a continuation alone cannot be
+    resumed after a restart. The state file therefore records the snapshot it
+    was written against, the continuation, the IDs removed from the snapshot
+    and an overlay snapshot file holding the templates added since. A process
+    opening the same snapshot restores the overlay and resumes from the saved
+    continuation; with any other snapshot it starts from the snapshot's own
+    continuation. Only one process at a time writes the state file.
+    """
+    def __init__(self, gallery: TemplateGallery, feed, state_path: Optional[str] = None,
+                 continuation: Optional[str] = None, poll_interval: Optional[float] = None,
+                 reconcile_interval: Optional[float] = None, snapshot: Optional[Dict[str, Any]] = None):
+        """
+        Initialize the sync.
+
+        Args:
+            gallery: Gallery to update
+            feed: CosmosChangeFeed or LocalChangeFeed
+            state_path: File the sync state is persisted to (defaults to the GALLERY_SYNC_STATE
+                        environment variable; not persisted when neither is set)
+            continuation: Continuation to start from when no matching state is persisted (e.g. the
+                          gallery snapshot's); None reads the feed from the beginning
+            poll_interval: Seconds between feed reads (defaults to GALLERY_SYNC_INTERVAL, then 5)
+            reconcile_interval: Seconds between deletion checks (defaults to GALLERY_RECONCILE_INTERVAL,
+                                then 3600; 0 disables them)
+            snapshot: Identity of the snapshot the gallery was opened from (snapshot_identity of its
+                      header); the state is only persisted and restored for snapshot galleries
+        """
+        self.gallery = gallery
+        self.feed = feed
+        self.state_path = state_path or os.getenv("GALLERY_SYNC_STATE")
+        self.snapshot = snapshot
+        self.poll_interval = poll_interval if poll_interval is not None else float(os.getenv("GALLERY_SYNC_INTERVAL", "5"))
+        self.reconcile_interval = (reconcile_interval if reconcile_interval is not None
+                                   else float(os.getenv("GALLERY_RECONCILE_INTERVAL", "3600")))
+        self.continuation = continuation
+        self.restored = self._load_state()
+
+        self.applied = 0
+        self.removed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_sync: Optional[float] = None
+        self.last_reconcile = time.time()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock_file = None
+        self._writer: Optional[bool] = None
+
+    def _persists_state(self) -> bool:
+        """Check if the state of this sync's gallery can be persisted and restored."""
+        return bool(self.state_path) and self.snapshot is not None and self.gallery.overlay is not None
+
+    def _load_state(self) -> bool:
+        """
+        Restore the overlay and continuation persisted against the gallery's snapshot.
+
+        Returns:
+            True if the state was restored, False if the sync starts from the given continuation
+        """
+        if not self._persists_state() or not os.path.exists(self.state_path):
+            return False
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            if state.get("snapshot") != self.snapshot:
+                logger.warning("Gallery sync state was written against another snapshot; starting from the snapshot's continuation")
+                return False
+            overlay = open_snapshot(os.path.join(os.path.dirname(os.path.abspath(self.state_path)), state["overlay"]),
+                                    self.gallery.processor)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable gallery sync state: {str(e)}")
+            return False
+
+        for template_id in state.get("removed", []):
+            self.gallery.remove(template_id)
+        for template_id in list(overlay.ids()):
+            self.gallery.add(template_id, overlay.get(template_id))
+        self.continuation = state.get("continuation")
+        self.gallery.updated = state.get("updated", self.gallery.updated)
+        logger.info(f"Restored {len(overlay)} templates changed since the gallery snapshot from {self.state_path}")
+        return True
+
+    def _acquire_writer(self) -> bool:
+        """Check if this process writes the state file, taking its lock on the first call."""
+        if self._writer is None:
+            self._writer = False
+            if fcntl is None:
+                logger.warning("Gallery sync state is not persisted: file locks are not available on this platform")
+                return False
+            try:
+                lock_file = open(f"{self.state_path}.lock", "a")
+            except OSError as e:
+                logger.error(f"Failed to open gallery sync state lock: {str(e)}")
+                return False
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another process (e.g. another uvicorn worker) persists the state
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            self._writer = True
+        return self._writer
+
+    def _save_state(self) -> None:
+        """Persist the overlay and continuation, writing to new files that replace the old ones."""
+        if not self._persists_state() or not self._acquire_writer():
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        overlay_name = f"{os.path.basename(self.state_path)}.{uuid.uuid4().hex}.overlay"
+        overlay_path = os.path.join(directory, overlay_name)
+        previous = None
+        temp_path = None
+        try:
+            try:
+                with open(self.state_path, "r") as f:
+                    previous = json.load(f).get("overlay")
+            except (OSError, ValueError):
+                pass
+            write_snapshot(self.gallery.overlay, overlay_path, self.continuation)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "snapshot": self.snapshot,
+                    "continuation": self.continuation,
+                    "overlay": overlay_name,
+                    "removed": self.gallery.index.removed_ids(),
+                    "updated": time.time()
+                }, f)
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            logger.error(f"Failed to persist gallery sync state: {str(e)}")
+            for path in (temp_path, overlay_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            return
+
+        if previous and previous != overlay_name:
+            try:
+                os.remove(os.path.join(directory, previous))
+            except OSError:
+                pass
+
+    def sync_once(self) -> int:
+        """
+        Read the feed until it has no more changes and apply them to the gallery.
+
+        Returns:
+            Number of changes applied
+        """
+        applied = 0
+        while True:
+            items, continuation = self.feed.read(self.continuation)
+            for item in items:
+                self._apply(item)
+            applied += len(items)
+            self.continuation = continuation
+            if not items:
+                break
+
+        self.last_sync = time.time()
+        self.gallery.updated = self.last_sync
+        if applied:
+            self._save_state()
+        return applied
+
+    def _apply(self, item: Dict[str, Any]) -> None:
+        """Apply one changed document to the gallery."""
+        item_id = item.get("id")
+        if not item_id:
+            return
+
+        if item.get("deleted"):
+            if self.gallery.remove(item_id):
+                self.removed += 1
+            return
+
+        try:
+            self.gallery.add(item_id, item)
+            self.applied += 1
+        except (ProfileMismatchError, KeyError, TypeError, ValueError):
+            # Not a template of the gallery's profile (any older version of it is dropped)
+            self.gallery.remove(item_id)
+            self.skipped += 1
+
+    def reconcile(self) -> int:
+        """
+        Remove templates whose documents no longer exist.
+
+        Returns:
+            Number of removed templates
+        """
+        existing = set(self.feed.list_ids())
+        stale = [template_id for template_id in self.gallery.ids() if template_id not in existing]
+        for template_id in stale:
+            self.gallery.remove(template_id)
+        self.removed += len(stale)
+        self.last_reconcile = time.time()
+        return len(stale)
+
+    def staleness(self) -> Optional[float]:
+        """
+        Get the gallery's staleness.
+
+        Returns:
+            Seconds since the gallery last caught up with the feed, or None if it never did
+        """
+        return None if self.last_sync is None else time.time() - self.last_sync
+
+    def start(self) -> None:
+        """Start syncing in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self._writer = None
+
+    def _run(self) -> None:
+        """Poll the feed until stopped."""
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+                if self.reconcile_interval > 0 and time.time() - self.last_reconcile >= self.reconcile_interval:
+                    self.reconcile()
+            except (exceptions.CosmosHttpResponseError, OSError) as e:
+                self.errors += 1
+                logger.error(f"Gallery sync failed: {str(e)}")
+            self._stop.wait(self.poll_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get sync statistics.
+
+        Returns:
+            Dictionary with gallery size, change counters and staleness in seconds
+        """
+        staleness = self.staleness()
+        return {
+            "templates": len(self.gallery),
+            "applied": self.applied,
+            "removed": self.removed,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "staleness_seconds": round(staleness, 1) if staleness is not None else None
+        }
+
+
+def create_gallery_sync(gallery: TemplateGallery, snapshot_path: Optional[str] = None) -> Optional[GallerySync]:
+    """
+    Create a sync of a gallery with the Cosmos DB container's change feed.
+
+    Args:
+        gallery: Gallery to keep up to date
+        snapshot_path: Snapshot the gallery was opened from; its continuation is where the
+                       sync starts unless GALLERY_SYNC_STATE holds a state written against it
+
+    Returns:
+        The (not yet started) sync, or None if GALLERY_SYNC_INTERVAL is 0 or Cosmos DB is not connected
+    """
+    from cosmos_db import CosmosDBClient
+
+    if float(os.getenv("GALLERY_SYNC_INTERVAL", "5")) <= 0:
+        return None
+
+    # A client of its own, as the feed's continuation is read from the client's last response
+    cosmos_client = CosmosDBClient()
+    if not cosmos_client.is_connected():
+        return None
+
+    header = read_header(snapshot_path) if snapshot_path else {}
+    return GallerySync(gallery, CosmosChangeFeed(cosmos_client.container), continuation=header.get("continuation"),
+                       snapshot=snapshot_identity(header) if snapshot_path else None)
@@ -7,11 +7,23 @@ import logging
 from retina_processor import RetinaProcessor
 from cosmos_db import CosmosDBClient
 from service_bus import ServiceBusHandler
-from blob_storage import BlobStorageClient
+from queue_scheduler import QueuePolicy
+from single_flight import SingleFlight, make_key
+from message_ledger import MessageLedger
+from micro_batcher import MicroBatcher
+from gallery_snapshot import SnapshotFormatError, open_snapshot
+from gallery_sync import create_gallery_sync
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from blob_storage import AsyncBlobStorageClient, BlobStorageClient
+from blob_prefetch import BlobPrefetcher
+from probe_cache import ProbeCache
+from feature_set import FeatureSet
+from extraction_profiles import get_profile
 from dotenv import load_dotenv
 import uuid
 import cv2
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
 import datetime
 
 # Configure logging
@@ -35,9 +47,42 @@ class RetinaAnalyzerService:
         self.cosmos_client = CosmosDBClient()
         self.service_bus = ServiceBusHandler()
         self.blob_client = BlobStorageClient()
+        # Downloads awaited on the event loop share its connection pool
+        self.async_blob_client = AsyncBlobStorageClient()
+        # Retried and repeated messages for an unchanged blob reuse its extracted features
+        self.probe_cache = ProbeCache()
+        self.prefetcher = BlobPrefetcher(self.async_blob_client, probe_cache=self.probe_cache)
         self.response_queue_name = os.getenv("AZURE_SERVICE_BUS_RESPONSE_QUEUE_NAME")
         self.validation_queue_name = os.getenv("AZURE_SERVICE_BUS_VALIDATION_QUEUE_NAME")
         self.validation_response_queue_name = os.getenv("AZURE_SERVICE_BUS_VALIDATION_RESPONSE_QUEUE_NAME")
+        # Extraction profiles per queue; a message may override them with a "profile" field
+        self.enrollment_profile = os.getenv("ENROLLMENT_PROFILE")
+        self.validation_profile = os.getenv("VALIDATION_PROFILE")
+        # Coalesces identical in-flight validations and briefly reuses their results
+        self.validation_flight = SingleFlight()
+        # Responses of processed messages, resent when a message is redelivered
+        self.ledger = MessageLedger(self.cosmos_client)
+        # Validations arriving within VALIDATION_BATCH_WINDOW_MS are extracted and scored together
+        # (VALIDATION_BATCH_SIZE=1 handles every message on its own)
+        self.validation_batch_size = max(1, int(os.getenv("VALIDATION_BATCH_SIZE", "16")))
+        self.validation_batcher = MicroBatcher(
+            self._validate_batch,
+            max_size=self.validation_batch_size,
+            window_ms=float(os.getenv("VALIDATION_BATCH_WINDOW_MS", "5"))
+        )
+        # Memory-mapped templates shared with the API workers; templates missing from it are read from Cosmos DB
+        self.gallery = None
+        self.gallery_sync = None
+        snapshot_path = os.getenv("GALLERY_SNAPSHOT")
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                self.gallery = open_snapshot(snapshot_path, self.retina_processor)
+            except (SnapshotFormatError, OSError) as e:
+                # Templates are read from Cosmos DB instead
+                logger.error(f"Failed to open gallery snapshot {snapshot_path}: {str(e)}")
+        if self.gallery is not None:
+            logger.info(f"Opened gallery snapshot {snapshot_path} with {len(self.gallery)} templates")
+            self.gallery_sync = create_gallery_sync(self.gallery, snapshot_path)
     
     async def start(self):
         """Start the service and begin processing messages from Service Bus."""
@@ -85,21 +130,55 @@ class RetinaAnalyzerService:
             logger.error("Blob Storage is not configured. Check your .env file.")
             return
         
+        # Load the lazily imported dependencies and OpenCV code paths before the first message
+        profiles = {p for p in (self.enrollment_profile, self.validation_profile) if p}
+        warm_up_timings = await asyncio.to_thread(self.retina_processor.warm_up, sorted(profiles) or None)
+        logger.info("Retina processor warmed up: " + ", ".join(
+            f"{profile}={seconds * 1000:.0f}ms" for profile, seconds in warm_up_timings.items()
+        ))
+        
+        # Apply enrollments and deletions made after the gallery snapshot was built
+        if self.gallery_sync is not None:
+            self.gallery_sync.start()
+        
         # Start processing messages
         try:
             logger.info("Starting to process messages from Service Bus...")
             # Create a message handler mapping for different queues
+            enrollment_queue_name = os.getenv("SERVICE_BUS_QUEUE_NAME")
             message_handlers = {
-                os.getenv("SERVICE_BUS_QUEUE_NAME"): self.process_message,
+                enrollment_queue_name: self.process_message,
                 self.validation_queue_name: self.validate_retina
             }
-            await self.service_bus.start_processing_multiple(message_handlers)
+            
+            # Door-access validations are user-facing: they get priority over enrollments,
+            # and enrollments pause while validation lag exceeds its target
+            policies = {
+                enrollment_queue_name: QueuePolicy(
+                    workers=int(os.getenv("ENROLLMENT_WORKERS", "1")), priority=0, weight=1,
+                    prefetch=int(os.getenv("ENROLLMENT_PREFETCH", "2"))
+                ),
+                # With micro-batching, enough validations must be in flight to form batches, so
+                # messages do not take handler slots each; every batch takes one in _validate_batch
+                self.validation_queue_name: QueuePolicy(
+                    workers=int(os.getenv("VALIDATION_WORKERS", str(max(2, self.validation_batch_size)))), priority=1,
+                    weight=int(os.getenv("VALIDATION_WEIGHT", "4")), gated=self.validation_batch_size == 1,
+                    prefetch=int(os.getenv("VALIDATION_PREFETCH", str(self.validation_batch_size)))
+                )
+            }
+            lag_target = (self.validation_queue_name, float(os.getenv("VALIDATION_LAG_TARGET_MS", "2000")))
+            # Images are downloaded and decoded as soon as their messages arrive, and the next
+            # messages are received ahead, so extraction does not wait for Blob Storage
+            await self.service_bus.start_processing_multiple(message_handlers, policies, lag_target, self.prefetcher)
         except KeyboardInterrupt:
             logger.info("Keyboard interrupt received. Shutting down...")
         except Exception as e:
             logger.error(f"Error in message processing: {str(e)}")
         finally:
             self.service_bus.stop_processing()
+            if self.gallery_sync is not None:
+                self.gallery_sync.stop()
+            await self.async_blob_client.close()
             logger.info("Retina Analyzer Service stopped")
     
     async def process_message(self, message_data: Dict[str, Any]):
@@ -110,10 +189,22 @@ class RetinaAnalyzerService:
             message_data: Message data containing image_path and employeeId
         """
         try:
+            # A redelivered message that was already processed only gets its response resent
+            ledger_key = MessageLedger.make_key("enrollment", message_data)
+            recorded_response = await asyncio.to_thread(self.ledger.get, ledger_key)
+            if recorded_response is not None:
+                logger.info(f"Message {ledger_key} already processed, resending its response")
+                await self.service_bus.send_message(
+                    message_data=recorded_response,
+                    queue_name=self.response_queue_name
+                )
+                return recorded_response
+            
             # Extract data from message
             blob_path = message_data.get('image_path')
             employee_id = message_data.get('employeeId')
             file_id = message_data.get('imgId')
+            profile = message_data.get('profile') or self.enrollment_profile
             
             if not blob_path:
                 logger.error("Message missing required field: image_path")
@@ -121,76 +212,68 @@ class RetinaAnalyzerService:
             
             logger.info(f"Processing image from blob: {blob_path} for employee: {employee_id}")
             
-            # Download the image from Blob Storage
-            temp_image_path = self.blob_client.download_blob_to_temp(blob_path)
-            if not temp_image_path:
-                logger.error(f"Failed to download image from blob: {blob_path}")
+            etag, probe = await self._get_probe(blob_path, profile)
+            if probe is None:
+                logger.error(f"Failed to download or read image from blob: {blob_path}")
                 return
             
-            try:
-                # Read the image
-                image = cv2.imread(temp_image_path)
-                if image is None:
-                    logger.error(f"Could not read image from path: {temp_image_path}")
-                    return
+            if isinstance(probe, FeatureSet):
+                features = probe
+            else:
+                # Extract features (in a worker thread, so validations keep being scheduled)
+                features = await asyncio.to_thread(self.retina_processor.extract_features, probe, profile=profile)
+                self.probe_cache.put(blob_path, etag, features)
+            
+            # Store features in Cosmos DB under a deterministic ID, so that
+            # reprocessing the same image replaces the document instead of duplicating it
+            cosmos_id = await asyncio.to_thread(
+                self.retina_processor.export_features_to_json,
+                features, 
+                person_id=employee_id,
+                item_id=CosmosDBClient.enrollment_id(employee_id, file_id or blob_path, features["profile"])
+            )
+            
+            if cosmos_id:
+                logger.info(f"Features stored in Cosmos DB with ID: {cosmos_id}")
                 
-                # Extract features
-                features = self.retina_processor.extract_features(image)
+                # Create response message
+                response_message = {
+                    "status": "success",
+                    "id": cosmos_id,
+                    "employeeId": employee_id,
+                    "originalImage": blob_path,
+                    "imgId": file_id,
+                    "profile": features["profile"]
+                }
                 
-                # Store features in Cosmos DB
-                cosmos_id = self.retina_processor.export_features_to_json(
-                    features, 
-                    person_id=employee_id
+                # Send response message back to Service Bus response queue
+                await self.service_bus.send_message(
+                    message_data=response_message,
+                    queue_name=self.response_queue_name
                 )
+                logger.info(f"Response message sent to queue '{self.response_queue_name}': {response_message}")
+                await asyncio.to_thread(self.ledger.record, ledger_key, response_message)
                 
-                if cosmos_id:
-                    logger.info(f"Features stored in Cosmos DB with ID: {cosmos_id}")
-                    
-                    # Create response message
-                    response_message = {
-                        "status": "success",
-                        "id": cosmos_id,
-                        "employeeId": employee_id,
-                        "originalImage": blob_path,
-                        "imgId": file_id
-                    }
-                    
-                    # Send response message back to Service Bus response queue
-                    await self.service_bus.send_message(
-                        message_data=response_message,
-                        queue_name=self.response_queue_name
-                    )
-                    logger.info(f"Response message sent to queue '{self.response_queue_name}': {response_message}")
-                    
-                    return response_message
-                else:
-                    logger.error("Failed to store features in Cosmos DB")
-                    
-                    # Send error message back to Service Bus response queue
-                    error_message = {
-                        "status": "error",
-                        "message": "Failed to store features in Cosmos DB",
-                        "employeeId": employee_id,
-                        "originalImage": blob_path,
-                        "imgId": file_id
-                    }
-                    
-                    await self.service_bus.send_message(
-                        message_data=error_message,
-                        queue_name=self.response_queue_name
-                    )
-                    logger.info(f"Error message sent to queue '{self.response_queue_name}': {error_message}")
-                    
-                    return error_message
+                return response_message
+            else:
+                logger.error("Failed to store features in Cosmos DB")
+                
+                # Send error message back to Service Bus response queue
+                error_message = {
+                    "status": "error",
+                    "message": "Failed to store features in Cosmos DB",
+                    "employeeId": employee_id,
+                    "originalImage": blob_path,
+                    "imgId": file_id
+                }
+                
+                await self.service_bus.send_message(
+                    message_data=error_message,
+                    queue_name=self.response_queue_name
+                )
+                logger.info(f"Error message sent to queue '{self.response_queue_name}': {error_message}")
                 
-            finally:
-                # Clean up the temporary file
-                try:
-                    if os.path.exists(temp_image_path):
-                        os.remove(temp_image_path)
-                        logger.info(f"Removed temporary file: {temp_image_path}")
-                except Exception as e:
-                    logger.warning(f"Failed to remove temporary file {temp_image_path}: {str(e)}")
+                return error_message
             
         except Exception as e:
             logger.error(f"Error processing message: {str(e)}")
@@ -215,6 +298,39 @@ class RetinaAnalyzerService:
             
             return error_message
     
+    def _gallery_is_fresh(self) -> bool:
+        """
+        Check whether templates may be read from the gallery snapshot.
+        
+        Returns:
+            True if there is a gallery and it did not fall behind Cosmos DB for too long
+        """
+        return self.gallery is not None and self.gallery.is_fresh()
+    
+    async def _get_probe(self, blob_path: str, profile: Optional[str]) -> Tuple[Optional[str], Union[FeatureSet, np.ndarray, None]]:
+        """
+        Get the features cached for a blob's current version, or else its image.
+        
+        The blob's ETag costs a properties request; on a hit the image is
+        neither transferred nor decoded.
+        
+        Args:
+            blob_path: Path of the image in Blob Storage
+            profile: Extraction profile name (None for the default)
+            
+        Returns:
+            Tuple of (ETag of the blob or None, cached FeatureSet or decoded image, None if it could not be loaded)
+        """
+        etag = await self.prefetcher.get_etag(blob_path)
+        profile_name = get_profile(profile).name if profile else self.retina_processor.profile.name
+        features = self.probe_cache.get(blob_path, etag, profile_name)
+        if features is not None:
+            logger.info(f"Using cached features of unchanged blob: {blob_path}")
+            return etag, features
+        
+        # The image was prefetched when the message arrived, or is downloaded now
+        return etag, await self.prefetcher.get(blob_path)
+    
     async def _send_validation_response(self, response_data: Dict[str, Any]) -> None:
         """
         Helper method to send validation responses to the correct queue.
@@ -247,6 +363,239 @@ class RetinaAnalyzerService:
             logger.error(f"Failed to send validation response: {str(e)}")
             logger.error(f"Response data that failed to send: {response_data}")
     
+    def _compute_validation(self, blob_path: str, employees: List[Dict[str, Any]], profile: Optional[str],
+                            probe: Union[FeatureSet, np.ndarray, None] = None, etag: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Download, extract and compare a retina image; runs in a worker thread.
+        
+        Args:
+            blob_path: Path of the image in Blob Storage
+            employees: Employee references with employeeId and documentId
+            profile: Extraction profile name (None for the default)
+            probe: Cached features or prefetched image (None to download the image)
+            etag: ETag of the blob the probe's features are cached under
+            
+        Returns:
+            Validation result without messageId
+        """
+        if isinstance(probe, FeatureSet):
+            input_features = probe
+        else:
+            # Download the image from Blob Storage unless it was prefetched
+            image = probe
+            if image is None:
+                image, error = self._load_blob_image(blob_path)
+                if error is not None:
+                    return error
+            
+            # Extract features from the input image
+            input_features = self.retina_processor.extract_features(image, profile=profile)
+            self.probe_cache.put(blob_path, etag, input_features)
+        
+        # Score the packed gallery rows when it holds every employee's template
+        if self._gallery_is_fresh():
+            result = self.gallery.match_employees(input_features, employees)
+            if result is not None:
+                return result
+        
+        # Compare with each employee's retina features from the gallery snapshot or Cosmos DB
+        def get_template(document_id: str, employee_id: Optional[str]) -> Dict[str, Any]:
+            template = self.gallery.get(document_id) if self._gallery_is_fresh() else None
+            if template is None:
+                template = self.cosmos_client.get_features(document_id, employee_id)
+            return template
+        
+        return self.retina_processor.match_employees(input_features, employees, get_template)
+    
+    def _load_blob_image(self, blob_path: str) -> Tuple[Optional[np.ndarray], Optional[Dict[str, Any]]]:
+        """
+        Download and decode an image from Blob Storage.
+        
+        Args:
+            blob_path: Path of the image in Blob Storage
+            
+        Returns:
+            Tuple of (image, None), or (None, error result) if it could not be downloaded or read
+        """
+        temp_image_path = self.blob_client.download_blob_to_temp(blob_path)
+        if not temp_image_path:
+            logger.error(f"Failed to download image from blob: {blob_path}")
+            return None, {
+                "status": "error",
+                "message": f"Failed to download image from blob: {blob_path}",
+                "matchingEmployeeId": None
+            }
+        
+        try:
+            image = cv2.imread(temp_image_path)
+            if image is None:
+                logger.error(f"Could not read image from path: {temp_image_path}")
+                return None, {
+                    "status": "error",
+                    "message": f"Could not read image from path: {temp_image_path}",
+                    "matchingEmployeeId": None
+                }
+            return image, None
+        finally:
+            # Clean up the temporary file
+            try:
+                if os.path.exists(temp_image_path):
+                    os.remove(temp_image_path)
+            except Exception as e:
+                logger.warning(f"Failed to remove temporary file {temp_image_path}: {str(e)}")
+    
+    async def _validate_batch(self, requests: List[Tuple[str, List[Dict[str, Any]], Optional[str], Any, Optional[str]]]) -> List[Dict[str, Any]]:
+        """
+        Micro-batch function: validate a batch of requests in a worker thread.
+        
+        The batch holds one execution slot of the Service Bus gate while it
+        runs, so it is scheduled against enrollments like a single handler.
+        
+        Args:
+            requests: List of (blob_path, employees, profile, probe, etag) tuples
+            
+        Returns:
+            Validation result for each request, without messageId
+        """
+        gate = self.service_bus.gate
+        if gate is None:
+            return await asyncio.to_thread(self._compute_validation_batch, requests)
+        await gate.acquire(self.validation_queue_name)
+        try:
+            return await asyncio.to_thread(self._compute_validation_batch, requests)
+        finally:
+            gate.release()
+    
+    def _compute_validation_batch(self, requests: List[Tuple[str, List[Dict[str, Any]], Optional[str], Any, Optional[str]]]) -> List[Dict[str, Any]]:
+        """
+        Validate several retina images together.
+        
+        Downloads the probes that were neither cached nor prefetched
+        concurrently, extracts them, reads the union of their templates from
+        Cosmos DB in one bulk read and scores every probe against its
+        employees' templates with one matrix comparison per profile.
+        
+        Args:
+            requests: List of (blob_path, employees, profile, probe, etag) tuples, probe being the
+                      cached FeatureSet, the prefetched image or None to download the image
+            
+        Returns:
+            Validation result for each request, without messageId
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+        probes: Dict[int, Dict[str, Any]] = {}
+        
+        # Download the probe images that were neither cached nor prefetched concurrently
+        loaded = [(request[3], None) for request in requests]
+        missing_images = [index for index, request in enumerate(requests) if request[3] is None]
+        if missing_images:
+            with ThreadPoolExecutor(max_workers=min(8, len(missing_images))) as pool:
+                for index, result in zip(missing_images, pool.map(lambda index: self._load_blob_image(requests[index][0]),
+                                                                   missing_images)):
+                    loaded[index] = result
+        
+        # Extract the probes that are not cached
+        for index, ((probe, error), (blob_path, _, profile, _, etag)) in enumerate(zip(loaded, requests)):
+            if error is not None:
+                results[index] = error
+                continue
+            if isinstance(probe, FeatureSet):
+                probes[index] = probe
+                continue
+            try:
+                probes[index] = self.retina_processor.extract_features(probe, profile=profile)
+                self.probe_cache.put(blob_path, etag, probes[index])
+            except Exception as e:
+                logger.error(f"Error validating retina: {str(e)}")
+                results[index] = {
+                    "status": "error",
+                    "message": f"Error validating retina: {str(e)}",
+                    "matchingEmployeeId": None
+                }
+        
+        # Probes whose templates are all in the gallery are scored on its packed rows
+        if self._gallery_is_fresh():
+            for index in list(probes):
+                result = self.gallery.match_employees(probes[index], requests[index][1])
+                if result is not None:
+                    results[index] = result
+                    del probes[index]
+        
+        # Read all templates referenced by the rest of the batch at once
+        document_ids = {
+            employee.get('documentId')
+            for index in probes for employee in requests[index][1] if employee.get('documentId')
+        }
+        templates = {}
+        if self._gallery_is_fresh():
+            for document_id in document_ids:
+                template = self.gallery.get(document_id)
+                if template is not None:
+                    templates[document_id] = template
+        missing = [document_id for document_id in document_ids if document_id not in templates]
+        if missing:
+            try:
+                templates.update(self.cosmos_client.get_features_many(missing))
+            except Exception as e:
+                logger.warning(f"Error reading templates from Cosmos DB: {str(e)}")
+        
+        # Score each group of probes sharing a profile against their templates in one matrix operation
+        groups: Dict[Tuple[str, str], List[int]] = {}
+        for index, features in probes.items():
+            groups.setdefault((features["profile"], features["extractor_version"]), []).append(index)
+        
+        for indices in groups.values():
+            template_ids = sorted({
+                employee.get('documentId') for index in indices for employee in requests[index][1]
+                if employee.get('documentId') in templates
+            })
+            column = {document_id: j for j, document_id in enumerate(template_ids)}
+            mask = np.zeros((len(indices), len(template_ids)), dtype=bool)
+            for i, index in enumerate(indices):
+                for employee in requests[index][1]:
+                    if employee.get('documentId') in column:
+                        mask[i, column[employee.get('documentId')]] = True
+            
+            scores = self.retina_processor.compare_features_matrix(
+                [probes[index] for index in indices],
+                [templates[document_id] for document_id in template_ids],
+                mask
+            )
+            
+            for i, index in enumerate(indices):
+                matching_employee_id = None
+                highest_similarity = 0.0
+                
+                for employee in requests[index][1]:
+                    employee_id = employee.get('employeeId')
+                    document_id = employee.get('documentId')
+                    
+                    if not document_id:
+                        logger.warning(f"Missing documentId for employee: {employee_id}")
+                        continue
+                    if document_id not in column:
+                        logger.warning(f"Error comparing with employee {employee_id}: Item with ID {document_id} not found")
+                        continue
+                    j = column[document_id]
+                    if not scores["compatible"][j]:
+                        logger.warning(f"Error comparing with employee {employee_id}: incompatible extraction profile")
+                        continue
+                    
+                    similarity = float(scores["overall_similarity"][i, j])
+                    # If it's a match and has higher similarity than previous matches
+                    if scores["is_match"][i, j] and similarity > highest_similarity:
+                        highest_similarity = similarity
+                        matching_employee_id = employee_id
+                
+                results[index] = {
+                    "status": "success",
+                    "matchingEmployeeId": matching_employee_id,
+                    "similarity": highest_similarity if matching_employee_id else 0.0
+                }
+        
+        logger.info(f"Validated micro-batch of {len(requests)} images against {len(templates)} templates")
+        return results
+    
     async def validate_retina(self, message_data: Dict[str, Any]):
         """
         Validate a retina image against multiple employee retina scans.
@@ -258,7 +607,8 @@ class RetinaAnalyzerService:
                     "employees": [
                         {"employeeId": "emp123", "documentId": "cosmos_doc_id"},
                         ...
-                    ]
+                    ],
+                    "profile": "standard"  # optional extraction profile
                 }
                 
         Returns:
@@ -271,7 +621,17 @@ class RetinaAnalyzerService:
 
             logger.info(f"Received employees data: {message_data}")
             message_id = message_data.get('messageId', str(uuid.uuid4()))
+            
+            # A redelivered message that was already processed only gets its response resent
+            ledger_key = MessageLedger.make_key("validation", message_data)
+            recorded_response = await asyncio.to_thread(self.ledger.get, ledger_key)
+            if recorded_response is not None:
+                logger.info(f"Message {ledger_key} already processed, resending its response")
+                await self._send_validation_response(recorded_response)
+                return recorded_response
+            
             originating_instance = message_data.get('originatingInstance', None)
+            profile = message_data.get('profile') or self.validation_profile
             
             if not blob_path:
                 logger.error("Message missing required field: image_path")
@@ -297,93 +657,28 @@ class RetinaAnalyzerService:
             
             logger.info(f"Validating retina image from blob: {blob_path} against {len(employees)} employees")
             
-            # Download the image from Blob Storage
-            temp_image_path = self.blob_client.download_blob_to_temp(blob_path)
-            if not temp_image_path:
-                logger.error(f"Failed to download image from blob: {blob_path}")
-                response = {
-                    "status": "error",
-                    "message": f"Failed to download image from blob: {blob_path}",
-                    "matchingEmployeeId": None,
-                    "messageId": message_id
-                }
-                await self._send_validation_response(response)
-                return response
+            # Redelivered or duplicate messages for the same image and employees share one computation
+            employee_key = sorted((emp.get('employeeId') or "", emp.get('documentId') or "") for emp in employees)
             
-            try:
-                # Read the image
-                image = cv2.imread(temp_image_path)
-                if image is None:
-                    logger.error(f"Could not read image from path: {temp_image_path}")
-                    response = {
-                        "status": "error",
-                        "message": f"Could not read image from path: {temp_image_path}",
-                        "matchingEmployeeId": None,
-                        "messageId": message_id
-                    }
-                    await self._send_validation_response(response)
-                    return response
-                
-                # Extract features from the input image
-                input_features = self.retina_processor.extract_features(image)
-                
-                # Compare with each employee's retina features
-                matching_employee_id = None
-                highest_similarity = 0.0
-                
-                for employee in employees:
-                    employee_id = employee.get('employeeId')
-                    document_id = employee.get('documentId')
-                    
-                    if not document_id:
-                        logger.warning(f"Missing documentId for employee: {employee_id}")
-                        continue
-                    
-                    try:
-                        # Get employee's retina features from Cosmos DB
-                        employee_features = self.cosmos_client.get_features(document_id)
-                        
-                        # Compare features
-                        comparison_result = self.retina_processor.compare_features(
-                            input_features, 
-                            employee_features
-                        )
-                        
-                        similarity = comparison_result.get('overall_similarity', 0.0)
-                        is_match = comparison_result.get('is_match', False)
-                        
-                        logger.info(f"Comparison with employee {employee_id}: similarity={similarity}, is_match={is_match}")
-                        
-                        # If it's a match and has higher similarity than previous matches
-                        if is_match and similarity > highest_similarity:
-                            highest_similarity = similarity
-                            matching_employee_id = employee_id
-                    
-                    except Exception as e:
-                        logger.warning(f"Error comparing with employee {employee_id}: {str(e)}")
-                        continue
-                
-                # Prepare response
-                response = {
-                    "status": "success",
-                    "matchingEmployeeId": matching_employee_id,
-                    "similarity": highest_similarity if matching_employee_id else 0.0,
-                    "messageId": message_id
-                }
-                
-                # Send response
-                await self._send_validation_response(response)
-                
-                return response
-                
-            finally:
-                # Clean up the temporary file
-                try:
-                    if os.path.exists(temp_image_path):
-                        os.remove(temp_image_path)
-                        logger.info(f"Removed temporary file: {temp_image_path}")
-                except Exception as e:
-                    logger.warning(f"Failed to remove temporary file {temp_image_path}: {str(e)}")
+            async def compute():
+                etag, probe = await self._get_probe(blob_path, profile)
+                if self.validation_batch_size > 1:
+                    return await self.validation_batcher.submit((blob_path, employees, profile, probe, etag))
+                return await asyncio.to_thread(self._compute_validation, blob_path, employees, profile, probe, etag)
+            
+            result = await self.validation_flight.do(
+                make_key("validate", blob_path, employee_key, profile),
+                compute,
+                cacheable=lambda result: result.get("status") == "success"
+            )
+            
+            # Every message gets its own response
+            response = {**result, "messageId": message_id}
+            await self._send_validation_response(response)
+            if response["status"] == "success":
+                await asyncio.to_thread(self.ledger.record, ledger_key, response)
+            
+            return response
             
         except Exception as e:
             logger.error(f"Error validating retina: {str(e)}")
@@ -0,0 +1,119 @@
+"""
+Measure the request unit charge and latency of feature writes with the default
+and the features indexing policy.
+
+The script creates two temporary containers in the configured database, writes
+the same feature documents to both and deletes the containers afterwards.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import time
+import uuid
+import cv2
+import numpy as np
+from azure.cosmos import PartitionKey
+from cosmos_db import CosmosDBClient, FEATURES_INDEXING_POLICY
+from retina_processor import RetinaProcessor
+
+
+def load_documents(image_dir: str, profile: str = None) -> list:
+    """
+    Extract feature documents from a directory of retina images.
+
+    Args:
+        image_dir: Directory containing retina images
+        profile: Extraction profile
+
+    Returns:
+        List of feature documents ready to be written
+    """
+    processor = RetinaProcessor(profile=profile)
+    documents = []
+    # Silence the per-call cache and performance prints of the processor
+    with contextlib.redirect_stdout(io.StringIO()):
+        for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+            image = cv2.imread(path)
+            if image is not None:
+                features = processor.extract_features(image).to_document()
+                features["person_id"] = os.path.splitext(os.path.basename(path))[0]
+                documents.append(features)
+    return documents
+
+
+def measure_writes(container, documents: list, writes: int) -> dict:
+    """
+    Write documents to a container and collect their charges.
+
+    Args:
+        container: Container proxy
+        documents: Feature documents, written round robin
+        writes: Number of writes
+
+    Returns:
+        Dictionary with mean and P95 request charge and latency
+    """
+    charges = []
+    latencies = []
+    for i in range(writes):
+        item = dict(documents[i % len(documents)], id=str(uuid.uuid4()))
+        start_time = time.perf_counter()
+        container.create_item(
+            body=item,
+            response_hook=lambda headers, _: charges.append(float(headers.get("x-ms-request-charge", 0)))
+        )
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return {
+        "mean_ru": float(np.mean(charges)),
+        "p95_ru": float(np.percentile(charges, 95)),
+        "mean_ms": float(np.mean(latencies)),
+        "p95_ms": float(np.percentile(latencies, 95))
+    }
+
+
+def main():
+    """Main function to run the measurement."""
+    parser = argparse.ArgumentParser(description="Compare feature write RU with the default and the features indexing policy")
+    parser.add_argument("--image-dir", default="../../retinal_images", help="Directory with retina images")
+    parser.add_argument("--writes", type=int, default=50, help="Writes per container")
+    parser.add_argument("--profile", default=None, help="Extraction profile (fast, standard, high_accuracy)")
+    args = parser.parse_args()
+
+    client = CosmosDBClient()
+    if not client.is_connected():
+        print("Error: Not connected to Cosmos DB. Check your connection settings.")
+        return
+
+    documents = load_documents(args.image_dir, args.profile)
+    if not documents:
+        print(f"Error: No readable images found in {args.image_dir}")
+        return
+
+    suffix = uuid.uuid4().hex[:8]
+    policies = {"default": None, "features": FEATURES_INDEXING_POLICY}
+    results = {}
+    for name, policy in policies.items():
+        container_name = f"ru_measurement_{name}_{suffix}"
+        container = client.database.create_container(
+            id=container_name,
+            partition_key=PartitionKey(path=client.partition_key_path),
+            indexing_policy=policy,
+            offer_throughput=400
+        )
+        try:
+            results[name] = measure_writes(container, documents, args.writes)
+        finally:
+            client.database.delete_container(container_name)
+
+    print(f"\nWrite Charges ({args.writes} writes of {len(documents)} documents, partition key {client.partition_key_path}):")
+    for name, stats in results.items():
+        print(f"{name} indexing policy: mean {stats['mean_ru']:.2f} RU (P95 {stats['p95_ru']:.2f}), "
+              f"mean {stats['mean_ms']:.1f} ms (P95 {stats['p95_ms']:.1f} ms)")
+    saving = 1 - results["features"]["mean_ru"] / results["default"]["mean_ru"]
+    print(f"RU saved per write: {saving:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Ledger of processed Service Bus messages, used to answer redeliveries without recomputing them.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from azure.cosmos import exceptions
+from dotenv import load_dotenv
+from cosmos_db import CosmosDBClient
+from ru_limiter import shared_limiter
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class MessageLedger:
+    """
+    Records the response sent for each processed message.
+
+    Entries are kept in a bounded in-memory map and, when LEDGER_COSMOS_CONTAINER
+    is set, in a Cosmos DB container with a time to live, so that redeliveries
+    are recognized across restarts and by other instances. Container requests
+    share the container's request unit limiter with the other clients of this
+    process. Lookups block on Cosmos DB, so async callers run them in a thread.
+    """
+    def __init__(self, cosmos_client: Optional[CosmosDBClient] = None, ttl: Optional[int] = None,
+                 max_entries: Optional[int] = None):
+        """
+        Initialize the message ledger.
+
+        Args:
+            cosmos_client: Optional connected Cosmos DB client for the shared ledger container
+            ttl: Seconds an entry is kept (defaults to the LEDGER_TTL environment variable, then one day)
+            max_entries: Maximum number of local entries (defaults to LEDGER_MAX_ENTRIES, then 10000)
+        """
+        self.ttl = ttl if ttl is not None else int(os.getenv("LEDGER_TTL", str(24 * 60 * 60)))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("LEDGER_MAX_ENTRIES", "10000"))
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.container = None
+        self.limiter = None
+
+        container_name = os.getenv("LEDGER_COSMOS_CONTAINER")
+        if container_name and cosmos_client is not None and cosmos_client.is_connected():
+            try:
+                self.container = cosmos_client.get_container(container_name, default_ttl=self.ttl)
+                self.limiter = shared_limiter(cosmos_client.endpoint or "", cosmos_client.database_name, container_name)
+                print(f"Using Cosmos DB message ledger: {container_name}")
+            except exceptions.CosmosHttpResponseError as e:
+                print(f"Failed to open Cosmos DB message ledger {container_name}: {str(e)}")
+
+    @staticmethod
+    def make_key(queue: str, message_data: Dict[str, Any]) -> Optional[str]:
+        """
+        Get the ledger key of a message.
+
+        Args:
+            queue: Name of the queue (or handler) the message belongs to
+            message_data: Message data; its messageId is used, else the Service Bus message ID
+
+        Returns:
+            The key, or None if the message carries no ID
+        """
+        message_id = message_data.get("messageId") or message_data.get("serviceBusMessageId")
+        if not message_id:
+            return None
+        return f"{queue}:{message_id}"
+
+    def get(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Get the response recorded for a message.
+
+        Args:
+            key: Ledger key of the message
+
+        Returns:
+            The recorded response, or None if the message was not processed yet
+        """
+        if not key:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry["expires"] > time.time():
+                    return entry["response"]
+                del self._entries[key]
+
+        if self.container is not None:
+            try:
+                item = self.limiter.execute(self.container.read_item, item=key, partition_key=key)
+                self._remember(key, item["response"])
+                return item["response"]
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+            except exceptions.CosmosHttpResponseError as e:
+                print(f"Failed to read message ledger entry {key}: {str(e)}")
+
+        return None
+
+    def record(self, key: Optional[str], response: Dict[str, Any]) -> None:
+        """
+        Record the response sent for a message.
+
+        Args:
+            key: Ledger key of the message
+            response: Response that was sent
+        """
+        if not key:
+            return
+
+        self._remember(key, response)
+
+        if self.container is not None:
+            try:
+                self.limiter.execute(self.container.upsert_item, body={"id": key, "response": response})
+            except exceptions.CosmosHttpResponseError as e:
+                print(f"Failed to write message ledger entry {key}: {str(e)}")
+
+    def _remember(self, key: str, response: Dict[str, Any]) -> None:
+        """Store an entry locally, evicting the oldest entries beyond max_entries."""
+        with self._lock:
+            self._entries[key] = {"response": response, "expires": time.time() + self.ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,107 @@
+"""
+Micro-batching of concurrent requests into one batch computation.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Collects items submitted within a short window into batches.
+
+    The first item of a batch starts a timer; the batch runs when the timer
+    fires or max_size items are waiting. One batch runs at a time, and items
+    arriving meanwhile form the next batch, so batches grow with load while
+    a lone item only waits for the window.
+    """
+    def __init__(self, batch_func: Callable[[List[Any]], Awaitable[List[Any]]], max_size: int = 16,
+                 window_ms: float = 5.0):
+        """
+        Initialize the micro-batcher.
+
+        Args:
+            batch_func: Coroutine function receiving a list of items and returning
+                        a list of results in the same order
+            max_size: Maximum number of items per batch
+            window_ms: Milliseconds to wait for more items after the first one
+        """
+        self.batch_func = batch_func
+        self.max_size = max(1, max_size)
+        self.window = max(0.0, window_ms) / 1000
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = False
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Add an item to the next batch and wait for its result.
+
+        Args:
+            item: Item to process
+
+        Returns:
+            The result batch_func produced for the item
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if not self._running:
+            if len(self._pending) >= self.max_size:
+                self._start_batch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._start_batch)
+
+        return await future
+
+    def _start_batch(self) -> None:
+        """Start a batch with the waiting items, unless one is already running."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._running or not self._pending:
+            return
+
+        batch = self._pending[:self.max_size]
+        self._pending = self._pending[self.max_size:]
+        self._running = True
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        """Run one batch and hand each item's result or the batch's error to its waiter."""
+        self.batches += 1
+        self.items += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            results = await self.batch_func([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Batch function returned {len(results)} results for {len(batch)} items")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._running = False
+            # Items that arrived while this batch ran have waited long enough
+            if self._pending:
+                self._start_batch()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get batching statistics.
+
+        Returns:
+            Dictionary with batch count, item count, mean and largest batch size
+        """
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch
+        }
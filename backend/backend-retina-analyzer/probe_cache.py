@@ -0,0 +1,172 @@
+"""
+In-memory cache of the features extracted from probe images in Blob Storage.
+"""
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import numpy as np
+from dotenv import load_dotenv
+from feature_set import FeatureSet
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+def feature_set_bytes(features: FeatureSet) -> int:
+    """
+    Estimate the memory held by a feature set.
+
+    Args:
+        features: Feature set
+
+    Returns:
+        Approximate size in bytes of its arrays and other values
+    """
+    size = sys.getsizeof(features)
+    for value in features.values():
+        size += value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value)
+    return size
+
+
+class ProbeCache:
+    """
+    Features of probe images keyed by blob path and blob version.
+
+    Validation retries and multi-step flows reference the same image_path
+    again. The version is the blob's ETag, read with a properties request, so
+    a hit returns the stored features without transferring or decoding the
+    image, while an overwritten blob gets a new ETag and is extracted again.
+    Entries hold the features of every profile extracted from one blob
+    version; they are evicted least recently used first once their total size
+    exceeds max_bytes, and expire after ttl seconds. The cache is thread-safe.
+    """
+    def __init__(self, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Initialize the probe cache.
+
+        Args:
+            max_bytes: Total size of the cached features (defaults to the PROBE_CACHE_BYTES
+                       environment variable, then 64 MiB; 0 disables the cache)
+            ttl: Seconds features stay cached (defaults to PROBE_CACHE_TTL, then 600)
+        """
+        self.max_bytes = (max_bytes if max_bytes is not None
+                          else int(os.getenv("PROBE_CACHE_BYTES", str(64 * 1024 * 1024))))
+        self.ttl = ttl if ttl is not None else float(os.getenv("PROBE_CACHE_TTL", "600"))
+        self.size_bytes = 0
+        # Blob path -> {"etag", "expires", "size", "features": {profile name: FeatureSet}}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_enabled(self) -> bool:
+        """Check if the cache may hold any features."""
+        return self.max_bytes > 0
+
+    def _entry(self, blob_path: str, etag: str) -> Optional[Dict[str, Any]]:
+        """Get the live entry of a blob version, dropping a stale one; the lock must be held."""
+        entry = self._entries.get(blob_path)
+        if entry is None:
+            return None
+        if entry["etag"] != etag or entry["expires"] <= time.monotonic():
+            self._remove(blob_path)
+            return None
+        self._entries.move_to_end(blob_path)
+        return entry
+
+    def _remove(self, blob_path: str) -> None:
+        """Remove an entry; the lock must be held."""
+        entry = self._entries.pop(blob_path)
+        self.size_bytes -= entry["size"]
+
+    def contains(self, blob_path: str, etag: Optional[str]) -> bool:
+        """
+        Check whether features of a blob version are cached for any profile.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+            etag: ETag of the blob
+
+        Returns:
+            True if the image does not need to be downloaded for a profile it was extracted with
+        """
+        if not etag or not self.is_enabled():
+            return False
+        with self._lock:
+            return self._entry(blob_path, etag) is not None
+
+    def get(self, blob_path: str, etag: Optional[str], profile: str) -> Optional[FeatureSet]:
+        """
+        Get the cached features of a blob version.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+            etag: ETag of the blob (None if it could not be read, which is always a miss)
+            profile: Name of the extraction profile
+
+        Returns:
+            Copy of the cached FeatureSet, or None if it is not cached
+        """
+        if not etag or not self.is_enabled():
+            return None
+        with self._lock:
+            entry = self._entry(blob_path, etag)
+            features = entry["features"].get(profile) if entry is not None else None
+            if features is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Callers may add fields (person_id, id) to the features they get
+            return features.copy()
+
+    def put(self, blob_path: str, etag: Optional[str], features: FeatureSet) -> None:
+        """
+        Cache the features extracted from a blob version under their profile.
+
+        Args:
+            blob_path: Path of the image in Blob Storage
+            etag: ETag the blob had before it was downloaded (nothing is cached if None)
+            features: Extracted features, tagged with their profile
+        """
+        if not etag or not self.is_enabled():
+            return
+        features = features.copy()
+        size = feature_set_bytes(features)
+        with self._lock:
+            entry = self._entry(blob_path, etag)
+            if entry is None:
+                entry = {"etag": etag, "expires": time.monotonic() + self.ttl, "size": 0, "features": {}}
+                self._entries[blob_path] = entry
+            previous = entry["features"].get(features["profile"])
+            if previous is not None:
+                entry["size"] -= feature_set_bytes(previous)
+                self.size_bytes -= feature_set_bytes(previous)
+            entry["features"][features["profile"]] = features
+            entry["size"] += size
+            self.size_bytes += size
+
+            # Evict the least recently used blobs, never the one just stored
+            while self.size_bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics.
+
+        Returns:
+            Dictionary with the cached blobs and bytes, and hit, miss and eviction counts
+        """
+        with self._lock:
+            return {
+                "blobs": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,79 @@
+"""
+Per-worker processing context holding reusable OpenCV objects and image buffers.
+"""
+import cv2
+import numpy as np
+from typing import Dict, Tuple
+
+
+class ProcessingContext:
+    """
+    Reusable state for one extraction worker.
+
+    Holds the CLAHE instance, the morphology and junction kernels, and
+    preallocated destination buffers for every pipeline stage, so that
+    steady-state feature extraction does not allocate new image arrays.
+    A context must only be used by one extraction at a time.
+    """
+    def __init__(self, standard_size: Tuple[int, int] = (256, 256)):
+        """
+        Initialize the processing context.
+
+        Args:
+            standard_size: (width, height) images are resized to before processing
+        """
+        self.standard_size = standard_size
+
+        # Reusable OpenCV objects and kernels
+        self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        self.opening_kernel = np.ones((3, 3), np.uint8)
+        self.junction_kernel = np.array([
+            [1, 1, 1],
+            [1, 10, 1],
+            [1, 1, 1]
+        ], dtype=np.uint8)
+        # Erodes the field-of-view mask past the rim where adaptive thresholding responds
+        self.fov_erosion_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
+
+        # Named destination buffers, (re)allocated only when shape or dtype changes
+        self._buffers: Dict[str, np.ndarray] = {}
+        self.allocations = 0
+
+        width, height = standard_size
+        for name in ("gray", "enhanced", "preprocessed", "threshold", "vessels",
+                     "skeleton", "junctions"):
+            self.buffer(name, (height, width), np.uint8)
+        self.buffer("vessel_mask", (height, width), np.bool_)
+        self.buffer("labels", (height, width), np.int32)
+
+    def buffer(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """
+        Get the named buffer, allocating it if it does not exist or does not fit.
+
+        Args:
+            name: Buffer name (one per pipeline stage output)
+            shape: Required array shape
+            dtype: Required array dtype
+
+        Returns:
+            Array of the requested shape and dtype (contents are undefined)
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get buffer statistics for this context.
+
+        Returns:
+            Dictionary with the number of buffers, their total size and allocation count
+        """
+        return {
+            "buffers": len(self._buffers),
+            "buffer_bytes": int(sum(buf.nbytes for buf in self._buffers.values())),
+            "allocations": self.allocations
+        }
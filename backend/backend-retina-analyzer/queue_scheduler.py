@@ -0,0 +1,200 @@
+"""
+Priority scheduling of Service Bus message handlers across queues.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+
+class QueuePolicy:
+    """
+    Scheduling policy of one queue.
+    """
+    def __init__(self, workers: int = 1, priority: int = 0, weight: int = 1, gated: bool = True,
+                 prefetch: int = 0):
+        """
+        Initialize a queue policy.
+
+        Args:
+            workers: Maximum number of messages of this queue handled at the same time
+            priority: Strict-mode priority; queues with a higher value are served first
+            weight: Weighted-mode share of execution slots relative to the other queues
+            gated: Whether handlers wait for an execution slot of the shared gate; False
+                   for queues whose handlers bound their own CPU use (e.g. by batching)
+            prefetch: Messages received ahead of the worker budget, so their images download
+                      while the workers are busy
+        """
+        self.workers = max(1, workers)
+        self.priority = priority
+        self.weight = max(1, weight)
+        self.gated = gated
+        self.prefetch = max(0, prefetch)
+
+
+class PriorityGate:
+    """
+    Async semaphore shared by all queues that hands free execution slots to
+    waiting queues by policy.
+
+    In "strict" mode a slot always goes to the waiting queue with the highest
+    priority. In "weighted" mode slots are shared by smooth weighted round
+    robin, so a low-priority queue still progresses under sustained load.
+    """
+    def __init__(self, slots: int, policies: Dict[str, QueuePolicy], mode: str = "strict"):
+        """
+        Initialize the gate.
+
+        Args:
+            slots: Number of handlers allowed to run at the same time across all queues
+            policies: Policy of each queue
+            mode: "strict" or "weighted"
+        """
+        if mode not in ("strict", "weighted"):
+            raise ValueError(f"Unknown scheduling mode: {mode}")
+        self.free = max(1, slots)
+        self.policies = policies
+        self.mode = mode
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {name: deque() for name in policies}
+        self._credit: Dict[str, int] = {name: 0 for name in policies}
+
+    def waiting(self, queue_name: str) -> int:
+        """Get the number of messages of a queue waiting for a slot."""
+        return len(self._waiters[queue_name])
+
+    async def acquire(self, queue_name: str) -> None:
+        """
+        Wait for an execution slot.
+
+        Args:
+            queue_name: Queue the message belongs to
+        """
+        if self.free > 0 and not any(self._waiters.values()):
+            self.free -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[queue_name].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before the cancellation; pass it on
+                self.release()
+            else:
+                self._waiters[queue_name].remove(future)
+            raise
+
+    def release(self) -> None:
+        """Release an execution slot, handing it to the next waiter by policy."""
+        queue_name = self._next_queue()
+        if queue_name is None:
+            self.free += 1
+            return
+        self._waiters[queue_name].popleft().set_result(None)
+
+    def _next_queue(self) -> Optional[str]:
+        """Pick the queue whose waiter gets the next slot."""
+        candidates = [name for name, waiters in self._waiters.items() if waiters]
+        if not candidates:
+            return None
+
+        if self.mode == "strict":
+            return max(candidates, key=lambda name: self.policies[name].priority)
+
+        # Smooth weighted round robin over the queues with waiters
+        total = 0
+        for name in candidates:
+            self._credit[name] += self.policies[name].weight
+            total += self.policies[name].weight
+        chosen = max(candidates, key=lambda name: self._credit[name])
+        self._credit[chosen] -= total
+        return chosen
+
+
+class QueueMetrics:
+    """
+    Lag and throughput statistics of one queue.
+
+    Lag is the time from a message being enqueued to its handler starting, so
+    it includes time spent waiting for a worker or an execution slot.
+    """
+    def __init__(self, smoothing: float = 0.2):
+        """
+        Initialize empty queue metrics.
+
+        Args:
+            smoothing: Weight of the newest sample in the lag moving average
+        """
+        self.smoothing = smoothing
+        self.received = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.total_processing_ms = 0.0
+        self.throttled_seconds = 0.0
+        self._last_sample = 0.0
+
+    def record_start(self, lag_ms: float) -> None:
+        """
+        Record a handler starting.
+
+        Args:
+            lag_ms: Time the message waited since it was enqueued, in milliseconds
+        """
+        self.received += 1
+        self.in_flight += 1
+        lag_ms = max(0.0, lag_ms)
+        self.lag_ms = lag_ms if self.received == 1 else (1 - self.smoothing) * self.lag_ms + self.smoothing * lag_ms
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        self._last_sample = time.monotonic()
+
+    def record_end(self, processing_ms: float, success: bool) -> None:
+        """
+        Record a handler finishing.
+
+        Args:
+            processing_ms: Handler and settlement time in milliseconds
+            success: Whether the message was completed (False if it was abandoned)
+        """
+        self.in_flight -= 1
+        self.total_processing_ms += processing_ms
+        if success:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def recent_lag_ms(self, window: float = 10.0) -> float:
+        """
+        Get the lag moving average, or 0 if the queue has been idle for longer than window seconds.
+
+        Args:
+            window: Seconds after the last sample the average is considered current
+
+        Returns:
+            Recent lag in milliseconds
+        """
+        if self.in_flight == 0 and time.monotonic() - self._last_sample > window:
+            return 0.0
+        return self.lag_ms
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Get the current statistics.
+
+        Returns:
+            Dictionary of counters, lag and mean processing time
+        """
+        finished = self.completed + self.failed
+        return {
+            "received": self.received,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+            "lag_ms": round(self.recent_lag_ms(), 1),
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "mean_processing_ms": round(self.total_processing_ms / finished, 1) if finished else 0.0,
+            "throttled_seconds": round(self.throttled_seconds, 1)
+        }
@@ -3,34 +3,44 @@ Retina image processing module for feature extraction and comparison.
 """
 import cv2
 import numpy as np
-from skimage.feature import local_binary_pattern
-from skimage.feature import hog
-from skimage.measure import regionprops
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import Dict, List, Tuple, Any, Optional, Union
-from scipy.spatial import distance
-from skimage.morphology import skeletonize
-from skimage.feature import peak_local_max
-import json
+from typing import Callable, Dict, List, Tuple, Any, Optional, Union
 import os
 import base64
 from datetime import datetime
 import functools
 import time
+import threading
 from cosmos_db import CosmosDBClient
+from feature_set import FeatureSet, as_feature_set
+from processing_context import ProcessingContext
+from extraction_profiles import (
+    EXTRACTOR_VERSION, ExtractionProfile, ProfileMismatchError,
+    get_profile, get_template_profile, convert_features
+)
+from stage_executor import StageGraph, StageMetrics, configure_opencv_threads
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 
 class RetinaProcessor:
     """
     Class for processing retina images, extracting features, and comparing them.
     """
-    def __init__(self):
-        """Initialize the retina processor with default parameters."""
+    def __init__(self, profile: Optional[str] = None):
+        """
+        Initialize the retina processor with default parameters.
+        
+        Args:
+            profile: Name of the default extraction profile (see extraction_profiles.PROFILES);
+                     defaults to the RETINA_PROFILE environment variable, then "standard"
+        """
         self.blood_vessel_threshold = 30
         self.similarity_threshold = 0.95  # Threshold for determining if two retinas match
-        self.standard_size = (256, 256)  # Reduced standard size for faster processing (was 512x512)
-        self.bifurcation_distance_threshold = 10  # Max distance for matching bifurcation points
-        self.grid_size = (8, 8)  # Grid size for spatial vessel distribution analysis
+        # Image size, grid sizes and point caps come from the extraction profile
+        self.profile = get_profile(profile)
+        self.optic_disc_radius_range = (0.035, 0.1)  # Optic disc radius as a fraction of the image width
+        self.optic_disc_pyramid_levels = 2  # Downsampling levels for the coarse candidate search
+        self.optic_disc_candidates = 3  # Bright regions checked with the Hough transform
+        self.fov_thumbnail_size = 64  # Longest thumbnail side used to locate the field of view
         
         # Create directory for storing retina data
         os.makedirs("retina_data", exist_ok=True)
@@ -39,9 +49,28 @@ class RetinaProcessor:
         self._feature_cache = {}
         self._cache_hits = 0
         self._cache_misses = 0
+        self._cache_lock = threading.Lock()
+        
+        # Per-thread processing contexts (reusable CLAHE, kernels and buffers)
+        self._local = threading.local()
+        
+        # Thread pool running independent extraction stages of one image concurrently.
+        # RETINA_CONCURRENCY is the number of images extracted at the same time in this
+        # process and WEB_CONCURRENCY the number of uvicorn worker processes; OpenCV's own
+        # threads are divided between all levels of parallelism.
+        self.stage_workers = max(1, int(os.getenv("RETINA_STAGE_WORKERS", str(min(4, os.cpu_count() or 1)))))
+        self.concurrent_images = max(1, int(os.getenv("RETINA_CONCURRENCY", "1")))
+        self.worker_processes = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        self.opencv_threads = configure_opencv_threads(self.stage_workers, self.concurrent_images, self.worker_processes)
+        self._stage_executor = (
+            ThreadPoolExecutor(max_workers=self.stage_workers * self.concurrent_images, thread_name_prefix="retina-stage")
+            if self.stage_workers > 1 else None
+        )
+        self.stage_metrics = StageMetrics()
         
-        # Initialize Cosmos DB client
-        self.cosmos_client = CosmosDBClient()
+        # Cosmos DB client, connected on first use (see the cosmos_client property)
+        self._cosmos_client: Optional[CosmosDBClient] = None
+        self._cosmos_lock = threading.Lock()
     
     # Performance monitoring decorator
     def _time_function(func):
@@ -57,132 +86,414 @@ class RetinaProcessor:
             return result
         return wrapper
     
+    @property
+    def standard_size(self) -> Tuple[int, int]:
+        """Standard image size of the default profile."""
+        return self.profile.standard_size
+    
+    @property
+    def grid_size(self) -> Tuple[int, int]:
+        """Spatial distribution grid size of the default profile."""
+        return self.profile.grid_size
+    
+    @property
+    def bifurcation_distance_threshold(self) -> int:
+        """Bifurcation matching distance of the default profile."""
+        return self.profile.bifurcation_distance_threshold
+    
+    @property
+    def fov_crop(self) -> bool:
+        """Whether the default profile crops to the field of view."""
+        return self.profile.fov_crop
+    
+    @property
+    def cosmos_client(self) -> CosmosDBClient:
+        """Cosmos DB client, created (and connected) on first access."""
+        if self._cosmos_client is None:
+            with self._cosmos_lock:
+                if self._cosmos_client is None:
+                    self._cosmos_client = CosmosDBClient()
+        return self._cosmos_client
+    
+    def _get_context(self, profile: Optional[ExtractionProfile] = None) -> ProcessingContext:
+        """
+        Get the processing context of the calling thread for a profile's image size,
+        creating it on first use.
+        
+        Args:
+            profile: Extraction profile (defaults to the processor's profile)
+            
+        Returns:
+            ProcessingContext sized to the profile's standard image size
+        """
+        standard_size = (profile or self.profile).standard_size
+        contexts = getattr(self._local, "contexts", None)
+        if contexts is None:
+            contexts = self._local.contexts = {}
+        ctx = contexts.get(standard_size)
+        if ctx is None:
+            ctx = contexts[standard_size] = ProcessingContext(standard_size)
+        return ctx
+    
+    @staticmethod
+    def _dst(ctx: Optional[ProcessingContext], name: str, shape: Tuple[int, ...], dtype=np.uint8) -> Optional[np.ndarray]:
+        """
+        Get a destination buffer from the context, or None to let OpenCV allocate.
+        
+        Args:
+            ctx: Processing context, or None when the caller needs a fresh array
+            name: Buffer name
+            shape: Buffer shape
+            dtype: Buffer dtype
+            
+        Returns:
+            Preallocated buffer or None
+        """
+        return ctx.buffer(name, shape, dtype) if ctx is not None else None
+    
+    def locate_field_of_view(self, image: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Locate the bounding box of the retina's circular field of view on a thumbnail.
+        
+        Args:
+            image: Input retina image as numpy array
+            
+        Returns:
+            Bounding box (x, y, width, height) in image coordinates, or None if no
+            field of view could be separated from the background
+        """
+        h, w = image.shape[:2]
+        scale = self.fov_thumbnail_size / max(h, w)
+        thumbnail = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        if len(thumbnail.shape) > 2:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        
+        # The background is close to black; anything clearly brighter belongs to the retina
+        threshold = max(10.0, 0.1 * float(np.percentile(thumbnail, 99)))
+        points = cv2.findNonZero((thumbnail > threshold).astype(np.uint8))
+        if points is None:
+            return None
+        
+        x, y, bw, bh = cv2.boundingRect(points)
+        # Map back to full resolution with a one-thumbnail-pixel margin
+        x0, y0 = max(0, int((x - 1) / scale)), max(0, int((y - 1) / scale))
+        x1, y1 = min(w, int(np.ceil((x + bw + 1) / scale))), min(h, int(np.ceil((y + bh + 1) / scale)))
+        return (x0, y0, x1 - x0, y1 - y0)
+    
+    def crop_to_field_of_view(self, image: np.ndarray, aspect: float = 1.0) -> np.ndarray:
+        """
+        Crop the image to the bounding box of its field of view, padded to the target aspect ratio.
+        
+        The box is widened (or heightened) around its center so that resizing
+        the crop to the standard size scales both axes alike and does not
+        distort the vessel geometry. Where the widened box leaves the image,
+        it is padded with black, like the background around the retina.
+        
+        Args:
+            image: Input retina image as numpy array
+            aspect: Width / height ratio of the size the crop is resized to
+            
+        Returns:
+            Crop of the image around the field of view (the image itself if none was found);
+            a view unless it had to be padded
+        """
+        bbox = self.locate_field_of_view(image)
+        if bbox is None:
+            return image
+        x, y, w, h = bbox
+        
+        # Grow the shorter side of the box around its center to the target aspect ratio
+        if w < h * aspect:
+            grown = int(round(h * aspect))
+            x -= (grown - w) // 2
+            w = grown
+        elif w > h * aspect:
+            grown = int(round(w / aspect))
+            y -= (grown - h) // 2
+            h = grown
+        
+        img_h, img_w = image.shape[:2]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(img_w, x + w), min(img_h, y + h)
+        crop = image[y0:y1, x0:x1]
+        if (x0, y0, x1, y1) == (x, y, x + w, y + h):
+            return crop
+        return cv2.copyMakeBorder(crop, y0 - y, y + h - y1, x0 - x, x + w - x1, cv2.BORDER_CONSTANT, value=0)
+    
+    def compute_fov_mask(self, preprocessed: np.ndarray, ctx: Optional[ProcessingContext] = None) -> np.ndarray:
+        """
+        Compute the field-of-view mask of a preprocessed image.
+        
+        Args:
+            preprocessed: Preprocessed retina image
+            ctx: Optional processing context whose buffers receive the mask
+            
+        Returns:
+            Binary mask (255 inside the field of view), eroded past the border rim
+        """
+        shared = ctx or self._get_context()
+        mask = cv2.threshold(preprocessed, 10, 255, cv2.THRESH_BINARY, dst=self._dst(ctx, "fov_threshold", preprocessed.shape))[1]
+        # A constant zero border also erodes the mask where the retina is cut off by the frame
+        return cv2.erode(
+            mask, shared.fov_erosion_kernel, dst=self._dst(ctx, "fov_mask", preprocessed.shape),
+            borderType=cv2.BORDER_CONSTANT, borderValue=0
+        )
+    
     @_time_function
-    def preprocess_image(self, image: np.ndarray) -> np.ndarray:
+    def preprocess_image(self, image: np.ndarray, ctx: Optional[ProcessingContext] = None,
+                         profile: Optional[ExtractionProfile] = None) -> np.ndarray:
         """
         Preprocess the retina image for feature extraction.
         
         Args:
             image: Input retina image as numpy array
+            ctx: Optional processing context whose buffers receive the output.
+                 Without it a new array is returned.
+            profile: Extraction profile (defaults to the processor's profile)
             
         Returns:
             Preprocessed image
         """
+        profile = profile or self.profile
+        width, height = profile.standard_size
+        shared = ctx or self._get_context(profile)
+        
+        # Drop the black border around the field of view before resizing
+        if profile.fov_crop:
+            image = self.crop_to_field_of_view(image, aspect=width / height)
+        
         # Resize the image to standard size
-        resized = cv2.resize(image, self.standard_size, interpolation=cv2.INTER_AREA)
+        resized = cv2.resize(
+            image, profile.standard_size,
+            dst=self._dst(ctx, "resized", (height, width) + image.shape[2:], image.dtype),
+            interpolation=cv2.INTER_AREA
+        )
         
         # Convert to grayscale if it's a color image
         if len(resized.shape) > 2:
-            gray = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY, dst=self._dst(ctx, "gray", (height, width)))
         else:
-            gray = resized.copy()
+            gray = resized
         
         # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(gray)
+        enhanced = shared.clahe.apply(gray, dst=self._dst(ctx, "enhanced", (height, width)))
         
         # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(enhanced, (5, 5), 0)
+        blurred = cv2.GaussianBlur(enhanced, (5, 5), 0, dst=self._dst(ctx, "preprocessed", (height, width)))
         
         return blurred
     
     @_time_function
-    def extract_blood_vessels(self, image: np.ndarray) -> np.ndarray:
+    def extract_blood_vessels(self, image: np.ndarray, ctx: Optional[ProcessingContext] = None,
+                              mask: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Extract blood vessels from the retina image.
         
         Args:
             image: Preprocessed retina image
+            ctx: Optional processing context whose buffers receive the output
+            mask: Optional field-of-view mask; vessels outside it are discarded
             
         Returns:
             Binary image with blood vessels
         """
+        shared = ctx or self._get_context()
+        
         # Apply adaptive thresholding to highlight blood vessels
         thresh = cv2.adaptiveThreshold(
             image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY_INV, 11, 2
+            cv2.THRESH_BINARY_INV, 11, 2,
+            dst=self._dst(ctx, "threshold", image.shape)
         )
         
         # Apply morphological operations to enhance blood vessels
-        kernel = np.ones((3, 3), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=1)
+        opening = cv2.morphologyEx(
+            thresh, cv2.MORPH_OPEN, shared.opening_kernel,
+            dst=self._dst(ctx, "vessels", image.shape), iterations=1
+        )
+        if mask is not None:
+            cv2.bitwise_and(opening, mask, dst=opening)
         
         return opening
     
+    def _find_optic_disc_candidates(self, image: np.ndarray) -> List[Tuple[int, int, float]]:
+        """
+        Find candidate bright regions for the optic disc on a downsampled pyramid level.
+        
+        Args:
+            image: Preprocessed retina image
+            
+        Returns:
+            List of (x, y, response) candidates in full-resolution coordinates,
+            strongest first
+        """
+        coarse = image
+        for _ in range(self.optic_disc_pyramid_levels):
+            coarse = cv2.pyrDown(coarse)
+        scale = image.shape[1] / coarse.shape[1]
+        radius = self.optic_disc_radius_range[1] * coarse.shape[1] * 0.6
+        
+        # Difference of Gaussians tuned to the disc size, normalized by the field-of-view
+        # mask so the bright side of the black border does not respond like a disc
+        fov = (coarse > 20).astype(np.float32)
+        weighted = coarse.astype(np.float32) * fov
+        
+        def masked_blur(sigma: float) -> np.ndarray:
+            return cv2.GaussianBlur(weighted, (0, 0), sigma) / (cv2.GaussianBlur(fov, (0, 0), sigma) + 1e-3)
+        
+        response = (masked_blur(radius * 0.7) - masked_blur(radius * 2.5)) * fov
+        
+        candidates = []
+        for _ in range(self.optic_disc_candidates):
+            _, max_val, _, max_loc = cv2.minMaxLoc(response)
+            if max_val <= 0:
+                break
+            candidates.append((int(max_loc[0] * scale), int(max_loc[1] * scale), float(max_val)))
+            # Suppress this region so the next candidate is a different blob
+            cv2.circle(response, max_loc, int(radius * 3), 0, thickness=-1)
+        
+        return candidates
+    
+    def _optic_disc_confidence(self, image: np.ndarray, center: Tuple[int, int], radius: int) -> float:
+        """
+        Score a detected circle by the contrast between the disc and its surrounding ring.
+        
+        Args:
+            image: Preprocessed retina image
+            center: Circle centre (x, y)
+            radius: Circle radius
+            
+        Returns:
+            Confidence between 0 and 1
+        """
+        x, y = center
+        outer = int(radius * 1.5)
+        x0, y0 = max(0, x - outer), max(0, y - outer)
+        x1, y1 = min(image.shape[1], x + outer + 1), min(image.shape[0], y + outer + 1)
+        window = image[y0:y1, x0:x1]
+        
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        dist_sq = (xx - x) ** 2 + (yy - y) ** 2
+        inside = dist_sq <= radius ** 2
+        ring = (dist_sq > radius ** 2) & (dist_sq <= outer ** 2)
+        if not inside.any() or not ring.any():
+            return 0.0
+        
+        contrast = (float(window[inside].mean()) - float(window[ring].mean())) / 255.0
+        # A contrast of a quarter of the intensity range counts as a certain detection
+        return float(np.clip(contrast * 4.0, 0.0, 1.0))
+    
     @_time_function
-    def detect_optic_disc(self, image: np.ndarray) -> Tuple[Optional[Tuple[int, int]], Optional[int]]:
+    def detect_optic_disc(self, image: np.ndarray) -> Tuple[Optional[Tuple[int, int]], Optional[int], float]:
         """
-        Detect the optic disc in the retina image.
+        Detect the optic disc in the retina image with a coarse-to-fine search.
+        
+        Bright candidate regions are located on a downsampled pyramid level, and
+        the Hough Circle Transform is only run in small windows around them.
         
         Args:
             image: Preprocessed retina image
             
         Returns:
-            Tuple containing (center_x, center_y) and radius of the optic disc,
-            or (None, None) if not detected
+            Tuple containing (center_x, center_y), radius and confidence of the optic disc,
+            or (None, None, 0.0) if not detected
         """
-        # Apply Hough Circle Transform to detect the optic disc
-        circles = cv2.HoughCircles(
-            image, cv2.HOUGH_GRADIENT, dp=1, minDist=50,
-            param1=50, param2=30, minRadius=10, maxRadius=50  # Adjusted for smaller image size
-        )
+        start_time = time.perf_counter()
+        candidates = self._find_optic_disc_candidates(image)
+        coarse_time = time.perf_counter()
+        self.stage_metrics.record("optic_disc.coarse", coarse_time - start_time)
+        
+        min_radius = max(1, int(self.optic_disc_radius_range[0] * image.shape[1]))
+        max_radius = max(min_radius + 1, int(self.optic_disc_radius_range[1] * image.shape[1]))
+        half_window = int(max_radius * 1.5)
+        
+        best = (None, None, 0.0)
+        top_response = candidates[0][2] if candidates else 1.0
+        for cx, cy, response in candidates:
+            x0, y0 = max(0, cx - half_window), max(0, cy - half_window)
+            x1, y1 = min(image.shape[1], cx + half_window), min(image.shape[0], cy + half_window)
+            
+            # Apply Hough Circle Transform only inside the candidate window
+            circles = cv2.HoughCircles(
+                image[y0:y1, x0:x1], cv2.HOUGH_GRADIENT, dp=1, minDist=half_window,
+                param1=50, param2=20, minRadius=min_radius, maxRadius=max_radius
+            )
+            if circles is not None:
+                # Most voted circle of this window, in full-image coordinates
+                x, y, r = np.around(circles[0, 0]).astype(int)
+                center, radius = (int(x + x0), int(y + y0)), int(r)
+                confidence = self._optic_disc_confidence(image, center, radius)
+            else:
+                # Keep the bright region itself as a weaker detection
+                center, radius = (cx, cy), (min_radius + max_radius) // 2
+                confidence = 0.5 * self._optic_disc_confidence(image, center, radius)
+            
+            # Weaker coarse responses are less likely to be the disc
+            confidence *= response / top_response
+            if confidence > best[2]:
+                best = (center, radius, confidence)
         
-        if circles is not None:
-            circles = np.uint16(np.around(circles))
-            # Get the most prominent circle (likely the optic disc)
-            x, y, r = circles[0, 0]
-            return ((x, y), r)
+        self.stage_metrics.record("optic_disc.hough", time.perf_counter() - coarse_time)
         
-        return (None, None)
+        return best
     
     @_time_function
-    def detect_bifurcation_points(self, blood_vessels: np.ndarray) -> List[Tuple[int, int]]:
+    def detect_bifurcation_points(self, blood_vessels: np.ndarray, ctx: Optional[ProcessingContext] = None,
+                                  profile: Optional[ExtractionProfile] = None) -> List[Tuple[int, int]]:
         """
         Detect bifurcation points in the blood vessel network.
         
         Args:
             blood_vessels: Binary image with blood vessels
+            ctx: Optional processing context providing intermediate buffers
+            profile: Extraction profile (defaults to the processor's profile)
             
         Returns:
             List of (x, y) coordinates of bifurcation points
         """
-        # Create a skeleton of the blood vessels
-        skeleton = skeletonize(blood_vessels > 0).astype(np.uint8) * 255
+        profile = profile or self.profile
+        shared = ctx or self._get_context(profile)
+        
+        from skimage.morphology import skeletonize
+        from skimage.feature import peak_local_max
         
-        # Define kernel for detecting bifurcation points
-        kernel = np.array([
-            [1, 1, 1],
-            [1, 10, 1],
-            [1, 1, 1]
-        ], dtype=np.uint8)
+        # Create a skeleton of the blood vessels
+        vessel_mask = np.greater(blood_vessels, 0, out=self._dst(ctx, "vessel_mask", blood_vessels.shape, np.bool_))
+        skeleton = np.multiply(
+            skeletonize(vessel_mask), 255,
+            out=self._dst(ctx, "skeleton", blood_vessels.shape), dtype=np.uint8
+        )
         
-        # Apply the kernel to detect junction points
-        result = cv2.filter2D(skeleton, -1, kernel)
+        # Apply the junction kernel to detect junction points
+        result = cv2.filter2D(skeleton, -1, shared.junction_kernel, dst=self._dst(ctx, "junctions", blood_vessels.shape))
         
         # Find points with value > 12 (central pixel + at least 3 neighbors)
         # Limit the number of points for faster processing
-        max_points = 50
+        max_points = profile.max_bifurcation_points
         bifurcation_points = peak_local_max(
             result, min_distance=5, threshold_abs=12, exclude_border=False,
             num_peaks=max_points  # Limit number of points
         )
         
         # Convert to list of (x, y) tuples
-        return [(x, y) for y, x in bifurcation_points]
+        return [(int(x), int(y)) for y, x in bifurcation_points]
     
     @_time_function
-    def analyze_vessel_spatial_distribution(self, blood_vessels: np.ndarray) -> np.ndarray:
+    def analyze_vessel_spatial_distribution(self, blood_vessels: np.ndarray, mask: Optional[np.ndarray] = None,
+                                            profile: Optional[ExtractionProfile] = None) -> np.ndarray:
         """
         Analyze the spatial distribution of blood vessels using a grid-based approach.
         
         Args:
             blood_vessels: Binary image with blood vessels
+            mask: Optional field-of-view mask; densities are relative to its area per cell
+            profile: Extraction profile (defaults to the processor's profile)
             
         Returns:
             Grid-based vessel density histogram
         """
         # Create a grid
-        grid_h, grid_w = self.grid_size
+        grid_h, grid_w = (profile or self.profile).grid_size
         h, w = blood_vessels.shape
         cell_h, cell_w = h // grid_h, w // grid_w
         
@@ -191,80 +502,119 @@ class RetinaProcessor:
         
         for i in range(grid_h):
             for j in range(grid_w):
-                # Get the cell region
+                # Get the cell region (a view, no copy)
                 cell = blood_vessels[i*cell_h:(i+1)*cell_h, j*cell_w:(j+1)*cell_w]
+                cell_area = cell_h * cell_w
+                if mask is not None:
+                    cell_area = cv2.countNonZero(mask[i*cell_h:(i+1)*cell_h, j*cell_w:(j+1)*cell_w])
                 # Calculate vessel density in this cell
-                grid_densities[i, j] = np.sum(cell > 0) / (cell_h * cell_w)
+                grid_densities[i, j] = cv2.countNonZero(cell) / cell_area if cell_area else 0.0
         
         # Flatten the grid to create a feature vector
         return grid_densities.flatten()
     
-    def _get_image_hash(self, image: np.ndarray) -> str:
+    def _get_image_hash(self, image: np.ndarray, ctx: Optional[ProcessingContext] = None) -> str:
         """
         Generate a hash for an image to use as a cache key.
         
         Args:
             image: Input image
+            ctx: Optional processing context providing the thumbnail buffers
             
         Returns:
             Hash string
         """
         # Resize to tiny image for faster hashing
-        tiny = cv2.resize(image, (32, 32))
+        tiny = cv2.resize(image, (32, 32), dst=self._dst(ctx, "hash_tiny", (32, 32) + image.shape[2:], image.dtype))
         # Convert to grayscale if needed
         if len(tiny.shape) > 2:
-            tiny = cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY)
+            tiny = cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY, dst=self._dst(ctx, "hash_gray", (32, 32)))
         # Calculate hash
         return str(hash(tiny.tobytes()))
     
     @_time_function
-    def extract_features(self, image: np.ndarray) -> Dict[str, Any]:
+    def extract_lbp_histogram(self, image: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
         """
-        Extract features from a retina image.
+        Extract a normalized LBP (Local Binary Pattern) histogram.
         
         Args:
-            image: Input retina image as numpy array
+            image: Preprocessed retina image
+            mask: Optional field-of-view mask; only pixels inside it are counted
             
         Returns:
-            Dictionary of extracted features
+            Normalized 8-bin LBP histogram
         """
-        # Check if we've already processed this image
-        image_hash = self._get_image_hash(image)
-        if image_hash in self._feature_cache:
-            self._cache_hits += 1
-            print(f"Cache hit! Hits: {self._cache_hits}, Misses: {self._cache_misses}")
-            return self._feature_cache[image_hash]
+        from skimage.feature import local_binary_pattern
         
-        self._cache_misses += 1
-        print(f"Cache miss. Hits: {self._cache_hits}, Misses: {self._cache_misses}")
-        
-        # Preprocess the image (includes resizing to standard size)
-        preprocessed = self.preprocess_image(image)
-        
-        # Extract blood vessels
-        blood_vessels = self.extract_blood_vessels(preprocessed)
-        
-        # Detect optic disc
-        optic_disc_center, optic_disc_radius = self.detect_optic_disc(preprocessed)
-        
-        # Extract LBP (Local Binary Pattern) features - use smaller number of bins
-        lbp_features = local_binary_pattern(preprocessed, P=8, R=1, method='uniform')
+        # Use smaller number of bins
+        lbp_features = local_binary_pattern(image, P=8, R=1, method='uniform')
+        if mask is not None:
+            lbp_features = lbp_features[mask > 0]
         lbp_hist, _ = np.histogram(lbp_features, bins=8, range=(0, 8))  # Reduced from 10 to 8 bins
         lbp_hist = lbp_hist.astype(float)
         lbp_hist /= (lbp_hist.sum() + 1e-7)  # Normalize
+        return lbp_hist
+    
+    @_time_function
+    def extract_hog_features(self, image: np.ndarray, mask: Optional[np.ndarray] = None,
+                             profile: Optional[ExtractionProfile] = None) -> np.ndarray:
+        """
+        Extract HOG (Histogram of Oriented Gradients) features with reduced complexity.
         
-        # Extract HOG (Histogram of Oriented Gradients) features with reduced complexity
-        hog_features = hog(
-            preprocessed, orientations=6,  # Reduced from 8
-            pixels_per_cell=(32, 32),  # Increased from 16x16
-            cells_per_block=(1, 1), visualize=False, feature_vector=True
+        Args:
+            image: Preprocessed retina image
+            mask: Optional field-of-view mask; cells mostly outside it are zeroed
+            profile: Extraction profile (defaults to the processor's profile)
+            
+        Returns:
+            HOG feature vector
+        """
+        from skimage.feature import hog
+        
+        profile = profile or self.profile
+        # Cells cover a fixed fraction of the image (32x32 pixels at 256x256)
+        cell_h, cell_w = profile.hog_pixels_per_cell
+        features = hog(
+            image, orientations=profile.hog_orientations,
+            pixels_per_cell=(cell_h, cell_w),
+            cells_per_block=(1, 1), visualize=False, feature_vector=mask is None
         )
+        if mask is None:
+            return features
+        
+        # Fraction of each cell inside the field of view
+        rows, cols = features.shape[:2]
+        coverage = cv2.resize(mask[:rows * cell_h, :cols * cell_w], (cols, rows), interpolation=cv2.INTER_AREA) / 255.0
+        features[coverage < 0.5] = 0
+        return features.ravel()
+    
+    @_time_function
+    def analyze_vessel_morphology(self, blood_vessels: np.ndarray, ctx: Optional[ProcessingContext] = None,
+                                  mask: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """
+        Calculate vessel density and region properties of the vessel network.
+        
+        Args:
+            blood_vessels: Binary image with blood vessels
+            ctx: Optional processing context providing the label buffer
+            mask: Optional field-of-view mask; density is relative to its area
+            
+        Returns:
+            Dictionary with vessel density, average length and width, and vessel count
+        """
+        from skimage.measure import regionprops
         
         # Calculate blood vessel density
-        blood_vessel_density = np.sum(blood_vessels > 0) / (blood_vessels.shape[0] * blood_vessels.shape[1])
+        area = cv2.countNonZero(mask) if mask is not None else blood_vessels.shape[0] * blood_vessels.shape[1]
+        blood_vessel_density = cv2.countNonZero(blood_vessels) / area if area else 0.0
         
         # Extract region properties of blood vessels
-        labeled_vessels = cv2.connectedComponents(blood_vessels)[1]
+        labeled_vessels = cv2.connectedComponents(
+            blood_vessels, labels=self._dst(ctx, "labels", blood_vessels.shape, np.int32)
+        )[1]
+        avg_vessel_length = 0
+        avg_vessel_width = 0
+        vessel_count = 0
         if np.max(labeled_vessels) > 0:  # Check if any vessels were detected
             props = regionprops(labeled_vessels)
             
@@ -277,72 +627,210 @@ class RetinaProcessor:
                 avg_vessel_length = np.mean([max(prop.major_axis_length, 1) for prop in props if hasattr(prop, 'major_axis_length')])
                 avg_vessel_width = np.mean([max(prop.minor_axis_length, 1) for prop in props if hasattr(prop, 'minor_axis_length')])
                 vessel_count = len(props)
-            else:
-                avg_vessel_length = 0
-                avg_vessel_width = 0
-                vessel_count = 0
-        else:
-            avg_vessel_length = 0
-            avg_vessel_width = 0
-            vessel_count = 0
         
-        # Detect bifurcation points in blood vessels
-        bifurcation_points = self.detect_bifurcation_points(blood_vessels)
+        return {
+            "blood_vessel_density": float(blood_vessel_density),
+            "avg_vessel_length": float(avg_vessel_length),
+            "avg_vessel_width": float(avg_vessel_width),
+            "vessel_count": int(vessel_count)
+        }
+    
+    def _build_stage_graph(self, ctx: ProcessingContext, profile: ExtractionProfile) -> StageGraph:
+        """
+        Build the feature extraction stage graph for one image.
+        
+        Stages only depending on the preprocessed image (vessels, optic disc,
+        LBP, HOG) run concurrently, as do the vessel-based stages after them.
+        Each stage writes into its own buffers of the context.
+        
+        Args:
+            ctx: Processing context of the calling thread
+            profile: Extraction profile
+            
+        Returns:
+            StageGraph producing all feature components
+        """
+        graph = StageGraph()
+        graph.add_stage("blood_vessels", lambda preprocessed, fov_mask: self.extract_blood_vessels(preprocessed, ctx, fov_mask), ["preprocessed", "fov_mask"])
+        graph.add_stage("optic_disc", lambda preprocessed: self.detect_optic_disc(preprocessed), ["preprocessed"])
+        graph.add_stage("lbp", lambda preprocessed, fov_mask: self.extract_lbp_histogram(preprocessed, fov_mask), ["preprocessed", "fov_mask"])
+        graph.add_stage("hog", lambda preprocessed, fov_mask: self.extract_hog_features(preprocessed, fov_mask, profile), ["preprocessed", "fov_mask"])
+        graph.add_stage("vessel_morphology", lambda blood_vessels, fov_mask: self.analyze_vessel_morphology(blood_vessels, ctx, fov_mask), ["blood_vessels", "fov_mask"])
+        graph.add_stage("bifurcation_points", lambda blood_vessels: self.detect_bifurcation_points(blood_vessels, ctx, profile), ["blood_vessels"])
+        graph.add_stage("vessel_spatial", lambda blood_vessels, fov_mask: self.analyze_vessel_spatial_distribution(blood_vessels, fov_mask, profile), ["blood_vessels", "fov_mask"])
+        return graph
+    
+    def get_stage_metrics(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get aggregated execution times of the extraction stages.
+        
+        Returns:
+            Dictionary mapping stage names to count, mean and max time in milliseconds
+        """
+        return self.stage_metrics.snapshot()
+    
+    def warm_up(self, profiles: Optional[List[Union[str, ExtractionProfile]]] = None) -> Dict[str, float]:
+        """
+        Run one synthetic extraction and comparison per profile.
+        
+        Imports the lazily loaded scikit-image, scikit-learn and SciPy modules,
+        sizes the calling thread's buffers and loads OpenCV's code paths, so
+        that the first real request does not pay for them.
         
-        # Analyze spatial distribution of blood vessels
-        vessel_spatial_distribution = self.analyze_vessel_spatial_distribution(blood_vessels).tolist()
+        Args:
+            profiles: Profiles or profile names to warm up (defaults to the processor's profile)
+            
+        Returns:
+            Dictionary mapping profile names to warm-up time in seconds
+        """
+        # Synthetic fundus: bright disc on black background with dark vessel-like lines
+        rng = np.random.default_rng(0)
+        size = 512
+        image = np.zeros((size, size, 3), dtype=np.uint8)
+        cv2.circle(image, (size // 2, size // 2), int(size * 0.45), (40, 80, 160), -1)
+        for angle in np.linspace(0, np.pi, 6, endpoint=False):
+            dx, dy = int(np.cos(angle) * size * 0.4), int(np.sin(angle) * size * 0.4)
+            cv2.line(image, (size // 2 - dx, size // 2 - dy), (size // 2 + dx, size // 2 + dy), (20, 40, 90), 3)
+        cv2.circle(image, (int(size * 0.65), size // 2), int(size * 0.06), (150, 200, 230), -1)
+        image = cv2.add(image, rng.integers(0, 12, image.shape, dtype=np.uint8))
+        
+        timings = {}
+        for profile in profiles or [self.profile]:
+            if isinstance(profile, str):
+                profile = get_profile(profile)
+            start_time = time.perf_counter()
+            features = self.extract_features(image, use_cache=False, profile=profile)
+            self.compare_features(features, features)
+            timings[profile.name] = time.perf_counter() - start_time
+        
+        # Synthetic extractions are not part of the service's stage statistics
+        self.stage_metrics.reset()
+        return timings
+    
+    @_time_function
+    def extract_features(self, image: np.ndarray, use_cache: bool = True,
+                         profile: Optional[Union[str, ExtractionProfile]] = None) -> FeatureSet:
+        """
+        Extract features from a retina image.
+        
+        Args:
+            image: Input retina image as numpy array
+            use_cache: Whether to look up and store the result in the feature cache
+            profile: Extraction profile or its name (defaults to the processor's profile)
+            
+        Returns:
+            FeatureSet of extracted features, tagged with profile and extractor version
+        """
+        if isinstance(profile, str):
+            profile = get_profile(profile)
+        profile = profile or self.profile
+        
+        # Intermediate images are written into this thread's preallocated buffers
+        ctx = self._get_context(profile)
+        
+        # Check if we've already processed this image with this profile
+        image_hash = f"{profile.name}:{self._get_image_hash(image, ctx)}"
+        with self._cache_lock:
+            if use_cache and image_hash in self._feature_cache:
+                self._cache_hits += 1
+                print(f"Cache hit! Hits: {self._cache_hits}, Misses: {self._cache_misses}")
+                return self._feature_cache[image_hash]
+            
+            self._cache_misses += 1
+            print(f"Cache miss. Hits: {self._cache_hits}, Misses: {self._cache_misses}")
+        
+        # Preprocess the image (includes resizing to standard size)
+        start_time = time.perf_counter()
+        preprocessed = self.preprocess_image(image, ctx, profile)
+        # With field-of-view cropping, every later stage skips the background
+        fov_mask = self.compute_fov_mask(preprocessed, ctx) if profile.fov_crop else None
+        self.stage_metrics.record("preprocess", time.perf_counter() - start_time)
+        
+        # Run the independent extraction stages on the stage pool
+        stages = self._build_stage_graph(ctx, profile).run(
+            {"preprocessed": preprocessed, "fov_mask": fov_mask},
+            executor=self._stage_executor,
+            metrics=self.stage_metrics
+        )
+        
+        optic_disc_center, optic_disc_radius, optic_disc_confidence = stages["optic_disc"]
         
         # Generate a unique ID for this feature set
         feature_id = str(uuid.uuid4())
         
-        # Compile all features into a dictionary
-        features = {
-            "id": feature_id,
-            "lbp_histogram": lbp_hist.tolist(),
-            "hog_features": hog_features.tolist(),
-            "blood_vessel_density": float(blood_vessel_density),
-            "avg_vessel_length": float(avg_vessel_length),
-            "avg_vessel_width": float(avg_vessel_width),
-            "vessel_count": int(vessel_count),
-            "optic_disc_center": optic_disc_center,
-            "optic_disc_radius": optic_disc_radius,
-            "bifurcation_points": bifurcation_points,
-            "vessel_spatial_distribution": vessel_spatial_distribution,
-            "timestamp": datetime.now().isoformat()
-        }
+        # Compile all features into a feature set (the arrays are copied out of the stage buffers)
+        features = FeatureSet(
+            id=feature_id,
+            lbp_histogram=stages["lbp"],
+            hog_features=stages["hog"],
+            **stages["vessel_morphology"],
+            optic_disc_center=optic_disc_center,
+            optic_disc_radius=optic_disc_radius,
+            optic_disc_confidence=optic_disc_confidence,
+            bifurcation_points=stages["bifurcation_points"],
+            vessel_spatial_distribution=stages["vessel_spatial"],
+            profile=profile.name,
+            extractor_version=EXTRACTOR_VERSION,
+            timestamp=datetime.now().isoformat()
+        )
         
-        # Cache the result
-        self._feature_cache[image_hash] = features
+        if not use_cache:
+            return features
         
-        # Limit cache size to prevent memory issues
-        if len(self._feature_cache) > 100:
-            # Remove oldest item (first key)
-            oldest_key = next(iter(self._feature_cache))
-            del self._feature_cache[oldest_key]
+        with self._cache_lock:
+            # Cache the result
+            self._feature_cache[image_hash] = features
+            
+            # Limit cache size to prevent memory issues
+            if len(self._feature_cache) > 100:
+                # Remove oldest item (first key)
+                oldest_key = next(iter(self._feature_cache))
+                del self._feature_cache[oldest_key]
         
         return features
     
     @_time_function
-    def compare_features(self, features1: Dict[str, Any], features2: Dict[str, Any]) -> Dict[str, Any]:
+    def compare_features(self, features1: Union[FeatureSet, Dict[str, Any]],
+                         features2: Union[FeatureSet, Dict[str, Any]]) -> Dict[str, Any]:
         """
         Compare two sets of retina features to determine if they belong to the same person.
         
         Args:
-            features1: First set of retina features
-            features2: Second set of retina features
+            features1: First set of retina features (FeatureSet or feature document)
+            features2: Second set of retina features (FeatureSet or feature document)
             
         Returns:
             Dictionary containing similarity score and match result
+            
+        Raises:
+            ProfileMismatchError: If the features were extracted with incompatible
+                profiles or extractor versions
         """
-        # Convert feature lists to numpy arrays
-        lbp_hist1 = np.array(features1["lbp_histogram"]).reshape(1, -1)
-        lbp_hist2 = np.array(features2["lbp_histogram"]).reshape(1, -1)
+        from sklearn.metrics.pairwise import cosine_similarity
         
-        hog_features1 = np.array(features1["hog_features"]).reshape(1, -1)
-        hog_features2 = np.array(features2["hog_features"]).reshape(1, -1)
+        # Documents read elsewhere are converted once; feature sets already hold arrays
+        features1 = as_feature_set(features1)
+        features2 = as_feature_set(features2)
         
-        vessel_spatial1 = np.array(features1["vessel_spatial_distribution"]).reshape(1, -1)
-        vessel_spatial2 = np.array(features2["vessel_spatial_distribution"]).reshape(1, -1)
+        profile1, version1 = get_template_profile(features1)
+        profile2, version2 = get_template_profile(features2)
+        if version1.split(".")[0] != version2.split(".")[0]:
+            raise ProfileMismatchError(
+                f"Cannot compare features of extractor versions {version1} and {version2}"
+            )
+        if profile1.name != profile2.name:
+            # Match the second feature set with the first one's parameters
+            features2 = convert_features(features2, profile2, profile1)
+        
+        # Feature vectors as rows
+        lbp_hist1 = features1["lbp_histogram"].reshape(1, -1)
+        lbp_hist2 = features2["lbp_histogram"].reshape(1, -1)
+        
+        hog_features1 = features1["hog_features"].reshape(1, -1)
+        hog_features2 = features2["hog_features"].reshape(1, -1)
+        
+        vessel_spatial1 = features1["vessel_spatial_distribution"].reshape(1, -1)
+        vessel_spatial2 = features2["vessel_spatial_distribution"].reshape(1, -1)
         
         # Calculate similarity scores
         lbp_similarity = cosine_similarity(lbp_hist1, lbp_hist2)[0][0]
@@ -362,7 +850,8 @@ class RetinaProcessor:
         # Compare bifurcation points
         bifurcation_similarity = self.compare_bifurcation_points(
             features1["bifurcation_points"], 
-            features2["bifurcation_points"]
+            features2["bifurcation_points"],
+            profile1
         )
         
         # Calculate weighted average similarity
@@ -402,22 +891,171 @@ class RetinaProcessor:
         }
     
     @_time_function
-    def compare_bifurcation_points(self, points1: List[Tuple[int, int]], points2: List[Tuple[int, int]]) -> float:
+    def match_employees(self, input_features: Union[FeatureSet, Dict[str, Any]], employees: List[Dict[str, Any]],
+                        get_template: Callable[[str, Optional[str]], Union[FeatureSet, Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Find the employee whose template matches a probe best.
+        
+        Employees without a documentId, and templates that cannot be read or
+        compared (e.g. of an incompatible profile), are skipped with a warning.
+        
+        Args:
+            input_features: Features of the probe image
+            employees: Employee references with employeeId and documentId
+            get_template: Function returning the template of (document ID, employee ID), raising if it is missing
+            
+        Returns:
+            Validation result with status, matchingEmployeeId (None without a match) and similarity
+        """
+        matching_employee_id = None
+        highest_similarity = 0.0
+        
+        for employee in employees:
+            employee_id = employee.get('employeeId')
+            document_id = employee.get('documentId')
+            
+            if not document_id:
+                print(f"Missing documentId for employee: {employee_id}")
+                continue
+            
+            try:
+                comparison_result = self.compare_features(input_features, get_template(document_id, employee_id))
+                
+                similarity = comparison_result.get('overall_similarity', 0.0)
+                is_match = comparison_result.get('is_match', False)
+                
+                print(f"Comparison with employee {employee_id}: similarity={similarity}, is_match={is_match}")
+                
+                # If it's a match and has higher similarity than previous matches
+                if is_match and similarity > highest_similarity:
+                    highest_similarity = similarity
+                    matching_employee_id = employee_id
+            
+            except Exception as e:
+                print(f"Error comparing with employee {employee_id}: {str(e)}")
+                continue
+        
+        return {
+            "status": "success",
+            "matchingEmployeeId": matching_employee_id,
+            "similarity": highest_similarity if matching_employee_id else 0.0
+        }
+    
+    def compare_features_matrix(self, probes: List[Dict[str, Any]], templates: List[Dict[str, Any]],
+                                mask: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        Compare many probe feature sets with many templates at once.
+        
+        Vector features are scored for all pairs with matrix products; the
+        bifurcation point matching, which has no matrix form, only runs for the
+        pairs selected by mask. Scores equal those of compare_features.
+        
+        Args:
+            probes: Probe feature sets, all extracted with the same profile and extractor version
+            templates: Template feature sets
+            mask: Optional boolean (probes x templates) array of the pairs to score (default: all)
+            
+        Returns:
+            Dictionary with (probes x templates) arrays "overall_similarity" and "is_match", and
+            a "compatible" array per template; pairs outside mask or with incompatible templates
+            have similarity 0 and never match
+        """
+        if not probes or not templates:
+            return {
+                "overall_similarity": np.zeros((len(probes), len(templates))),
+                "is_match": np.zeros((len(probes), len(templates)), dtype=bool),
+                "compatible": np.zeros(len(templates), dtype=bool)
+            }
+        
+        profile, version = get_template_profile(probes[0])
+        for probe in probes[1:]:
+            if get_template_profile(probe) != (profile, version):
+                raise ValueError("All probes of a matrix comparison must share profile and extractor version")
+        
+        # Templates of incompatible profiles or extractor versions are not scored;
+        # compatible ones of other profiles are converted like in compare_features
+        template_profiles = [get_template_profile(template) for template in templates]
+        compatible = np.array([
+            template_version.split(".")[0] == version.split(".")[0] and template_profile.is_compatible(profile)
+            for template_profile, template_version in template_profiles
+        ])
+        templates = [
+            convert_features(template, template_profile, profile)
+            if ok and template_profile.name != profile.name else template
+            for template, (template_profile, _), ok in zip(templates, template_profiles, compatible)
+        ]
+        selected = np.ones((len(probes), len(templates)), dtype=bool) if mask is None else mask.astype(bool)
+        selected = selected & compatible[np.newaxis, :]
+        
+        def cosine_matrix(key: str) -> np.ndarray:
+            # Same as sklearn's cosine_similarity: zero vectors have similarity 0
+            a = np.array([probe[key] for probe in probes], dtype=np.float64)
+            b = np.array([template[key] if ok else probes[0][key] for template, ok in zip(templates, compatible)],
+                         dtype=np.float64)
+            a /= np.maximum(np.linalg.norm(a, axis=1, keepdims=True), np.finfo(np.float64).eps)
+            b /= np.maximum(np.linalg.norm(b, axis=1, keepdims=True), np.finfo(np.float64).eps)
+            return a @ b.T
+        
+        def ratio_similarity(key: str) -> np.ndarray:
+            a = np.array([probe[key] for probe in probes], dtype=np.float64)[:, np.newaxis]
+            b = np.array([template[key] for template in templates], dtype=np.float64)[np.newaxis, :]
+            return 1 - np.minimum(np.abs(a - b) / (np.maximum(a, b) + 1e-7), 1)
+        
+        lbp_similarity = cosine_matrix("lbp_histogram")
+        hog_similarity = cosine_matrix("hog_features")
+        vessel_spatial_similarity = cosine_matrix("vessel_spatial_distribution")
+        
+        density1 = np.array([probe["blood_vessel_density"] for probe in probes], dtype=np.float64)[:, np.newaxis]
+        density2 = np.array([template["blood_vessel_density"] for template in templates], dtype=np.float64)[np.newaxis, :]
+        vessel_density_similarity = 1 - np.minimum(np.abs(density1 - density2), 1)
+        vessel_length_similarity = ratio_similarity("avg_vessel_length")
+        vessel_width_similarity = ratio_similarity("avg_vessel_width")
+        
+        bifurcation_similarity = np.zeros(selected.shape)
+        for i, j in zip(*np.nonzero(selected)):
+            bifurcation_similarity[i, j] = self.compare_bifurcation_points(
+                probes[i]["bifurcation_points"], templates[j]["bifurcation_points"], profile
+            )
+        
+        # Same weights as compare_features
+        overall_similarity = (
+            0.2 * lbp_similarity +
+            0.2 * hog_similarity +
+            0.1 * vessel_density_similarity +
+            0.1 * vessel_length_similarity +
+            0.05 * vessel_width_similarity +
+            0.2 * bifurcation_similarity +
+            0.15 * vessel_spatial_similarity
+        )
+        overall_similarity = np.where(selected, overall_similarity, 0.0)
+        
+        return {
+            "overall_similarity": overall_similarity,
+            "is_match": selected & (overall_similarity >= self.similarity_threshold),
+            "compatible": compatible
+        }
+    
+    @_time_function
+    def compare_bifurcation_points(self, points1: List[Tuple[int, int]], points2: List[Tuple[int, int]],
+                                   profile: Optional[ExtractionProfile] = None) -> float:
         """
         Compare two sets of bifurcation points to calculate similarity.
         
         Args:
             points1: First set of bifurcation points
             points2: Second set of bifurcation points
+            profile: Profile whose pixel scale both point sets are in (defaults to the processor's profile)
             
         Returns:
             Similarity score between 0 and 1
         """
-        if not points1 or not points2:
+        if len(points1) == 0 or len(points2) == 0:
             return 0.0
         
+        profile = profile or self.profile
+        
         # Limit the number of points for faster comparison
-        max_points = 30
+        max_points = profile.max_compare_points
         points1 = points1[:max_points]
         points2 = points2[:max_points]
         
@@ -433,13 +1071,14 @@ class RetinaProcessor:
             return 0.0
         
         # Calculate distances between all pairs of points
+        from scipy.spatial import distance
         distances = distance.cdist(points1_array, points2_array, 'euclidean')
         
         # Count how many points are matched (have a corresponding point within threshold)
         matched_count = 0
         
         # Greedy matching algorithm
-        while distances.size > 0 and np.min(distances) < self.bifurcation_distance_threshold:
+        while distances.size > 0 and np.min(distances) < profile.bifurcation_distance_threshold:
             # Find the closest pair
             min_idx = np.unravel_index(np.argmin(distances), distances.shape)
             
@@ -470,6 +1109,10 @@ class RetinaProcessor:
         Returns:
             Object with NumPy types converted to native Python types
         """
+        # Feature sets serialize their arrays themselves
+        if isinstance(obj, FeatureSet):
+            return obj.to_document()
+        
         # Handle NumPy arrays
         if isinstance(obj, np.ndarray):
             return obj.tolist()
@@ -496,40 +1139,72 @@ class RetinaProcessor:
         # Return other types as is
         return obj
 
-    def batch_export_features(self, features_list: List[Dict[str, Any]], person_id: str = None) -> List[str]:
+    def batch_export_features(self, features_list: List[Dict[str, Any]],
+                              person_id: str = None) -> List[Union[str, Exception]]:
         """
         Export multiple retina feature sets to Cosmos DB.
         
+        The feature sets are written concurrently (see CosmosDBClient.store_features_many);
+        a failed one does not stop the others. Throughput statistics are available from
+        the Cosmos DB client's write_stats().
+        
         Args:
             features_list: List of feature dictionaries
             person_id: Optional person ID to associate with the features
             
         Returns:
-            List of Cosmos DB IDs for the stored features
+            List aligned with features_list holding the Cosmos DB ID of each stored
+            feature set, or the exception raised for it
         """
-        cosmos_ids = []
-        
+        entries = []
+        export_timestamp = datetime.now().isoformat()
         for i, features in enumerate(features_list):
             # Add export timestamp and batch index
-            export_data = features.copy()
-            export_data["export_timestamp"] = datetime.now().isoformat()
+            export_data = as_feature_set(features).copy()
+            export_data["export_timestamp"] = export_timestamp
             export_data["batch_index"] = i
             
             if person_id:
                 export_data["person_id"] = person_id
             
-            # Convert NumPy types to native Python types for JSON serialization
-            export_data = self._convert_numpy_types(export_data)
+            entries.append((export_data, person_id, None))
+        
+        if not self.cosmos_client.is_connected():
+            return [ConnectionError("Not connected to Cosmos DB") for _ in entries]
+        
+        results = self.cosmos_client.store_features_many(entries)
+        return [result if isinstance(result, Exception) else result["id"] for result in results]
+    
+    def export_features_many(self, features_list: List[Dict[str, Any]], person_ids: List[Optional[str]],
+                             item_ids: Optional[List[Optional[str]]] = None) -> List[Optional[str]]:
+        """
+        Export the feature sets of several people to Cosmos DB in one call.
+        
+        Args:
+            features_list: List of feature dictionaries
+            person_ids: Person ID for each feature set
+            item_ids: Optional deterministic Cosmos DB ID for each feature set (None entries get a random ID)
             
-            # Store in Cosmos DB
-            if hasattr(self, 'cosmos_client') and self.cosmos_client.is_connected():
-                cosmos_result = self.cosmos_client.store_features(export_data, person_id)
-                if cosmos_result and 'id' in cosmos_result:
-                    cosmos_ids.append(cosmos_result['id'])
+        Returns:
+            List aligned with features_list holding the Cosmos DB ID, or None where storing failed
+        """
+        entries = []
+        item_ids = item_ids or [None] * len(features_list)
+        for features, person_id, item_id in zip(features_list, person_ids, item_ids):
+            # Add person_id to the export data if provided
+            export_data = as_feature_set(features).copy()
+            if person_id:
+                export_data['person_id'] = person_id
+            
+            entries.append((export_data, person_id, item_id))
+        
+        if not self.cosmos_client.is_connected():
+            return [None] * len(entries)
         
-        return cosmos_ids
+        results = self.cosmos_client.store_features_many(entries)
+        return [result['id'] if isinstance(result, dict) and 'id' in result else None for result in results]
     
-    def import_features_from_json(self, filepath: str) -> Dict[str, Any]:
+    def import_features_from_json(self, filepath: str) -> FeatureSet:
         """
         Import retina features from a JSON file.
         
@@ -537,14 +1212,15 @@ class RetinaProcessor:
             filepath: Path to the JSON file
             
         Returns:
-            Dictionary of retina features
+            FeatureSet of retina features
         """
-        with open(filepath, 'r') as f:
-            features = json.load(f)
+        with open(filepath, 'rb') as f:
+            features = FeatureSet.from_document(f.read())
         
         return features
     
-    def export_features_to_json(self, features: Dict[str, Any], filename: str = None, person_id: str = None) -> str:
+    def export_features_to_json(self, features: Dict[str, Any], filename: str = None, person_id: str = None,
+                                item_id: str = None) -> str:
         """
         Export extracted features to Cosmos DB.
         
@@ -552,22 +1228,20 @@ class RetinaProcessor:
             features: Dictionary of extracted features
             filename: Optional filename (not used, kept for compatibility)
             person_id: Optional person ID to associate with the features
+            item_id: Optional deterministic Cosmos DB ID; the document is upserted under it
             
         Returns:
             Cosmos DB ID if successful, None otherwise
         """
         # Add person_id to the export data if provided
-        export_data = features.copy()
+        export_data = as_feature_set(features).copy()
         if person_id:
             export_data['person_id'] = person_id
         
-        # Convert NumPy types to native Python types for JSON serialization
-        export_data = self._convert_numpy_types(export_data)
-        
         # Store in Cosmos DB if connected
         cosmos_id = None
         if hasattr(self, 'cosmos_client') and self.cosmos_client.is_connected():
-            cosmos_result = self.cosmos_client.store_features(export_data, person_id)
+            cosmos_result = self.cosmos_client.store_features(export_data, person_id, item_id)
             if cosmos_result and 'id' in cosmos_result:
                 cosmos_id = cosmos_result['id']
         
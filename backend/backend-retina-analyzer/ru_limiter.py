@@ -0,0 +1,263 @@
+"""
+Client-side request unit limiting of Cosmos DB writes.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+from azure.cosmos import exceptions
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Status code of a request rejected because the container's throughput is exhausted
+THROTTLED_STATUS_CODE = 429
+
+# Charge expected of a request before any response was seen
+INITIAL_CHARGE = 10.0
+
+# The rate is never cut below this fraction of the configured budget
+MIN_RATE_FRACTION = 0.1
+
+# Fraction of the configured budget the rate recovers per second without throttling
+RECOVERY_PER_SECOND = 0.1
+
+# Seconds the achieved RU/s are averaged over
+STATS_WINDOW = 10.0
+
+# Limiters shared by the clients of each container in this process
+_shared_limiters: Dict[Tuple[str, ...], "RequestUnitLimiter"] = {}
+_shared_lock = threading.Lock()
+
+
+class RequestUnitLimiter:
+    """
+    Token bucket limiting the request units consumed by Cosmos DB requests.
+
+    Before a request the bucket is charged the expected cost, a moving average
+    of the x-ms-request-charge headers seen so far, and corrected with the
+    actual charge once the response arrives. A throttled request (429) halves
+    the rate, which then recovers gradually while no request is throttled.
+    Throttled requests are retried after the x-ms-retry-after-ms the service
+    asks for, and at most `concurrency` requests run at once.
+    """
+    def __init__(self, ru_per_second: Optional[float] = None, concurrency: Optional[int] = None,
+                 max_retries: Optional[int] = None):
+        """
+        Initialize the limiter.
+
+        Args:
+            ru_per_second: Request units allowed per second (defaults to the COSMOS_RU_PER_SECOND
+                           environment variable, then 400, the container's provisioned throughput;
+                           0 disables the rate limit)
+            concurrency: Maximum number of concurrent requests (defaults to COSMOS_WRITE_CONCURRENCY, then 4)
+            max_retries: Retries of a throttled request (defaults to COSMOS_MAX_RETRIES, then 5)
+        """
+        self.ru_per_second = (ru_per_second if ru_per_second is not None
+                              else float(os.getenv("COSMOS_RU_PER_SECOND", "400")))
+        self.concurrency = max(1, concurrency if concurrency is not None
+                               else int(os.getenv("COSMOS_WRITE_CONCURRENCY", "4")))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("COSMOS_MAX_RETRIES", "5"))
+
+        self.rate = self.ru_per_second
+        self._available = self.ru_per_second
+        self._updated = time.monotonic()
+        self._last_throttle = 0.0
+        self._expected_charge = INITIAL_CHARGE
+        self._charges: Deque[Tuple[float, float]] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_charge = 0.0
+
+    def execute(self, operation: Callable, *args, **kwargs) -> Any:
+        """
+        Run a Cosmos DB request within the budget.
+
+        Args:
+            operation: Container method accepting a response_hook keyword, e.g. container.upsert_item
+            *args: Positional arguments of the operation
+            **kwargs: Keyword arguments of the operation
+
+        Returns:
+            The operation's result
+
+        Raises:
+            CosmosHttpResponseError: If the request fails, or is still throttled after max_retries retries
+        """
+        attempt = 0
+        with self._slots:
+            while True:
+                reserved = self._reserve()
+                headers: Dict[str, Any] = {}
+                try:
+                    result = operation(*args, response_hook=lambda response_headers, _: headers.update(response_headers),
+                                       **kwargs)
+                except exceptions.CosmosHttpResponseError as e:
+                    error_headers = e.headers or {}
+                    self._settle(reserved, error_headers)
+                    if e.status_code != THROTTLED_STATUS_CODE:
+                        raise
+                    self._throttled(1)
+                    if attempt >= self.max_retries:
+                        with self._lock:
+                            self.failures += 1
+                        raise
+                    attempt += 1
+                    with self._lock:
+                        self.retries += 1
+                    time.sleep(float(error_headers.get("x-ms-retry-after-ms") or 1000) / 1000)
+                    continue
+                except Exception:
+                    self._settle(reserved, {})
+                    raise
+
+                self._settle(reserved, headers)
+                # Throttled attempts the SDK already retried itself
+                sdk_retries = int(headers.get("x-ms-throttle-retry-count", 0) or 0)
+                if sdk_retries:
+                    self._throttled(sdk_retries)
+                return result
+
+    def map(self, function: Callable, items: Iterable[Any]) -> List[Any]:
+        """
+        Apply a function that makes requests through the limiter to several items concurrently.
+
+        A failed item does not stop the others; its exception is returned in
+        its place.
+
+        Args:
+            function: Function of one item
+            items: Items to apply it to
+
+        Returns:
+            List aligned with items holding the function's result or the exception raised for it
+        """
+        def call(item):
+            try:
+                return function(item)
+            except Exception as e:
+                return e
+
+        items = list(items)
+        if len(items) <= 1:
+            return [call(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as pool:
+            return list(pool.map(call, items))
+
+    def _refill(self, now: float) -> None:
+        """Recover the rate and refill the bucket; the lock must be held."""
+        elapsed = now - self._updated
+        self._updated = now
+        if now - self._last_throttle >= 1.0:
+            self.rate = min(self.ru_per_second, self.rate + RECOVERY_PER_SECOND * self.ru_per_second * elapsed)
+        # The bucket holds at most one second of the current rate
+        self._available = min(self.rate, self._available + elapsed * self.rate)
+
+    def _reserve(self) -> float:
+        """
+        Wait until the bucket covers the expected charge of a request and take it.
+
+        Returns:
+            The reserved request units
+        """
+        if self.ru_per_second <= 0:
+            return 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                # A request costing more than the bucket holds goes through once the bucket is full
+                needed = min(self._expected_charge, self.rate)
+                if self._available >= needed:
+                    self._available -= self._expected_charge
+                    return self._expected_charge
+                wait = (needed - self._available) / self.rate
+            time.sleep(wait)
+
+    def _settle(self, reserved: float, headers: Dict[str, Any]) -> None:
+        """Replace a request's reservation with its actual charge."""
+        charge = float(headers.get("x-ms-request-charge", 0) or 0)
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            self.total_charge += charge
+            self._charges.append((now, charge))
+            while self._charges and self._charges[0][0] < now - STATS_WINDOW:
+                self._charges.popleft()
+            if charge > 0:
+                self._expected_charge = 0.8 * self._expected_charge + 0.2 * charge
+            if self.ru_per_second > 0:
+                self._available += reserved - charge
+
+    def _throttled(self, count: int) -> None:
+        """Count throttled requests and cut the rate."""
+        with self._lock:
+            self.throttles += count
+            self._last_throttle = time.monotonic()
+            if self.ru_per_second > 0:
+                self.rate = max(self.ru_per_second * MIN_RATE_FRACTION, self.rate / 2)
+                self._available = min(self._available, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get limiter statistics.
+
+        Returns:
+            Dictionary with the request units per second achieved over the last seconds,
+            the current rate, and request, throttle and retry counts
+        """
+        now = time.monotonic()
+        with self._lock:
+            window = [charge for timestamp, charge in self._charges if timestamp >= now - STATS_WINDOW]
+            return {
+                "achieved_ru_per_second": round(sum(window) / STATS_WINDOW, 1),
+                "rate_ru_per_second": round(self.rate, 1),
+                "budget_ru_per_second": self.ru_per_second,
+                "expected_charge": round(self._expected_charge, 2),
+                "requests": self.requests,
+                "throttles": self.throttles,
+                "retries": self.retries,
+                "failures": self.failures,
+                "total_charge": round(self.total_charge, 1)
+            }
+
+
+def process_budget() -> float:
+    """
+    Get the request units per second this process may consume on a container.
+
+    The container's throughput (COSMOS_RU_PER_SECOND, default 400) is divided
+    between the processes writing to it (COSMOS_RU_PROCESSES, defaulting to
+    WEB_CONCURRENCY, the number of uvicorn worker processes), like the OpenCV
+    threads are divided between the worker processes.
+
+    Returns:
+        Request units per second of this process (0 disables the rate limit)
+    """
+    processes = max(1, int(os.getenv("COSMOS_RU_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))))
+    return float(os.getenv("COSMOS_RU_PER_SECOND", "400")) / processes
+
+
+def shared_limiter(*key: str) -> RequestUnitLimiter:
+    """
+    Get the limiter shared by all clients of a container in this process.
+
+    Args:
+        *key: Values identifying the container, e.g. endpoint, database and container name
+
+    Returns:
+        The container's limiter, created with this process's share of the budget on first use
+    """
+    with _shared_lock:
+        limiter = _shared_limiters.get(key)
+        if limiter is None:
+            limiter = RequestUnitLimiter(process_budget())
+            _shared_limiters[key] = limiter
+        return limiter
@@ -3,11 +3,17 @@ Azure Service Bus integration for retina analysis.
 """
 import os
 import json
+import time
+import orjson
 import asyncio
-from typing import Dict, Any, Callable, Awaitable, Optional
+from datetime import datetime, timezone
+from typing import Dict, Any, Callable, Awaitable, Optional, Tuple
 from azure.servicebus.aio import ServiceBusClient
 from azure.servicebus import ServiceBusMessage
 from dotenv import load_dotenv
+from queue_scheduler import QueuePolicy, PriorityGate, QueueMetrics
+from feature_set import dumps
+from blob_prefetch import BlobPrefetcher
 import cv2
 import numpy as np
 
@@ -24,6 +30,18 @@ class ServiceBusHandler:
         self.queue_name = os.getenv("SERVICE_BUS_QUEUE_NAME")
         self.is_running = False
         self.processor = None
+        
+        # Scheduling across queues: handlers running at once over all queues, and
+        # how free slots are handed out ("strict" priority or "weighted" shares)
+        self.max_concurrent_handlers = max(1, int(os.getenv("SERVICE_BUS_WORKERS", os.getenv("RETINA_CONCURRENCY", "1"))))
+        self.scheduling_mode = os.getenv("SERVICE_BUS_SCHEDULING", "strict")
+        self.metrics_interval = float(os.getenv("SERVICE_BUS_METRICS_INTERVAL", "60"))
+        self.policies: Dict[str, QueuePolicy] = {}
+        self.queue_metrics: Dict[str, QueueMetrics] = {}
+        self.gate: Optional[PriorityGate] = None
+        self.lag_target: Optional[Tuple[str, float]] = None
+        self.prefetcher: Optional[BlobPrefetcher] = None
+        self.worker_slots: Dict[str, asyncio.Semaphore] = {}
     
     def is_configured(self) -> bool:
         """Check if Service Bus is configured."""
@@ -82,30 +100,53 @@ class ServiceBusHandler:
                         # Sleep to avoid tight loop in case of persistent errors
                         await asyncio.sleep(1)
     
+    @staticmethod
+    def _parse_message(message: ServiceBusMessage) -> Dict[str, Any]:
+        """
+        Parse the JSON body of a Service Bus message.
+        
+        Args:
+            message: Service Bus message
+            
+        Returns:
+            Message data
+            
+        Raises:
+            json.JSONDecodeError: If the body is not valid JSON
+        """
+        # Handle both string and generator message bodies
+        if hasattr(message.body, 'decode'):
+            # If it's bytes-like, orjson parses it without decoding it first
+            message_body = message.body
+        elif hasattr(message.body, '__iter__') and not isinstance(message.body, (str, bytes)):
+            # If it's a generator or iterable, convert to bytes first
+            message_body = b''.join(message.body)
+        else:
+            # If it's already a string
+            message_body = str(message.body)
+        
+        # orjson's decode error is a json.JSONDecodeError
+        message_data = orjson.loads(message_body)
+        
+        # Redeliveries keep the Service Bus message ID; handlers use it to recognize them
+        message_data.setdefault('serviceBusMessageId', message.message_id)
+        return message_data
+    
     async def _process_message(self, message: ServiceBusMessage, 
-                              message_handler: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+                              message_handler: Callable[[Dict[str, Any]], Awaitable[None]],
+                              message_data: Optional[Dict[str, Any]] = None) -> None:
         """
         Process a Service Bus message.
         
         Args:
             message: Service Bus message
             message_handler: Callback function to handle the message
+            message_data: Message data if the body was already parsed
         """
         try:
             # Parse the message body as JSON
-            # Handle both string and generator message bodies
-            if hasattr(message.body, 'decode'):
-                # If it's bytes-like, decode it
-                message_body = message.body.decode('utf-8')
-            elif hasattr(message.body, '__iter__') and not isinstance(message.body, (str, bytes)):
-                # If it's a generator or iterable, convert to bytes first
-                message_bytes = b''.join(message.body)
-                message_body = message_bytes.decode('utf-8')
-            else:
-                # If it's already a string
-                message_body = str(message.body)
-            
-            message_data = json.loads(message_body)
+            if message_data is None:
+                message_data = self._parse_message(message)
             
             # Validate required fields
             if 'image_path' not in message_data:
@@ -147,18 +188,27 @@ class ServiceBusHandler:
         ) as servicebus_client:
             async with servicebus_client.get_queue_sender(queue_name=target_queue) as sender:
                 # Create a message
-                message = ServiceBusMessage(json.dumps(message_data))
+                # Messages may carry feature sets, which serialize their arrays natively
+                message = ServiceBusMessage(dumps(message_data))
                 
                 # Send the message
                 await sender.send_messages(message)
                 print(f"Message sent to queue '{target_queue}': {message_data}")
     
-    async def start_processing_multiple(self, message_handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]]) -> None:
+    async def start_processing_multiple(self, message_handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]],
+                                        policies: Optional[Dict[str, QueuePolicy]] = None,
+                                        lag_target: Optional[Tuple[str, float]] = None,
+                                        prefetcher: Optional[BlobPrefetcher] = None) -> None:
         """
         Start processing messages from multiple Service Bus queues with different handlers.
         
         Args:
             message_handlers: Dictionary mapping queue names to message handler functions
+            policies: Optional scheduling policy per queue (default: one worker, equal priority)
+            lag_target: Optional (queue name, milliseconds); while that queue's lag exceeds the
+                target, queues with a lower priority stop receiving messages
+            prefetcher: Optional prefetcher that starts loading each message's image_path as soon
+                as the message is received; handlers get the images from it
         """
         if not self.is_configured():
             print("Service Bus not configured. Check your .env file.")
@@ -174,19 +224,35 @@ class ServiceBusHandler:
             logging_enable=True
         )
         
-        # Start processing tasks for each queue
-        self.processing = True
-        processing_tasks = []
-        
+        queue_handlers = {}
         for queue_name, handler in message_handlers.items():
             if not queue_name:
                 print(f"Skipping empty queue name")
                 continue
-                
-            print(f"Starting to process messages from queue: {queue_name}")
+            queue_handlers[queue_name] = handler
+        
+        policies = policies or {}
+        self.policies = {name: policies.get(name) or QueuePolicy() for name in queue_handlers}
+        self.queue_metrics = {name: QueueMetrics() for name in queue_handlers}
+        self.gate = PriorityGate(self.max_concurrent_handlers, self.policies, self.scheduling_mode)
+        self.lag_target = lag_target if lag_target and lag_target[0] in queue_handlers else None
+        self.prefetcher = prefetcher
+        self.worker_slots = {name: asyncio.Semaphore(policy.workers) for name, policy in self.policies.items()}
+        
+        # Start processing tasks for each queue
+        self.processing = True
+        processing_tasks = []
+        
+        for queue_name, handler in queue_handlers.items():
+            policy = self.policies[queue_name]
+            print(f"Starting to process messages from queue: {queue_name} "
+                  f"(workers={policy.workers}, prefetch={policy.prefetch}, priority={policy.priority}, "
+                  f"weight={policy.weight})")
             task = asyncio.create_task(self._process_queue(queue_name, handler))
             processing_tasks.append(task)
         
+        metrics_task = asyncio.create_task(self._report_metrics())
+        
         # Wait for all tasks to complete
         try:
             await asyncio.gather(*processing_tasks)
@@ -194,15 +260,66 @@ class ServiceBusHandler:
             print("Processing tasks cancelled")
         except Exception as e:
             print(f"Error in processing tasks: {str(e)}")
+        finally:
+            metrics_task.cancel()
+    
+    def get_queue_metrics(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get lag and throughput statistics of every processed queue.
+        
+        Returns:
+            Dictionary mapping queue names to their statistics
+        """
+        return {
+            queue_name: {**metrics.snapshot(), "waiting": self.gate.waiting(queue_name) if self.gate else 0}
+            for queue_name, metrics in self.queue_metrics.items()
+        }
+    
+    async def _report_metrics(self) -> None:
+        """Periodically print the per-queue statistics."""
+        while self.processing:
+            await asyncio.sleep(self.metrics_interval)
+            for queue_name, stats in self.get_queue_metrics().items():
+                print(f"Queue {queue_name} metrics: {stats}")
+            if self.prefetcher is not None:
+                print(f"Blob prefetch metrics: {self.prefetcher.stats()}")
+    
+    def _is_throttled(self, queue_name: str) -> bool:
+        """
+        Check whether a queue should stop receiving because a higher-priority queue lags.
+        
+        Args:
+            queue_name: Name of the queue
+            
+        Returns:
+            True if the queue should wait before receiving more messages
+        """
+        if self.lag_target is None:
+            return False
+        protected_queue, target_ms = self.lag_target
+        if queue_name == protected_queue:
+            return False
+        if self.policies[queue_name].priority >= self.policies[protected_queue].priority:
+            return False
+        return self.queue_metrics[protected_queue].recent_lag_ms() > target_ms
     
     async def _process_queue(self, queue_name: str, message_handler: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
         """
         Process messages from a specific Service Bus queue.
         
+        Up to the queue's worker budget of messages are handled concurrently;
+        each handler additionally waits for an execution slot of the shared gate.
+        Up to the queue's prefetch count of further messages are received ahead
+        and wait for a worker, while their images are loaded by the prefetcher.
+        
         Args:
             queue_name: Name of the queue to process
             message_handler: Callback function to handle messages
         """
+        policy = self.policies[queue_name]
+        metrics = self.queue_metrics[queue_name]
+        in_flight = set()
+        
         # Create a receiver for the queue
         async with self.client.get_queue_receiver(
             queue_name=queue_name,
@@ -210,20 +327,120 @@ class ServiceBusHandler:
         ) as receiver:
             while self.processing:
                 try:
+                    # Only receive what the worker budget can start soon, so locks do not expire while waiting
+                    capacity = policy.workers + policy.prefetch
+                    if len(in_flight) >= capacity:
+                        await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    
+                    if self._is_throttled(queue_name):
+                        await asyncio.sleep(0.5)
+                        metrics.throttled_seconds += 0.5
+                        continue
+                    
                     # Receive a batch of messages
-                    received_msgs = await receiver.receive_messages(max_message_count=10, max_wait_time=5)
+                    received_msgs = await receiver.receive_messages(
+                        max_message_count=capacity - len(in_flight), max_wait_time=5
+                    )
                     
-                    # Process each message in the batch
+                    # Handle each message in its own task
                     for msg in received_msgs:
-                        try:
-                            await self._process_message(msg, message_handler)
-                            # Complete the message
-                            await receiver.complete_message(msg)
-                        except Exception as e:
-                            print(f"Error processing message from queue {queue_name}: {str(e)}")
-                            # Abandon the message to make it available again
-                            await receiver.abandon_message(msg)
+                        message_data = self._prefetch(msg)
+                        task = asyncio.create_task(
+                            self._handle_scheduled(receiver, queue_name, msg, message_handler, message_data)
+                        )
+                        in_flight.add(task)
+                        task.add_done_callback(in_flight.discard)
                 except Exception as e:
                     print(f"Error receiving messages from queue {queue_name}: {str(e)}")
                     # Sleep to avoid tight loop in case of persistent errors
                     await asyncio.sleep(1)
+            
+            # Let running handlers settle their messages before the receiver closes
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+    
+    def _prefetch(self, msg: ServiceBusMessage) -> Optional[Dict[str, Any]]:
+        """
+        Parse a received message and start prefetching its image.
+        
+        Args:
+            msg: Received message
+            
+        Returns:
+            Message data, or None if there is no prefetcher or the body is invalid (reported when it is handled)
+        """
+        if self.prefetcher is None:
+            return None
+        try:
+            message_data = self._parse_message(msg)
+        except Exception:
+            return None
+        if isinstance(message_data, dict):
+            self.prefetcher.prefetch(message_data.get('image_path'))
+        return message_data
+    
+    async def _handle_scheduled(self, receiver, queue_name: str, msg: ServiceBusMessage,
+                                message_handler: Callable[[Dict[str, Any]], Awaitable[None]],
+                                message_data: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Handle one message once a worker of its queue and, if its queue is gated, an execution
+        slot of the gate are free, then settle it and release its prefetched image.
+        
+        Args:
+            receiver: Receiver the message was received with
+            queue_name: Name of the queue the message belongs to
+            msg: Received message
+            message_handler: Callback function to handle the message
+            message_data: Message data parsed when the message was received, if any
+        """
+        try:
+            async with self.worker_slots[queue_name]:
+                await self._handle_gated(receiver, queue_name, msg, message_handler, message_data)
+        finally:
+            if self.prefetcher is not None and isinstance(message_data, dict):
+                self.prefetcher.release(message_data.get('image_path'))
+    
+    async def _handle_gated(self, receiver, queue_name: str, msg: ServiceBusMessage,
+                            message_handler: Callable[[Dict[str, Any]], Awaitable[None]],
+                            message_data: Optional[Dict[str, Any]]) -> None:
+        """
+        Handle one message once the gate grants it an execution slot (if its queue is gated), then settle it.
+        
+        Args:
+            receiver: Receiver the message was received with
+            queue_name: Name of the queue the message belongs to
+            msg: Received message
+            message_handler: Callback function to handle the message
+            message_data: Message data parsed when the message was received, if any
+        """
+        metrics = self.queue_metrics[queue_name]
+        gated = self.policies[queue_name].gated
+        if gated:
+            await self.gate.acquire(queue_name)
+        try:
+            enqueued_time = msg.enqueued_time_utc
+            if enqueued_time is not None and enqueued_time.tzinfo is None:
+                enqueued_time = enqueued_time.replace(tzinfo=timezone.utc)
+            lag_ms = (datetime.now(timezone.utc) - enqueued_time).total_seconds() * 1000 if enqueued_time else 0.0
+            metrics.record_start(lag_ms)
+            
+            start_time = time.perf_counter()
+            success = False
+            try:
+                await self._process_message(msg, message_handler, message_data)
+                # Complete the message
+                await receiver.complete_message(msg)
+                success = True
+            except Exception as e:
+                print(f"Error processing message from queue {queue_name}: {str(e)}")
+                # Abandon the message to make it available again
+                try:
+                    await receiver.abandon_message(msg)
+                except Exception as abandon_error:
+                    print(f"Failed to abandon message from queue {queue_name}: {str(abandon_error)}")
+            finally:
+                metrics.record_end((time.perf_counter() - start_time) * 1000, success)
+        finally:
+            if gated:
+                self.gate.release()
@@ -0,0 +1,119 @@
+"""
+Single-flight coalescing of identical concurrent computations.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+def make_key(*parts: Any) -> str:
+    """
+    Build a single-flight key from JSON-serializable parts.
+
+    Args:
+        *parts: Values identifying the computation (order matters, dict keys do not)
+
+    Returns:
+        Hex digest identifying the computation
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time.
+
+    Callers arriving while a computation for their key is in flight await its
+    result instead of starting their own. The computation runs as its own task,
+    so it completes even if the caller that started it is cancelled. Results
+    stay reusable for a short window; failures are never reused.
+    """
+    def __init__(self, ttl: Optional[float] = None, max_results: int = 1000):
+        """
+        Initialize the single-flight group.
+
+        Args:
+            ttl: Seconds a finished result is reused (defaults to the SINGLE_FLIGHT_TTL
+                 environment variable, then 5; 0 only coalesces concurrent calls)
+            max_results: Maximum number of finished results kept
+        """
+        self.ttl = ttl if ttl is not None else float(os.getenv("SINGLE_FLIGHT_TTL", "5"))
+        self.max_results = max_results
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.reused = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]],
+                 cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Run a computation, or share the in-flight or recent one with the same key.
+
+        Args:
+            key: Key identifying the computation
+            func: Coroutine function performing the computation
+            cacheable: Optional predicate deciding whether a result may be reused after it finished
+
+        Returns:
+            Result of the computation
+        """
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.reused += 1
+                return cached[1]
+            del self._results[key]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done, cacheable))
+
+        # Shielded, so a cancelled caller does not cancel the computation for the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task, cacheable: Optional[Callable[[Any], bool]]) -> None:
+        """Remove a finished computation from the in-flight map and keep its result if reusable."""
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+
+        result = task.result()
+        if cacheable is not None and not cacheable(result):
+            return
+
+        now = time.monotonic()
+        self._results[key] = (now + self.ttl, result)
+        if len(self._results) > self.max_results:
+            # Drop expired results first, then the oldest ones
+            for expired in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                del self._results[expired]
+            while len(self._results) > self.max_results:
+                del self._results[next(iter(self._results))]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get single-flight statistics.
+
+        Returns:
+            Dictionary with executed, coalesced and reused call counts and in-flight computations
+        """
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "reused": self.reused,
+            "in_flight": len(self._in_flight)
+        }
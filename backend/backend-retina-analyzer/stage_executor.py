@@ -0,0 +1,160 @@
+"""
+Stage-graph executor for running independent feature extraction stages in parallel.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import cv2
+
+
+def configure_opencv_threads(stage_workers: int, concurrent_images: int = 1, processes: int = 1) -> int:
+    """
+    Limit OpenCV's internal thread pool so stage, image and process parallelism do not oversubscribe cores.
+
+    Args:
+        stage_workers: Number of stage threads used per image
+        concurrent_images: Number of images processed concurrently in this process
+        processes: Number of worker processes sharing the machine's cores
+
+    Returns:
+        Number of threads OpenCV was configured with
+    """
+    cpu_count = os.cpu_count() or 1
+    threads = max(1, cpu_count // max(1, stage_workers * concurrent_images * processes))
+    cv2.setNumThreads(threads)
+    return threads
+
+
+class StageMetrics:
+    """
+    Thread-safe aggregate of stage execution times.
+    """
+    def __init__(self):
+        """Initialize empty stage metrics."""
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Record one execution of a stage.
+
+        Args:
+            stage: Stage name
+            seconds: Execution time in seconds
+        """
+        with self._lock:
+            stats = self._stats.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get the current stage statistics.
+
+        Returns:
+            Dictionary mapping stage names to count, mean and max time in milliseconds
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "count": int(stats["count"]),
+                    "mean_ms": stats["total"] / stats["count"] * 1000,
+                    "max_ms": stats["max"] * 1000
+                }
+                for stage, stats in self._stats.items()
+            }
+
+    def reset(self) -> None:
+        """Clear all recorded statistics."""
+        with self._lock:
+            self._stats.clear()
+
+
+class StageGraph:
+    """
+    Directed acyclic graph of named stages.
+
+    Each stage is called with the results of its dependencies as keyword
+    arguments. Stages whose dependencies are satisfied are submitted to the
+    thread pool together, so independent stages run concurrently.
+    """
+    def __init__(self):
+        """Initialize an empty stage graph."""
+        self._stages: Dict[str, Dict[str, Any]] = {}
+
+    def add_stage(self, name: str, func: Callable[..., Any], depends_on: Sequence[str] = ()) -> "StageGraph":
+        """
+        Add a stage to the graph.
+
+        Args:
+            name: Stage name, also the key of its result
+            func: Callable receiving the results of its dependencies as keyword arguments
+            depends_on: Names of stages or inputs this stage needs
+
+        Returns:
+            The graph, for chaining
+        """
+        if name in self._stages:
+            raise ValueError(f"Stage already defined: {name}")
+        self._stages[name] = {"func": func, "depends_on": list(depends_on)}
+        return self
+
+    def run(self, inputs: Dict[str, Any], executor: Optional[ThreadPoolExecutor] = None,
+            metrics: Optional[StageMetrics] = None) -> Dict[str, Any]:
+        """
+        Run all stages of the graph.
+
+        Args:
+            inputs: Initial values available to stages as dependencies
+            executor: Thread pool to run stages on (stages run inline when None)
+            metrics: Optional metrics collector receiving each stage's execution time
+
+        Returns:
+            Dictionary containing the inputs and the result of every stage
+        """
+        results = dict(inputs)
+        pending = dict(self._stages)
+
+        def ready_stages() -> List[str]:
+            return [name for name, stage in pending.items()
+                    if all(dep in results for dep in stage["depends_on"])]
+
+        def call(name: str) -> Any:
+            stage = self._stages[name]
+            kwargs = {dep: results[dep] for dep in stage["depends_on"]}
+            start_time = time.perf_counter()
+            result = stage["func"](**kwargs)
+            if metrics is not None:
+                metrics.record(name, time.perf_counter() - start_time)
+            return result
+
+        if executor is None:
+            while pending:
+                ready = ready_stages()
+                if not ready:
+                    raise ValueError(f"Unresolvable stage dependencies: {sorted(pending)}")
+                for name in ready:
+                    del pending[name]
+                    results[name] = call(name)
+            return results
+
+        running = {}
+        while pending or running:
+            for name in ready_stages():
+                del pending[name]
+                running[executor.submit(call, name)] = name
+            if not running:
+                raise ValueError(f"Unresolvable stage dependencies: {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    # Do not leave sibling stages writing into shared buffers
+                    wait(running)
+                    raise
+        return results
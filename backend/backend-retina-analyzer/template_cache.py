@@ -0,0 +1,117 @@
+"""
+On-disk cache of enrolled retina templates shared by the worker processes of one instance.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional, Union
+from dotenv import load_dotenv
+from feature_set import FeatureSet, as_feature_set
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class TemplateCache:
+    """
+    Cache of Cosmos DB feature documents stored as JSON files in a directory.
+
+    Every uvicorn worker is a separate process with its own memory, so the
+    directory (e.g. on a tmpfs) is what lets workers share templates. Files
+    are written to a temporary name and renamed into place, so readers never
+    see a partially written template.
+    """
+    def __init__(self, directory: Optional[str] = None, ttl: Optional[float] = None):
+        """
+        Initialize the template cache.
+
+        Args:
+            directory: Cache directory (defaults to the TEMPLATE_CACHE_DIR environment variable;
+                       the cache is disabled when neither is set)
+            ttl: Seconds a cached template stays valid (defaults to TEMPLATE_CACHE_TTL, then 300)
+        """
+        self.directory = directory or os.getenv("TEMPLATE_CACHE_DIR")
+        self.ttl = ttl if ttl is not None else float(os.getenv("TEMPLATE_CACHE_TTL", "300"))
+        self.hits = 0
+        self.misses = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def is_enabled(self) -> bool:
+        """Check if a cache directory is configured."""
+        return bool(self.directory)
+
+    def _path(self, item_id: str) -> str:
+        """Get the file path of a cached template."""
+        name = hashlib.sha1(item_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, item_id: str) -> Optional[FeatureSet]:
+        """
+        Get a cached template.
+
+        Args:
+            item_id: Cosmos DB document ID
+
+        Returns:
+            FeatureSet of the cached document, or None if it is not cached or has expired
+        """
+        if not self.is_enabled():
+            return None
+
+        path = self._path(item_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.misses += 1
+                return None
+            with open(path, "rb") as f:
+                document = FeatureSet.from_document(f.read())
+        except (OSError, TypeError, ValueError):
+            self.misses += 1
+            return None
+        if not document:
+            # An empty entry is never a usable template
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return document
+
+    def put(self, item_id: str, document: Union[FeatureSet, Dict[str, Any]]) -> None:
+        """
+        Store a template in the cache.
+
+        Args:
+            item_id: Cosmos DB document ID
+            document: FeatureSet or feature document to cache (a missing document is not cached)
+        """
+        if not self.is_enabled() or not document:
+            return
+
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(as_feature_set(document).to_json())
+            os.replace(temp_path, self._path(item_id))
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Failed to cache template {item_id}: {str(e)}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def invalidate(self, item_id: str) -> None:
+        """
+        Remove a template from the cache.
+
+        Args:
+            item_id: Cosmos DB document ID
+        """
+        if not self.is_enabled():
+            return
+
+        try:
+            os.remove(self._path(item_id))
+        except FileNotFoundError:
+            pass
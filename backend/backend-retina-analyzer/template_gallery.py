@@ -0,0 +1,666 @@
+"""
+Compact in-memory gallery of retina templates for one-to-many matching of large populations.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from extraction_profiles import (
+    EXTRACTOR_VERSION, ExtractionProfile, ProfileMismatchError, convert_features, get_template_profile
+)
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger("TemplateGallery")
+
+# Vector features and their weights in the overall similarity (same as RetinaProcessor.compare_features)
+VECTOR_FEATURES = {
+    "lbp_histogram": 0.2,
+    "hog_features": 0.2,
+    "vessel_spatial_distribution": 0.15
+}
+BIFURCATION_WEIGHT = 0.2
+
+# Document fields a gallery uses, for projected Cosmos DB queries
+TEMPLATE_FIELDS = [
+    "profile", "extractor_version", "blood_vessel_density", "avg_vessel_length", "avg_vessel_width",
+    "bifurcation_points", *VECTOR_FEATURES
+]
+
+# Largest value of a quantized vector component per storage type
+QUANTIZATION_LEVELS = {"int8": 127.0, "int4": 7.0, "float16": 1.0}
+
+# Array type holding the vector components of each storage type (int4 packs two components per byte)
+STORAGE_TYPES = {"int8": np.int8, "int4": np.uint8, "float16": np.float16}
+
+# Largest stored bifurcation point coordinate (points are uint16 image coordinates)
+MAX_POINT_COORDINATE = np.iinfo(np.uint16).max
+
+
+class TemplateIndex:
+    """
+    Mapping between template IDs and gallery rows.
+    """
+    def __init__(self):
+        """Initialize an empty index."""
+        self._rows: Dict[str, int] = {}
+        self._ids: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        """Number of indexed templates."""
+        return len(self._rows)
+
+    def __contains__(self, template_id: str) -> bool:
+        """Check whether a template is indexed."""
+        return self.get(template_id) is not None
+
+    def get(self, template_id: str) -> Optional[int]:
+        """Get the row of a template, or None if it is not indexed."""
+        return self._rows.get(template_id)
+
+    def add(self, template_id: str, row: int) -> None:
+        """Index a template stored in a new row, replacing the row it was stored in before."""
+        previous = self._rows.get(template_id)
+        self._ids[row] = template_id
+        # Readers find the new row from here on
+        self._rows[template_id] = row
+        if previous is not None:
+            self._ids.pop(previous, None)
+
+    def remove(self, template_id: str) -> Optional[int]:
+        """Remove a template and return its former row, or None if it was not indexed."""
+        row = self._rows.pop(template_id, None)
+        if row is not None:
+            self._ids.pop(row, None)
+        return row
+
+    def id_at(self, row: int) -> Optional[str]:
+        """Get the ID of the template stored in a row, or None if the row was removed."""
+        return self._ids.get(row)
+
+    def removed_ids(self) -> List[str]:
+        """Get the IDs of templates removed from rows that cannot be written (none for an in-memory index)."""
+        return []
+
+
+class TemplateGallery:
+    """
+    Templates of one extraction profile packed into contiguous numpy arrays.
+
+    Vector features are stored as int8 (or packed int4, or float16) rows
+    scaled by their largest component, with one float32 scale per row; vessel
+    statistics as float32; bifurcation points as one ragged uint16 array of
+    image coordinates, addressed by per-template offsets and counts, keeping
+    only the points comparisons use. A standard-profile template takes 606
+    bytes as int8 and 378 bytes as int4 instead of several KB of Python
+    floats, and scores are computed directly on the packed rows.
+
+    A gallery created from existing columns (from_columns) never writes to
+    them: added and replaced templates go to an in-memory overlay gallery,
+    so memory-mapped columns stay shared between processes.
+
+    Writers (e.g. the gallery sync thread) are serialized by a lock, and
+    readers need none: a template is written to a new row, which is only
+    published in the index once complete, and grown arrays are filled
+    copies swapped in whole.
+    """
+    def __init__(self, processor, profile: Optional[ExtractionProfile] = None, dtype: Optional[str] = None,
+                 capacity: int = 1024, index: Optional[TemplateIndex] = None):
+        """
+        Initialize an empty gallery.
+
+        Args:
+            processor: RetinaProcessor providing the match threshold and bifurcation point matching
+            profile: Profile of the stored templates (defaults to the processor's profile)
+            dtype: Vector storage type, "int8", "int4" or "float16" (defaults to the GALLERY_DTYPE
+                   environment variable, then "int8")
+            capacity: Initial number of template rows
+            index: Index of already stored rows (default: a new empty index)
+        """
+        self.processor = processor
+        self.profile = profile or processor.profile
+        self.dtype = dtype or os.getenv("GALLERY_DTYPE", "int8")
+        if self.dtype not in QUANTIZATION_LEVELS:
+            raise ValueError(f"Unknown gallery dtype: {self.dtype}. Use int8, int4 or float16")
+        self.levels = QUANTIZATION_LEVELS[self.dtype]
+        self.max_points = self.profile.max_compare_points
+
+        self.index = index if index is not None else TemplateIndex()
+        self.count = 0
+        self._capacity = max(1, capacity)
+        self._dims: Dict[str, int] = {}
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.scales: Dict[str, np.ndarray] = {}
+        # blood_vessel_density, avg_vessel_length, avg_vessel_width
+        self.statistics = np.zeros((self._capacity, 3), dtype=np.float32)
+        self.point_offsets = np.zeros(self._capacity, dtype=np.uint32)
+        self.point_counts = np.zeros(self._capacity, dtype=np.uint8)
+        self.points = np.zeros((self._capacity * self.max_points, 2), dtype=np.uint16)
+        self._points_used = 0
+        self.active = np.zeros(self._capacity, dtype=bool)
+        self.overlay: Optional["TemplateGallery"] = None
+        self._write_lock = threading.Lock()
+        # Time the gallery was last known to hold every current template (set by snapshots and the sync)
+        self.updated: Optional[float] = None
+        self.max_staleness = float(os.getenv("GALLERY_MAX_STALENESS", "300"))
+
+    def __len__(self) -> int:
+        """Number of templates in the gallery."""
+        return len(self.index) + (len(self.overlay) if self.overlay is not None else 0)
+
+    def __contains__(self, template_id: str) -> bool:
+        """Check whether a template is in the gallery."""
+        return template_id in self.index or (self.overlay is not None and template_id in self.overlay)
+
+    def is_fresh(self) -> bool:
+        """
+        Check whether the gallery is recent enough to serve template reads.
+
+        Returns:
+            True if the gallery was up to date at most max_staleness seconds ago (always
+            True if max_staleness is 0 or the gallery was not loaded from Cosmos DB)
+        """
+        if self.max_staleness <= 0 or self.updated is None:
+            return True
+        return time.time() - self.updated <= self.max_staleness
+
+    def ids(self) -> Iterable[str]:
+        """Iterate over the IDs of the templates in the gallery."""
+        for row in np.nonzero(self.active[:self.count])[0]:
+            template_id = self.index.id_at(int(row))
+            # (None for a row replaced while iterating)
+            if template_id is not None:
+                yield template_id
+        if self.overlay is not None:
+            yield from self.overlay.ids()
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the packed arrays in use (excluding template IDs)."""
+        rows = self.count
+        overlay = self.overlay.nbytes if self.overlay is not None else 0
+        total = overlay + sum(self.vectors[key].shape[1] * self.vectors[key].itemsize * rows for key in self._dims)
+        total += sum(self.scales[key].itemsize * rows for key in self._dims)
+        total += rows * (self.statistics.itemsize * 3 + self.point_offsets.itemsize +
+                         self.point_counts.itemsize + self.active.itemsize)
+        return total + self._points_used * 2 * self.points.itemsize
+
+    def to_columns(self) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """
+        Get the stored templates as compacted columns, without removed rows or unused points.
+
+        Returns:
+            Tuple of (template IDs in row order, arrays by column name)
+        """
+        rows = np.nonzero(self.active[:self.count])[0]
+        counts = self.point_counts[rows]
+        offsets = np.zeros(len(rows), dtype=np.uint32)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        # Position of each kept point in the current ragged array
+        point_rows = np.repeat(self.point_offsets[rows].astype(np.int64) - offsets, counts.astype(np.int64))
+        point_index = point_rows + np.arange(len(point_rows), dtype=np.int64)
+
+        columns = {}
+        for key in self._dims:
+            columns[f"vector:{key}"] = self.vectors[key][rows]
+            columns[f"scale:{key}"] = self.scales[key][rows]
+        columns["statistics"] = self.statistics[rows]
+        columns["point_offsets"] = offsets
+        columns["point_counts"] = counts
+        columns["points"] = self.points[point_index]
+        ids = [self.index.id_at(row) for row in rows]
+
+        if self.overlay is not None and len(self.overlay):
+            overlay_ids, overlay_columns = self.overlay.to_columns()
+            overlay_columns["point_offsets"] = overlay_columns["point_offsets"] + len(columns["points"])
+            if not self._dims:
+                columns = overlay_columns
+            else:
+                columns = {name: np.concatenate([array, overlay_columns[name]]) for name, array in columns.items()}
+            ids += overlay_ids
+        return ids, columns
+
+    @classmethod
+    def from_columns(cls, processor, profile: ExtractionProfile, dtype: str, columns: Dict[str, np.ndarray],
+                     index: TemplateIndex) -> "TemplateGallery":
+        """
+        Create a gallery on top of existing columns (e.g. memory-mapped arrays) without copying them.
+
+        Args:
+            processor: RetinaProcessor providing the match threshold and bifurcation point matching
+            profile: Profile of the stored templates
+            dtype: Vector storage type of the columns
+            columns: Arrays by column name, as returned by to_columns
+            index: Index of the stored rows
+
+        Returns:
+            The gallery; templates added to it are kept in an in-memory overlay
+        """
+        gallery = cls(processor, profile=profile, dtype=dtype, capacity=1, index=index)
+        count = len(columns["statistics"])
+        for name, array in columns.items():
+            if name.startswith("vector:"):
+                key = name.split(":", 1)[1]
+                gallery._dims[key] = array.shape[1] * (2 if dtype == "int4" else 1)
+                gallery.vectors[key] = array
+                gallery.scales[key] = columns[f"scale:{key}"]
+        gallery.statistics = columns["statistics"]
+        gallery.point_offsets = columns["point_offsets"]
+        gallery.point_counts = columns["point_counts"]
+        gallery.points = columns["points"]
+        gallery._points_used = len(gallery.points)
+        gallery.active = np.ones(count, dtype=bool)
+        gallery.count = gallery._capacity = count
+        gallery.overlay = cls(processor, profile=profile, dtype=dtype)
+        return gallery
+
+    def check_compatible(self, features: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Check that a feature set can be stored in or scored against the gallery.
+
+        Args:
+            features: Dictionary of retina features
+
+        Returns:
+            The features, converted to the gallery profile if they were extracted with another compatible one
+
+        Raises:
+            ProfileMismatchError: If the features were extracted with an incompatible profile or version
+        """
+        profile, version = get_template_profile(features)
+        if version.split(".")[0] != EXTRACTOR_VERSION.split(".")[0] or not profile.is_compatible(self.profile):
+            raise ProfileMismatchError(
+                f"Features of profile '{profile.name}' (extractor {version}) cannot be compared "
+                f"with gallery profile '{self.profile.name}'"
+            )
+        if profile.name != self.profile.name:
+            return convert_features(features, profile, self.profile)
+        return features
+
+    def add(self, template_id: str, features: Dict[str, Any]) -> None:
+        """
+        Add a template, replacing any template with the same ID.
+
+        Args:
+            template_id: Template (Cosmos DB document) ID
+            features: Dictionary of retina features
+
+        Raises:
+            ProfileMismatchError: If the template's profile or feature sizes differ from the gallery's
+        """
+        if self.overlay is not None:
+            # Existing columns are never written; the stored row is replaced by an overlay row
+            self.overlay.add(template_id, features)
+            with self._write_lock:
+                row = self.index.remove(template_id)
+                if row is not None:
+                    self.active[row] = False
+            return
+
+        features = self.check_compatible(features)
+        with self._write_lock:
+            if not self._dims:
+                self._init_vectors(features)
+            for key, dim in self._dims.items():
+                if len(features[key]) != dim:
+                    raise ProfileMismatchError(f"Template {template_id} has {len(features[key])} {key} values, expected {dim}")
+
+            # A replaced template gets a new row, so readers never see a partly written one
+            if self.count == self._capacity:
+                self._grow_rows(max(1, self._capacity * 2))
+            row = self.count
+            for key in self._dims:
+                self.vectors[key][row], self.scales[key][row] = self._quantize(features[key])
+            self.statistics[row] = (features["blood_vessel_density"], features["avg_vessel_length"],
+                                    features["avg_vessel_width"])
+
+            points = features.get("bifurcation_points")
+            points = np.asarray(points if points is not None else [], dtype=np.float64).reshape(-1, 2)[:self.max_points]
+            if self._points_used + len(points) > len(self.points):
+                self._grow_points(max(len(self.points) * 2, self._points_used + len(points)))
+            self.points[self._points_used:self._points_used + len(points)] = np.clip(np.rint(points), 0, MAX_POINT_COORDINATE)
+            self.point_offsets[row] = self._points_used
+            self.point_counts[row] = len(points)
+            self._points_used += len(points)
+            self.active[row] = True
+
+            # Published last; the replaced row stays unused until the gallery is compacted (to_columns)
+            previous = self.index.get(template_id)
+            self.index.add(template_id, row)
+            if previous is not None:
+                self.active[previous] = False
+            self.count += 1
+
+    def add_many(self, templates: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """
+        Add several templates.
+
+        Args:
+            templates: Iterable of (template ID, features) pairs
+
+        Returns:
+            Number of templates added; incompatible templates are skipped
+        """
+        added = 0
+        for template_id, features in templates:
+            try:
+                self.add(template_id, features)
+                added += 1
+            except ProfileMismatchError as e:
+                logger.warning(f"Skipping template {template_id}: {str(e)}")
+        return added
+
+    def remove(self, template_id: str) -> bool:
+        """
+        Remove a template.
+
+        Args:
+            template_id: Template ID
+
+        Returns:
+            True if the template was in the gallery
+        """
+        removed = self.overlay is not None and self.overlay.remove(template_id)
+        with self._write_lock:
+            row = self.index.remove(template_id)
+            if row is None:
+                return removed
+            self.active[row] = False
+        return True
+
+    def get(self, template_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a template's features as stored, dequantized.
+
+        Args:
+            template_id: Template ID
+
+        Returns:
+            Dictionary of features usable with RetinaProcessor.compare_features, or None if not found
+        """
+        if self.overlay is not None and template_id in self.overlay:
+            return self.overlay.get(template_id)
+        row = self.index.get(template_id)
+        if row is None:
+            return None
+
+        features = {
+            key: (self._unpack(self.vectors[key][row:row + 1])[0] * (self.scales[key][row] / self.levels)).tolist()
+            for key in self._dims
+        }
+        density, length, width = self.statistics[row].tolist()
+        offset, count = int(self.point_offsets[row]), int(self.point_counts[row])
+        features.update({
+            "id": template_id,
+            "blood_vessel_density": density,
+            "avg_vessel_length": length,
+            "avg_vessel_width": width,
+            "bifurcation_points": [tuple(point) for point in self.points[offset:offset + count].tolist()],
+            "profile": self.profile.name,
+            "extractor_version": EXTRACTOR_VERSION
+        })
+        return features
+
+    def score(self, probe: Dict[str, Any], template_ids: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Compute the overall similarity of a probe with gallery templates.
+
+        Args:
+            probe: Probe feature set
+            template_ids: Templates to score (default: all rows, followed by the overlay's; removed rows score 0)
+
+        Returns:
+            Similarities in the order of template_ids, or of the gallery rows
+        """
+        probe = self.check_compatible(probe)
+        if self.overlay is not None:
+            if template_ids is None:
+                return np.concatenate([self._score_rows(probe, np.arange(self.count)), self.overlay.score(probe)])
+            in_overlay = np.array([template_id in self.overlay for template_id in template_ids], dtype=bool)
+            similarity = np.zeros(len(template_ids))
+            if in_overlay.any():
+                similarity[in_overlay] = self.overlay.score(
+                    probe, [template_id for template_id, overlaid in zip(template_ids, in_overlay) if overlaid]
+                )
+            template_ids = [template_id for template_id, overlaid in zip(template_ids, in_overlay) if not overlaid]
+            similarity[~in_overlay] = self._score_rows(probe, self._rows_of(template_ids))
+            return similarity
+
+        rows = np.arange(self.count) if template_ids is None else self._rows_of(template_ids)
+        return self._score_rows(probe, rows)
+
+    def _rows_of(self, template_ids: List[str]) -> np.ndarray:
+        """Get the rows of stored templates."""
+        rows = [self.index.get(template_id) for template_id in template_ids]
+        if None in rows:
+            raise KeyError(f"Template {template_ids[rows.index(None)]} is not in the gallery")
+        return np.array(rows, dtype=np.int64)
+
+    def _score_rows(self, probe: Dict[str, Any], rows: np.ndarray) -> np.ndarray:
+        """Overall similarity of a probe with the templates in the given rows."""
+        similarity = self._vector_scores(probe, rows)
+        for position, row in enumerate(rows):
+            if self.active[row]:
+                similarity[position] += BIFURCATION_WEIGHT * self._bifurcation_similarity(probe, row)
+        return np.where(self.active[rows], similarity, 0.0)
+
+    def search(self, probe: Dict[str, Any], top_k: int = 1,
+               threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        Find the best matching templates of a probe.
+
+        Vector features are scored for every row at once. Bifurcation points,
+        which contribute at most BIFURCATION_WEIGHT, are only matched for rows
+        whose vector score can still reach the threshold and the current top
+        results, so the result is exact without matching points for every row.
+
+        Args:
+            probe: Probe feature set
+            top_k: Maximum number of results
+            threshold: Minimum overall similarity (defaults to the processor's match threshold)
+
+        Returns:
+            List of (template ID, similarity), best first
+        """
+        probe = self.check_compatible(probe)
+        threshold = self.processor.similarity_threshold if threshold is None else threshold
+
+        rows = np.arange(self.count)
+        vector_scores = self._vector_scores(probe, rows)
+        candidates = np.nonzero(self.active[:self.count] & (vector_scores + BIFURCATION_WEIGHT >= threshold))[0]
+        candidates = candidates[np.argsort(-vector_scores[candidates], kind="stable")]
+
+        results: List[Tuple[str, float]] = []
+        for row in candidates:
+            bound = vector_scores[row] + BIFURCATION_WEIGHT
+            if len(results) >= top_k and bound <= results[-1][1]:
+                break
+            similarity = float(vector_scores[row] + BIFURCATION_WEIGHT * self._bifurcation_similarity(probe, row))
+            template_id = self.index.id_at(row)
+            if similarity >= threshold and template_id is not None:
+                results.append((template_id, similarity))
+                results.sort(key=lambda result: -result[1])
+                del results[top_k:]
+
+        if self.overlay is not None and len(self.overlay):
+            results = sorted(results + self.overlay.search(probe, top_k, threshold), key=lambda result: -result[1])
+            del results[top_k:]
+        return results
+
+    def match_employees(self, probe: Dict[str, Any], employees: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Find the employee whose stored template matches a probe best, scoring the packed rows.
+
+        Args:
+            probe: Probe feature set
+            employees: Employee references with employeeId and documentId
+
+        Returns:
+            Validation result like RetinaProcessor.match_employees, or None if the probe cannot be
+            scored against the gallery or a referenced template is not in it (callers then compare
+            full-precision templates instead)
+        """
+        references = []
+        for employee in employees:
+            if not employee.get("documentId"):
+                logger.warning(f"Missing documentId for employee: {employee.get('employeeId')}")
+                continue
+            references.append((employee.get("employeeId"), employee["documentId"]))
+        if any(document_id not in self for _, document_id in references):
+            return None
+        try:
+            similarities = self.score(probe, [document_id for _, document_id in references]).tolist()
+        except (ProfileMismatchError, KeyError):
+            return None
+
+        matching_employee_id = None
+        highest_similarity = 0.0
+        for (employee_id, _), similarity in zip(references, similarities):
+            if similarity >= self.processor.similarity_threshold and similarity > highest_similarity:
+                highest_similarity = similarity
+                matching_employee_id = employee_id
+        return {
+            "status": "success",
+            "matchingEmployeeId": matching_employee_id,
+            "similarity": highest_similarity if matching_employee_id else 0.0
+        }
+
+    def _vector_scores(self, probe: Dict[str, Any], rows: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        """Weighted similarity of every feature except the bifurcation points, for the given rows."""
+        scores = np.zeros(len(rows), dtype=np.float64)
+        if not self._dims:
+            return scores
+
+        probe_vectors = {}
+        for key in self._dims:
+            vector = np.asarray(probe[key], dtype=np.float32)
+            probe_vectors[key] = vector / max(float(np.linalg.norm(vector)), np.finfo(np.float32).eps)
+
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            for key, weight in VECTOR_FEATURES.items():
+                # Scales cancel out in the cosine similarity, so quantized rows are used as they are
+                stored = self._unpack(self.vectors[key][chunk])
+                norms = np.maximum(np.linalg.norm(stored, axis=1), np.finfo(np.float32).eps)
+                scores[start:start + len(chunk)] += weight * (stored @ probe_vectors[key]) / norms
+
+        density, length, width = self.statistics[rows].astype(np.float64).T
+        scores += 0.1 * (1 - np.minimum(np.abs(probe["blood_vessel_density"] - density), 1))
+        scores += 0.1 * self._ratio_similarity(probe["avg_vessel_length"], length)
+        scores += 0.05 * self._ratio_similarity(probe["avg_vessel_width"], width)
+        return scores
+
+    @staticmethod
+    def _ratio_similarity(value: float, values: np.ndarray) -> np.ndarray:
+        """Similarity of two positive statistics by their relative difference."""
+        return 1 - np.minimum(np.abs(value - values) / (np.maximum(value, values) + 1e-7), 1)
+
+    def _bifurcation_similarity(self, probe: Dict[str, Any], row: int) -> float:
+        """Match a probe's bifurcation points with a stored template's."""
+        offset, count = int(self.point_offsets[row]), int(self.point_counts[row])
+        profile, _ = get_template_profile(probe)
+        return self.processor.compare_bifurcation_points(
+            probe["bifurcation_points"], self.points[offset:offset + count].tolist(), profile
+        )
+
+    def _quantize(self, values: List[float]) -> Tuple[np.ndarray, float]:
+        """Scale a vector by its largest component and convert it to the storage type."""
+        vector = np.asarray(values, dtype=np.float32)
+        scale = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = scale or 1.0
+        if self.dtype == "int8":
+            return np.rint(vector / scale * self.levels).astype(np.int8), scale
+        if self.dtype == "int4":
+            # Two components per byte, offset to 1..15 so that a zero component is stored as 8
+            nibbles = (np.rint(vector / scale * self.levels) + 8).astype(np.uint8)
+            return nibbles[0::2] | (nibbles[1::2] << 4), scale
+        return (vector / scale).astype(np.float16), scale
+
+    def _unpack(self, stored: np.ndarray) -> np.ndarray:
+        """Quantized vector rows as float32 (without their scales)."""
+        if self.dtype != "int4":
+            return stored.astype(np.float32)
+        unpacked = np.empty((stored.shape[0], stored.shape[1] * 2), dtype=np.float32)
+        unpacked[:, 0::2] = (stored & 0x0F).astype(np.float32) - 8
+        unpacked[:, 1::2] = (stored >> 4).astype(np.float32) - 8
+        return unpacked
+
+    def _init_vectors(self, features: Dict[str, Any]) -> None:
+        """Allocate the vector arrays with the feature sizes of the first template."""
+        if self.dtype == "int4":
+            for key in VECTOR_FEATURES:
+                if len(features[key]) % 2:
+                    raise ProfileMismatchError(f"int4 galleries need an even number of {key} values, got {len(features[key])}")
+        dims = {key: len(features[key]) for key in VECTOR_FEATURES}
+        for key, dim in dims.items():
+            width = dim // 2 if self.dtype == "int4" else dim
+            self.vectors[key] = np.zeros((self._capacity, width), dtype=STORAGE_TYPES[self.dtype])
+            self.scales[key] = np.zeros(self._capacity, dtype=np.float32)
+        # Readers iterate the dimensions, so they are set once the arrays exist
+        self._dims = dims
+
+    def _grow_rows(self, capacity: int) -> None:
+        """Reallocate the per-template arrays with room for capacity rows."""
+        def grow(array: np.ndarray) -> np.ndarray:
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+
+        for key in self._dims:
+            self.vectors[key] = grow(self.vectors[key])
+            self.scales[key] = grow(self.scales[key])
+        self.statistics = grow(self.statistics)
+        self.point_offsets = grow(self.point_offsets)
+        self.point_counts = grow(self.point_counts)
+        self.active = grow(self.active)
+        self._capacity = capacity
+
+    def _grow_points(self, size: int) -> None:
+        """Reallocate the ragged point array with room for size points."""
+        grown = np.zeros((size, 2), dtype=np.uint16)
+        grown[:self._points_used] = self.points[:self._points_used]
+        self.points = grown
+
+
+def drift_report(gallery: TemplateGallery, probes: List[Dict[str, Any]],
+                 templates: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compare gallery scores with full-precision scores of the same templates.
+
+    Args:
+        gallery: Gallery holding the templates
+        probes: Probe feature sets
+        templates: Full-precision templates by ID, as stored in Cosmos DB
+
+    Returns:
+        Dictionary with similarity errors, match decision flips, rank-1 agreement and memory per template
+    """
+    template_ids = [template_id for template_id in templates if template_id in gallery]
+    full_precision = gallery.processor.compare_features_matrix(
+        probes, [templates[template_id] for template_id in template_ids]
+    )["overall_similarity"]
+    quantized = np.array([gallery.score(probe, template_ids) for probe in probes]).reshape(full_precision.shape)
+
+    threshold = gallery.processor.similarity_threshold
+    error = np.abs(quantized - full_precision)
+    # Ties (e.g. duplicate templates) count as agreement
+    rank1_agrees = (
+        full_precision[np.arange(len(probes)), quantized.argmax(axis=1)] >= full_precision.max(axis=1) - 1e-9
+        if error.size else []
+    )
+    values_per_template = sum(gallery._dims.values()) + 3 + 2 * gallery.max_points
+    return {
+        "dtype": gallery.dtype,
+        "probes": len(probes),
+        "templates": len(template_ids),
+        "max_abs_error": float(error.max()) if error.size else 0.0,
+        "mean_abs_error": float(error.mean()) if error.size else 0.0,
+        "decision_flips": int(np.count_nonzero((quantized >= threshold) != (full_precision >= threshold))),
+        "rank1_agreement": float(np.mean(rank1_agrees)) if error.size else 1.0,
+        "bytes_per_template": gallery.nbytes / max(1, gallery.count),
+        "float64_bytes_per_template": 8 * values_per_template
+    }
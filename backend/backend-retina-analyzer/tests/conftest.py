@@ -0,0 +1,7 @@
+"""
+Shared pytest configuration: the service modules are imported from the service directory.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,94 @@
+"""
+Tests of batch slot admission and release in the API's batch routes.
+"""
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+import app
+
+
+@pytest.fixture(autouse=True)
+def no_running_batches(monkeypatch):
+    monkeypatch.setattr(app, "running_batches", 0)
+
+
+def run_stream(stream):
+    async def consume():
+        return [line async for line in stream]
+    return asyncio.run(consume())
+
+
+def test_finished_stream_releases_its_slot():
+    release = app._admit_batch(3)
+    assert app.running_batches == 1
+
+    lines = run_stream(app._stream_batch([None] * 3, lambda index, item: {"index": index}, release=release))
+    assert len(lines) == 3
+    assert app.running_batches == 0
+    # The response's background task releases the same slot again without effect
+    asyncio.run(release())
+    assert app.running_batches == 0
+
+
+def test_failing_stream_releases_its_slot():
+    def flush(records):
+        raise RuntimeError("Cosmos DB is down")
+
+    release = app._admit_batch(2)
+    with pytest.raises(RuntimeError):
+        run_stream(app._stream_batch([None] * 2, lambda index, item: {"index": index}, flush=flush, release=release))
+    assert app.running_batches == 0
+
+
+def test_full_slots_are_refused(monkeypatch):
+    monkeypatch.setattr(app, "MAX_CONCURRENT_BATCHES", 1)
+    release = app._admit_batch(1)
+    with pytest.raises(HTTPException) as error:
+        app._admit_batch(1)
+    assert error.value.status_code == 429
+    asyncio.run(release())
+    asyncio.run(app._admit_batch(1)())
+    assert app.running_batches == 0
+
+
+class BlockingCosmosClient:
+    def __init__(self):
+        self.started = threading.Event()
+        self.unblock = threading.Event()
+
+    def get_features_many(self, document_ids):
+        self.started.set()
+        self.unblock.wait(5)
+        return {}
+
+
+class EmptyTemplateCache:
+    def get(self, document_id):
+        return None
+
+
+def test_validation_cancelled_while_loading_templates_releases_its_slot(monkeypatch):
+    cosmos_client = BlockingCosmosClient()
+    monkeypatch.setattr(app, "ready", True)
+    monkeypatch.setattr(app, "cosmos_client", cosmos_client)
+    monkeypatch.setattr(app, "template_cache", EmptyTemplateCache())
+    monkeypatch.setattr(app, "template_gallery", None)
+    request = app.BatchValidationRequest(items=[{
+        "image_path": "a.png", "messageId": "m1", "employees": [{"employeeId": "e1", "documentId": "d1"}]
+    }])
+
+    async def run():
+        task = asyncio.create_task(app.validate_batch(request))
+        while not cosmos_client.started.is_set():
+            await asyncio.sleep(0.01)
+        assert app.running_batches == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(run())
+    finally:
+        cosmos_client.unblock.set()
+    assert app.running_batches == 0
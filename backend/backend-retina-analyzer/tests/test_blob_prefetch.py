@@ -0,0 +1,146 @@
+"""
+Tests of blob image prefetching, with a fake async blob client.
+"""
+import asyncio
+import cv2
+import numpy as np
+from blob_prefetch import BlobPrefetcher
+from feature_set import FeatureSet
+from probe_cache import ProbeCache
+
+
+def encode(height, width=32):
+    image = np.full((height, width, 3), 128, dtype=np.uint8)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+class FakeBlobClient:
+    def __init__(self, blobs, delay=0.0):
+        self.blobs = blobs
+        self.delay = delay
+        self.downloads = []
+        self.etag_reads = []
+
+    async def download_blob_bytes(self, blob_path):
+        self.downloads.append(blob_path)
+        await asyncio.sleep(self.delay)
+        return self.blobs.get(blob_path)
+
+    async def get_blob_etag(self, blob_path):
+        self.etag_reads.append(blob_path)
+        return f"etag-{blob_path}" if blob_path in self.blobs else None
+
+
+def test_prefetched_image_is_served_from_the_buffer():
+    async def run():
+        client = FakeBlobClient({"a.png": encode(16)}, delay=0.01)
+        prefetcher = BlobPrefetcher(client, max_bytes=10 ** 6)
+        assert prefetcher.prefetch("a.png")
+        image = await prefetcher.get("a.png")
+        prefetcher.release("a.png")
+        return client, prefetcher, image
+
+    client, prefetcher, image = asyncio.run(run())
+    assert image.shape == (16, 32, 3)
+    assert client.downloads == ["a.png"]
+    stats = prefetcher.stats()
+    assert (stats["hits"], stats["misses"], stats["buffered"], stats["held_bytes"]) == (1, 0, 0, 0)
+
+
+def test_budget_skips_prefetches_and_release_frees_it():
+    async def run():
+        client = FakeBlobClient({name: encode(64) for name in ("a.png", "b.png", "c.png")})
+        image_bytes = 64 * 32 * 3
+        prefetcher = BlobPrefetcher(client, max_bytes=int(image_bytes * 1.5))
+        prefetcher._expected_bytes = image_bytes
+
+        # One image is always prefetched; the second would exceed the budget
+        assert prefetcher.prefetch("a.png")
+        assert not prefetcher.prefetch("b.png")
+        await prefetcher.get("a.png")
+        assert prefetcher.held_bytes == image_bytes
+
+        prefetcher.release("a.png")
+        assert prefetcher.held_bytes == 0
+        assert prefetcher.prefetch("c.png")
+        # A skipped image is loaded when its handler asks for it
+        assert (await prefetcher.get("b.png")).shape == (64, 32, 3)
+        prefetcher.release("b.png")
+        prefetcher.release("c.png")
+        await asyncio.sleep(0)
+        return prefetcher
+
+    prefetcher = asyncio.run(run())
+    stats = prefetcher.stats()
+    assert (stats["prefetched"], stats["skipped"], stats["misses"]) == (2, 1, 1)
+    assert stats["held_bytes"] == 0 and stats["buffered"] == 0
+
+
+def test_duplicate_messages_share_one_download_until_all_release():
+    async def run():
+        client = FakeBlobClient({"a.png": encode(16)}, delay=0.01)
+        prefetcher = BlobPrefetcher(client, max_bytes=10 ** 6)
+        assert prefetcher.prefetch("a.png")
+        assert prefetcher.prefetch("a.png")
+        first, second = await asyncio.gather(prefetcher.get("a.png"), prefetcher.get("a.png"))
+        prefetcher.release("a.png")
+        still_buffered = prefetcher.stats()["buffered"]
+        prefetcher.release("a.png")
+        return client, prefetcher, first is second, still_buffered
+
+    client, prefetcher, shared, still_buffered = asyncio.run(run())
+    assert client.downloads == ["a.png"]
+    assert shared
+    assert still_buffered == 1
+    assert prefetcher.stats()["buffered"] == 0
+
+
+def test_release_cancels_an_unfinished_download():
+    async def run():
+        client = FakeBlobClient({"a.png": encode(16)}, delay=1.0)
+        prefetcher = BlobPrefetcher(client, max_bytes=10 ** 6)
+        prefetcher.prefetch("a.png")
+        await asyncio.sleep(0.01)
+        task = prefetcher._entries["a.png"][0]
+        prefetcher.release("a.png")
+        await asyncio.sleep(0.01)
+        return prefetcher, task
+
+    prefetcher, task = asyncio.run(run())
+    assert task.cancelled()
+    assert prefetcher.held_bytes == 0
+
+
+def test_unreadable_and_missing_images_are_none():
+    async def run():
+        client = FakeBlobClient({"broken.png": b"not an image"})
+        prefetcher = BlobPrefetcher(client, max_bytes=0)
+        assert not prefetcher.prefetch("broken.png")
+        return await prefetcher.get("broken.png"), await prefetcher.get("missing.png")
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_cached_probe_features_skip_the_download():
+    async def run():
+        client = FakeBlobClient({"a.png": encode(16)})
+        cache = ProbeCache(max_bytes=10 ** 6, ttl=60)
+        cache.put("a.png", "etag-a.png", FeatureSet(id="a", profile="standard", hog_features=[1.0]))
+        prefetcher = BlobPrefetcher(client, max_bytes=10 ** 6, probe_cache=cache)
+
+        prefetcher.prefetch("a.png")
+        etag = await prefetcher.get_etag("a.png")
+        # Features are cached for this version, so nothing is downloaded or held
+        image = await asyncio.shield(prefetcher._entries["a.png"][0])
+        held = prefetcher.held_bytes
+        # A handler needing another profile still gets the image
+        loaded = await prefetcher.get("a.png")
+        prefetcher.release("a.png")
+        return client, etag, image, held, loaded
+
+    client, etag, image, held, loaded = asyncio.run(run())
+    assert etag == "etag-a.png"
+    assert image is None and held == 0
+    assert loaded.shape == (16, 32, 3)
+    assert client.etag_reads == ["a.png"]
+    assert client.downloads == ["a.png"]
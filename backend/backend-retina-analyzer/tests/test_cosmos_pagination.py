@@ -0,0 +1,94 @@
+"""
+Tests of keyset-paginated Cosmos DB queries, against a container stand-in.
+"""
+import re
+import pytest
+from cosmos_db import CosmosDBClient
+
+
+class FakeContainer:
+    """Evaluates the keyset queries of iter_feature_pages on a list of documents."""
+    def __init__(self, documents):
+        self.documents = sorted(documents, key=lambda document: document["id"])
+        self.queries = []
+
+    def query_items(self, query, parameters, enable_cross_partition_query, partition_key, max_item_count):
+        self.queries.append((query, {p["name"]: p["value"] for p in parameters}, partition_key))
+        values = self.queries[-1][1]
+        projection = re.match(r"SELECT TOP @limit (.*) FROM c", query).group(1)
+        fields = None if projection == "*" else [field.split(".", 1)[1] for field in projection.split(", ")]
+
+        matches = [d for d in self.documents if d["id"] > values["@after"]]
+        if "c.person_id = @person_id" in query:
+            matches = [d for d in matches if d.get("person_id") == values["@person_id"]]
+        page = matches[:values["@limit"]]
+        return iter([d if fields is None else {f: d[f] for f in fields if f in d} for d in page])
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.delenv("COSMOS_ENDPOINT", raising=False)
+    client = CosmosDBClient()
+    documents = [
+        {"id": f"doc-{i:02d}", "person_id": f"person-{i % 3}", "profile": "standard", "hog_features": [i] * 4}
+        for i in range(10)
+    ]
+    client.container = FakeContainer(documents)
+    return client
+
+
+def test_pages_cover_every_item_once_in_id_order(client):
+    pages = list(client.iter_feature_pages(page_size=4))
+
+    assert [len(items) for items, _ in pages] == [4, 4, 2]
+    assert [token for _, token in pages] == ["doc-03", "doc-07", None]
+    ids = [item["id"] for items, _ in pages for item in items]
+    assert ids == [f"doc-{i:02d}" for i in range(10)]
+    # Each page is its own TOP query after the previous page's last ID
+    assert [values["@after"] for _, values, _ in client.container.queries] == ["", "doc-03", "doc-07"]
+
+
+def test_continuation_token_resumes_after_its_page(client):
+    _, token = next(client.iter_feature_pages(page_size=4))
+
+    # A new client, e.g. in another process, resumes from the token alone
+    resumed = [item["id"] for item in client.iter_features(page_size=4, continuation=token)]
+    assert resumed == [f"doc-{i:02d}" for i in range(4, 10)]
+
+
+def test_full_last_page_ends_with_an_empty_page(client):
+    pages = list(client.iter_feature_pages(page_size=5))
+    assert [(len(items), token) for items, token in pages] == [(5, "doc-04"), (5, "doc-09"), (0, None)]
+
+
+def test_projection_and_filter(client):
+    items = list(client.iter_features(
+        where="c.person_id = @person_id",
+        parameters=[{"name": "@person_id", "value": "person-1"}],
+        fields=["profile", "id", "profile"],
+        page_size=2
+    ))
+
+    assert items == [{"id": f"doc-{i:02d}", "profile": "standard"} for i in (1, 4, 7)]
+    query = client.container.queries[0][0]
+    assert "SELECT TOP @limit c.id, c.profile FROM c" in query
+    assert "WHERE c.id > @after AND (c.person_id = @person_id) ORDER BY c.id" in query
+
+
+def test_person_partition_reads_one_partition(client):
+    client.partition_key_path = "/person_id"
+    features = client.get_features_by_person_id("person-2", fields=["hog_features"])
+
+    assert [feature["id"] for feature in features] == ["doc-02", "doc-05", "doc-08"]
+    assert {partition_key for _, _, partition_key in client.container.queries} == {"person-2"}
+
+
+def test_invalid_field_names_are_refused(client):
+    with pytest.raises(ValueError):
+        list(client.iter_features(fields=["profile", "c.id) OR (1=1"]))
+
+
+def test_disconnected_client_raises(client):
+    client.container = None
+    with pytest.raises(ConnectionError):
+        list(client.iter_features())
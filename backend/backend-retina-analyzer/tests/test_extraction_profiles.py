@@ -0,0 +1,69 @@
+"""
+Tests of extraction profile compatibility and template conversion.
+"""
+import pytest
+from extraction_profiles import ProfileMismatchError, convert_features, get_profile
+from retina_processor import RetinaProcessor
+from test_template_gallery import make_features
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return RetinaProcessor(profile="standard")
+
+
+def test_profiles_with_the_same_vector_layout_are_compatible():
+    assert get_profile("fast").is_compatible(get_profile("standard"))
+    assert not get_profile("high_accuracy").is_compatible(get_profile("standard"))
+    assert not get_profile("high_accuracy").is_compatible(get_profile("fast"))
+
+
+def test_conversion_rescales_pixel_measurements():
+    features = make_features(0, profile="fast", size=128)
+    features["optic_disc_center"] = (40, 60)
+    features["optic_disc_radius"] = 9
+
+    converted = convert_features(features, get_profile("fast"), get_profile("standard"))
+    assert converted["profile"] == "standard"
+    assert converted["bifurcation_points"].tolist() == [[2 * x, 2 * y] for x, y in features["bifurcation_points"]]
+    assert converted["avg_vessel_length"] == pytest.approx(2 * features["avg_vessel_length"])
+    assert converted["avg_vessel_width"] == pytest.approx(2 * features["avg_vessel_width"])
+    assert (converted["optic_disc_center"], converted["optic_disc_radius"]) == ((80, 120), 18)
+    # Vectors and ratios do not depend on the resolution
+    assert converted["hog_features"] == features["hog_features"]
+    assert converted["blood_vessel_density"] == features["blood_vessel_density"]
+    assert features["profile"] == "fast"
+
+    # Points beyond the smaller profile's maximum are dropped
+    back = convert_features(converted, get_profile("standard"), get_profile("fast"))
+    assert back["bifurcation_points"].tolist() == [list(point) for point in features["bifurcation_points"][:30]]
+
+    with pytest.raises(ProfileMismatchError):
+        convert_features(features, get_profile("fast"), get_profile("high_accuracy"))
+
+
+def test_converted_fast_template_matches_its_standard_extraction(processor):
+    standard = make_features(0)
+    fast = dict(standard, profile="fast", avg_vessel_length=standard["avg_vessel_length"] / 2,
+                avg_vessel_width=standard["avg_vessel_width"] / 2,
+                bifurcation_points=[(x // 2, y // 2) for x, y in standard["bifurcation_points"]])
+
+    result = processor.compare_features(standard, fast)
+    assert result["overall_similarity"] > 0.99
+    assert result["is_match"]
+    # The matrix comparison converts templates of other compatible profiles the same way
+    matrix = processor.compare_features_matrix([standard], [fast, make_features(1)])
+    assert matrix["compatible"].tolist() == [True, True]
+    assert matrix["overall_similarity"][0, 0] == pytest.approx(result["overall_similarity"])
+
+
+def test_incompatible_profiles_are_refused_by_both_comparisons(processor):
+    standard = make_features(0)
+    high_accuracy = make_features(0, profile="high_accuracy", size=512)
+
+    with pytest.raises(ProfileMismatchError):
+        processor.compare_features(standard, high_accuracy)
+    matrix = processor.compare_features_matrix([standard], [high_accuracy])
+    assert matrix["compatible"].tolist() == [False]
+    assert matrix["overall_similarity"][0, 0] == 0.0
+    assert not matrix["is_match"][0, 0]
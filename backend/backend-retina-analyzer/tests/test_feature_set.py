@@ -0,0 +1,99 @@
+"""
+Tests of the FeatureSet container and its serialization.
+"""
+import json
+import numpy as np
+import orjson
+import pytest
+from feature_set import FeatureSet, as_feature_set, dumps
+
+
+def make_document():
+    return {
+        "id": "doc-1",
+        "person_id": "person-1",
+        "lbp_histogram": [0.1, 0.2, 0.7],
+        "hog_features": [0.5, 0.25],
+        "vessel_spatial_distribution": [0.0, 1.0],
+        "blood_vessel_density": 0.12,
+        "avg_vessel_length": 21.5,
+        "avg_vessel_width": 3.25,
+        "vessel_count": 14,
+        "optic_disc_center": [120, 96],
+        "bifurcation_points": [[1, 2], [3, 4]],
+        "profile": "standard",
+        "extractor_version": "2.0",
+        "_etag": "\"0000\""
+    }
+
+
+def test_behaves_like_the_document_dictionary():
+    document = make_document()
+    features = FeatureSet(document)
+
+    assert len(features) == len(document)
+    assert set(features) == set(document)
+    assert features["person_id"] == "person-1"
+    assert features.get("missing") is None
+    assert "optic_disc_radius" not in features and "hog_features" in features
+    with pytest.raises(KeyError):
+        features["optic_disc_radius"]
+
+    features["id"] = "doc-2"
+    features.update({"person_id": "person-2", "note": "x"})
+    del features["_etag"]
+    assert (features["id"], features["person_id"], features["note"]) == ("doc-2", "person-2", "x")
+    assert "_etag" not in features
+    with pytest.raises(KeyError):
+        del features["timestamp"]
+
+
+def test_vectors_and_points_are_arrays_copied_from_their_source():
+    buffer = np.array([1.0, 2.0], dtype=np.float32)
+    features = FeatureSet(hog_features=buffer, bifurcation_points=[(5, 6), (7, 8)])
+    buffer[:] = 0
+
+    assert features["hog_features"].dtype == np.float64
+    assert features["hog_features"].tolist() == [1.0, 2.0]
+    assert features["bifurcation_points"].shape == (2, 2)
+    assert features["bifurcation_points"].dtype == np.int64
+
+
+def test_copy_is_shallow_like_a_dictionary_copy():
+    features = FeatureSet(make_document())
+    copied = features.copy()
+    copied["person_id"] = "someone else"
+    copied["id"] = "other"
+
+    assert features["person_id"] == "person-1"
+    assert features["id"] == "doc-1"
+    assert copied["hog_features"] is features["hog_features"]
+
+
+def test_orjson_round_trip():
+    document = make_document()
+    features = FeatureSet.from_document(document)
+
+    encoded = features.to_json()
+    assert json.loads(encoded) == document
+    assert FeatureSet.from_document(encoded).to_document() == document
+    assert as_feature_set(encoded.decode("utf-8"))["bifurcation_points"].tolist() == [[1, 2], [3, 4]]
+    assert as_feature_set(features) is features
+
+
+def test_dumps_handles_nested_feature_sets_and_numpy_values():
+    features = FeatureSet(make_document())
+    message = {
+        "features": features,
+        "similarity": np.float32(0.5),
+        "scores": np.arange(4, dtype=np.float16)[::2],
+        "points": (1, 2)
+    }
+
+    decoded = orjson.loads(dumps(message))
+    assert decoded["features"] == make_document()
+    assert decoded["similarity"] == 0.5
+    assert decoded["scores"] == [0.0, 2.0]
+    assert decoded["points"] == [1, 2]
+    with pytest.raises(TypeError):
+        dumps({"value": object()})
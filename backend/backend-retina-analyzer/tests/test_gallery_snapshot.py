@@ -0,0 +1,123 @@
+"""
+Tests of gallery snapshot files.
+"""
+import json
+import time
+import numpy as np
+import pytest
+import main
+from gallery_snapshot import PREAMBLE, SnapshotFormatError, open_snapshot, read_header, write_snapshot
+from retina_processor import RetinaProcessor
+from template_gallery import TemplateGallery
+from test_template_gallery import make_features
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return RetinaProcessor(profile="standard")
+
+
+@pytest.fixture
+def gallery(processor):
+    gallery = TemplateGallery(processor)
+    for seed in range(5):
+        gallery.add(f"template-{seed}", make_features(seed))
+    gallery.remove("template-3")
+    return gallery
+
+
+def test_snapshot_round_trip(tmp_path, processor, gallery):
+    path = str(tmp_path / "gallery.snapshot")
+    header = write_snapshot(gallery, path, continuation="42")
+
+    assert header["count"] == 4
+    assert read_header(path)["continuation"] == "42"
+    opened = open_snapshot(path, processor)
+    assert len(opened) == 4
+    assert sorted(opened.ids()) == ["template-0", "template-1", "template-2", "template-4"]
+    assert "template-3" not in opened
+    for template_id in opened.ids():
+        assert opened.get(template_id) == gallery.get(template_id)
+    probe = make_features(1)
+    assert np.allclose(opened.score(probe, ["template-1", "template-4"]),
+                       gallery.score(probe, ["template-1", "template-4"]))
+    assert opened.search(probe, threshold=0.0)[0][0] == "template-1"
+
+
+def test_snapshot_columns_are_memory_mapped_read_only(tmp_path, processor, gallery):
+    path = str(tmp_path / "gallery.snapshot")
+    write_snapshot(gallery, path)
+    opened = open_snapshot(path, processor)
+
+    assert isinstance(opened.statistics, np.memmap)
+    assert not opened.statistics.flags.writeable
+    # Changes go to the overlay and hide the mapped rows
+    opened.add("template-0", make_features(9))
+    opened.add("template-new", make_features(10))
+    opened.remove("template-1")
+    assert opened.get("template-0")["avg_vessel_length"] == pytest.approx(make_features(9)["avg_vessel_length"])
+    assert sorted(opened.ids()) == ["template-0", "template-2", "template-4", "template-new"]
+
+    # Writing the opened gallery folds the overlay into the new snapshot
+    rewritten = str(tmp_path / "rewritten.snapshot")
+    write_snapshot(opened, rewritten)
+    reopened = open_snapshot(rewritten, processor)
+    assert sorted(reopened.ids()) == ["template-0", "template-2", "template-4", "template-new"]
+    assert reopened.get("template-new") == opened.get("template-new")
+
+
+def test_empty_gallery_round_trip(tmp_path, processor):
+    path = str(tmp_path / "empty.snapshot")
+    write_snapshot(TemplateGallery(processor), path)
+    opened = open_snapshot(path, processor)
+    assert len(opened) == 0
+    assert opened.get("missing") is None
+
+
+def test_unreadable_files_are_refused(tmp_path, processor, gallery):
+    not_a_snapshot = tmp_path / "other.bin"
+    not_a_snapshot.write_bytes(b"not a snapshot at all")
+    with pytest.raises(SnapshotFormatError):
+        read_header(str(not_a_snapshot))
+
+    path = tmp_path / "gallery.snapshot"
+    write_snapshot(gallery, str(path))
+    data = bytearray(path.read_bytes())
+    magic, _, header_size = PREAMBLE.unpack_from(data)
+    data[:PREAMBLE.size] = PREAMBLE.pack(magic, 1, header_size)
+    path.write_bytes(bytes(data))
+    with pytest.raises(SnapshotFormatError):
+        open_snapshot(str(path), processor)
+
+
+def test_snapshot_reads_are_gated_on_age(tmp_path, processor, gallery, monkeypatch):
+    path = tmp_path / "gallery.snapshot"
+    write_snapshot(gallery, str(path))
+    assert open_snapshot(str(path), processor).is_fresh()
+
+    # A snapshot created an hour ago is stale until a sync catches it up
+    data = bytearray(path.read_bytes())
+    _, _, header_size = PREAMBLE.unpack_from(data)
+    header = json.loads(bytes(data[PREAMBLE.size:PREAMBLE.size + header_size]))
+    header["created"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - 3600))
+    data[PREAMBLE.size:PREAMBLE.size + header_size] = json.dumps(header).encode("utf-8").ljust(header_size, b" ")
+    path.write_bytes(bytes(data))
+
+    opened = open_snapshot(str(path), processor)
+    assert not opened.is_fresh()
+    opened.updated = time.time()
+    assert opened.is_fresh()
+
+    monkeypatch.setenv("GALLERY_MAX_STALENESS", "0")
+    assert open_snapshot(str(path), processor).is_fresh()
+
+
+def test_unreadable_snapshot_leaves_the_service_without_a_gallery(tmp_path, monkeypatch):
+    path = tmp_path / "gallery.snapshot"
+    path.write_bytes(b"not a snapshot")
+    for name in ("COSMOS_ENDPOINT", "AZURE_SERVICE_BUS_CONNECTION_STRING", "AZURE_STORAGE_CONNECTION_STRING"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("GALLERY_SNAPSHOT", str(path))
+
+    service = main.RetinaAnalyzerService()
+    assert service.gallery is None and service.gallery_sync is None
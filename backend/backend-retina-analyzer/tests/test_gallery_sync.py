@@ -0,0 +1,146 @@
+"""
+Tests of the gallery sync with a local change feed.
+"""
+import pytest
+from gallery_snapshot import open_snapshot, read_header, snapshot_identity, write_snapshot
+from gallery_sync import GallerySync, LocalChangeFeed
+from retina_processor import RetinaProcessor
+from template_gallery import TemplateGallery
+from test_template_gallery import make_features
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return RetinaProcessor(profile="standard")
+
+
+def document(template_id, seed, **fields):
+    return {"id": template_id, **make_features(seed), **fields}
+
+
+@pytest.fixture
+def feed():
+    feed = LocalChangeFeed()
+    for seed, template_id in enumerate(("a", "b", "c")):
+        feed.upsert(document(template_id, seed))
+    return feed
+
+
+def build_snapshot(path, processor, feed):
+    gallery = TemplateGallery(processor)
+    continuation = feed.current()
+    items, _ = feed.read(None)
+    gallery.add_many((item["id"], item) for item in items)
+    write_snapshot(gallery, path, continuation)
+    return path
+
+
+def start_process(path, processor, feed, state_path=None):
+    """Open the snapshot and create its sync, as the API and the worker do at startup."""
+    gallery = open_snapshot(path, processor)
+    header = read_header(path)
+    return GallerySync(gallery, feed, state_path=state_path, continuation=header["continuation"],
+                       poll_interval=0, reconcile_interval=0, snapshot=snapshot_identity(header))
+
+
+def similarity(gallery, features, template_id):
+    return float(gallery.score(features, [template_id])[0])
+
+
+def test_sync_applies_inserts_updates_and_deletes(tmp_path, processor, feed):
+    path = build_snapshot(str(tmp_path / "gallery.snapshot"), processor, feed)
+    sync = start_process(path, processor, feed)
+
+    feed.upsert(document("a", 10))
+    feed.upsert(document("d", 11))
+    feed.upsert(document("b", 1, deleted=True))
+    feed.upsert({"id": "e", "profile": "fast"})
+    assert sync.sync_once() == 4
+    assert sync.sync_once() == 0
+
+    assert sorted(sync.gallery.ids()) == ["a", "c", "d"]
+    assert similarity(sync.gallery, make_features(10), "a") > 0.99
+    assert sync.stats()["skipped"] == 1
+
+    feed.delete("c")
+    assert sync.reconcile() == 1
+    assert sorted(sync.gallery.ids()) == ["a", "d"]
+
+
+def test_restart_restores_changes_made_since_the_snapshot(tmp_path, processor, feed):
+    path = build_snapshot(str(tmp_path / "gallery.snapshot"), processor, feed)
+    state_path = str(tmp_path / "sync.json")
+
+    first = start_process(path, processor, feed, state_path)
+    feed.upsert(document("a", 10))
+    feed.upsert(document("b", 1, deleted=True))
+    first.sync_once()
+    re_enrolled = similarity(first.gallery, make_features(10), "a")
+    assert re_enrolled > 0.99
+    first.stop()
+
+    restarted = start_process(path, processor, feed, state_path)
+    assert restarted.restored
+    assert restarted.sync_once() == 0
+    assert similarity(restarted.gallery, make_features(10), "a") == pytest.approx(re_enrolled)
+    assert sorted(restarted.gallery.ids()) == ["a", "c"]
+
+    # Later changes are applied on top and persisted again
+    feed.upsert(document("c", 12))
+    assert restarted.sync_once() == 1
+    restarted.stop()
+    again = start_process(path, processor, feed, state_path)
+    assert similarity(again.gallery, make_features(12), "c") > 0.99
+    assert len(list(tmp_path.glob("*.overlay"))) == 1
+
+
+def test_state_of_another_snapshot_is_ignored(tmp_path, processor, feed):
+    state_path = str(tmp_path / "sync.json")
+    old = build_snapshot(str(tmp_path / "old.snapshot"), processor, feed)
+    first = start_process(old, processor, feed, state_path)
+    feed.upsert(document("a", 10))
+    first.sync_once()
+    first.stop()
+
+    # A rebuilt snapshot already holds the change; later ones are read from its continuation
+    feed.upsert(document("b", 11))
+    rebuilt = build_snapshot(str(tmp_path / "new.snapshot"), processor, feed)
+    feed.upsert(document("c", 12))
+    sync = start_process(rebuilt, processor, feed, state_path)
+    assert not sync.restored
+    assert sync.sync_once() == 1
+    for template_id, seed in (("a", 10), ("b", 11), ("c", 12)):
+        assert similarity(sync.gallery, make_features(seed), template_id) > 0.99
+
+
+def test_only_one_process_writes_the_state(tmp_path, processor, feed):
+    path = build_snapshot(str(tmp_path / "gallery.snapshot"), processor, feed)
+    state_path = str(tmp_path / "sync.json")
+    writer = start_process(path, processor, feed, state_path)
+    other = start_process(path, processor, feed, state_path)
+
+    feed.upsert(document("a", 10))
+    writer.sync_once()
+    other.sync_once()
+    assert writer._writer and not other._writer
+
+    # The other process's gallery is still up to date, only its state is not written
+    assert similarity(other.gallery, make_features(10), "a") > 0.99
+    feed.upsert(document("b", 11))
+    other.sync_once()
+    restarted = start_process(path, processor, feed, state_path)
+    assert restarted.sync_once() == 1
+    writer.stop()
+    other.stop()
+
+
+def test_without_state_a_restart_replays_from_the_snapshot(tmp_path, processor, feed):
+    path = build_snapshot(str(tmp_path / "gallery.snapshot"), processor, feed)
+    first = start_process(path, processor, feed)
+    feed.upsert(document("a", 10))
+    first.sync_once()
+
+    restarted = start_process(path, processor, feed)
+    assert not restarted.restored
+    assert restarted.sync_once() == 1
+    assert similarity(restarted.gallery, make_features(10), "a") > 0.99
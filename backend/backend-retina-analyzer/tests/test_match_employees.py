@@ -0,0 +1,36 @@
+"""
+Tests of the employee matching shared by the API and the Service Bus worker.
+"""
+from retina_processor import RetinaProcessor
+
+
+def make_processor(scores):
+    processor = RetinaProcessor.__new__(RetinaProcessor)
+    processor.compare_features = lambda probe, template: {
+        "overall_similarity": scores[template["id"]], "is_match": scores[template["id"]] >= 0.8
+    }
+    return processor
+
+
+def test_best_matching_employee_wins():
+    processor = make_processor({"d1": 0.85, "d2": 0.95, "d3": 0.5})
+    employees = [{"employeeId": f"e{i}", "documentId": f"d{i}"} for i in (1, 2, 3)]
+
+    result = processor.match_employees({}, employees, lambda document_id, employee_id: {"id": document_id})
+
+    assert result == {"status": "success", "matchingEmployeeId": "e2", "similarity": 0.95}
+
+
+def test_missing_and_unreadable_templates_are_skipped():
+    processor = make_processor({"d2": 0.5})
+    employees = [{"employeeId": "e1"}, {"employeeId": "e2", "documentId": "d2"},
+                 {"employeeId": "e3", "documentId": "missing"}]
+
+    def get_template(document_id, employee_id):
+        if document_id == "missing":
+            raise ValueError(f"Item with ID {document_id} not found")
+        return {"id": document_id}
+
+    result = processor.match_employees({}, employees, get_template)
+
+    assert result == {"status": "success", "matchingEmployeeId": None, "similarity": 0.0}
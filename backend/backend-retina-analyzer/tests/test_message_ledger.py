@@ -0,0 +1,73 @@
+"""
+Tests of the message ledger, with a fake Cosmos DB container.
+"""
+from azure.cosmos import exceptions
+from message_ledger import MessageLedger
+from ru_limiter import RequestUnitLimiter
+from test_ru_limiter import throttled
+
+
+class FakeContainer:
+    """Stores items in a dictionary, failing the first requests with the given errors."""
+    def __init__(self, errors=()):
+        self.items = {}
+        self.errors = list(errors)
+        self.calls = 0
+
+    def _request(self, response_hook):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        response_hook({"x-ms-request-charge": "1"}, None)
+
+    def read_item(self, item, partition_key, response_hook):
+        self._request(response_hook)
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return self.items[item]
+
+    def upsert_item(self, body, response_hook):
+        self._request(response_hook)
+        self.items[body["id"]] = body
+        return body
+
+
+def make_ledger(container, monkeypatch):
+    monkeypatch.delenv("LEDGER_COSMOS_CONTAINER", raising=False)
+    ledger = MessageLedger(ttl=60, max_entries=2)
+    ledger.container = container
+    ledger.limiter = RequestUnitLimiter(ru_per_second=0, concurrency=1, max_retries=2)
+    return ledger
+
+
+def test_entries_are_shared_through_the_container(monkeypatch):
+    container = FakeContainer()
+    ledger = make_ledger(container, monkeypatch)
+    key = MessageLedger.make_key("validation", {"messageId": "m1"})
+    ledger.record(key, {"status": "success"})
+
+    # Another instance finds the entry in the container
+    other = make_ledger(container, monkeypatch)
+    assert other.get(key) == {"status": "success"}
+    assert other.get("validation:unknown") is None
+    assert other.limiter.stats()["requests"] == 2
+
+
+def test_container_requests_go_through_the_limiter(monkeypatch):
+    container = FakeContainer(errors=[throttled("1")])
+    ledger = make_ledger(container, monkeypatch)
+    ledger.record("validation:m1", {"status": "success"})
+
+    assert container.calls == 2
+    assert ledger.limiter.stats()["throttles"] == 1
+    assert "validation:m1" in container.items
+
+
+def test_local_entries_are_bounded(monkeypatch):
+    ledger = make_ledger(None, monkeypatch)
+    for index in range(3):
+        ledger.record(f"enrollment:m{index}", {"index": index})
+
+    assert ledger.get("enrollment:m0") is None
+    assert ledger.get("enrollment:m2") == {"index": 2}
+    assert MessageLedger.make_key("enrollment", {}) is None
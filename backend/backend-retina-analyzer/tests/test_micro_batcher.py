@@ -0,0 +1,147 @@
+"""
+Tests of micro-batching and of the gate slot a validation batch takes.
+"""
+import asyncio
+import pytest
+from main import RetinaAnalyzerService
+from micro_batcher import MicroBatcher
+from queue_scheduler import PriorityGate, QueuePolicy
+
+
+def test_items_within_the_window_form_one_batch():
+    batches = []
+
+    async def double(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(double, max_size=16, window_ms=20)
+        results = await asyncio.gather(*[batcher.submit(i) for i in range(5)])
+        return batcher, results
+
+    batcher, results = asyncio.run(run())
+    assert results == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1, 2, 3, 4]]
+    assert batcher.stats() == {"batches": 1, "items": 5, "mean_batch_size": 5.0, "largest_batch": 5}
+
+
+def test_full_batch_starts_without_waiting_for_the_window():
+    batches = []
+
+    async def echo(items):
+        batches.append(list(items))
+        return items
+
+    async def run():
+        batcher = MicroBatcher(echo, max_size=3, window_ms=10000)
+        return await asyncio.wait_for(asyncio.gather(*[batcher.submit(i) for i in range(6)]), 1)
+
+    assert asyncio.run(run()) == list(range(6))
+    assert batches == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_items_arriving_during_a_batch_form_the_next_one():
+    batches = []
+    release = None
+
+    async def slow(items):
+        batches.append(list(items))
+        if len(batches) == 1:
+            await release.wait()
+        return items
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        batcher = MicroBatcher(slow, max_size=16, window_ms=1)
+        first = asyncio.ensure_future(batcher.submit("a"))
+        await asyncio.sleep(0.02)
+        later = [asyncio.ensure_future(batcher.submit(item)) for item in ("b", "c")]
+        await asyncio.sleep(0.02)
+        # Only one batch runs at a time
+        assert batches == [["a"]]
+        release.set()
+        return await asyncio.gather(first, *later)
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+    assert batches == [["a"], ["b", "c"]]
+
+
+def test_batch_error_reaches_every_item():
+    async def fail(items):
+        raise RuntimeError("boom")
+
+    async def short(items):
+        return items[:1]
+
+    async def run(func):
+        batcher = MicroBatcher(func, window_ms=1)
+        return await asyncio.gather(*[batcher.submit(i) for i in range(3)], return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(run(fail)))
+    assert all(isinstance(result, ValueError) for result in asyncio.run(run(short)))
+
+
+class FakeServiceBus:
+    def __init__(self, gate):
+        self.gate = gate
+
+
+def make_service(gate):
+    service = RetinaAnalyzerService.__new__(RetinaAnalyzerService)
+    service.validation_queue_name = "validation"
+    service.service_bus = FakeServiceBus(gate)
+    return service
+
+
+def test_validation_batch_takes_one_gate_slot():
+    gate_slots = []
+
+    async def run():
+        gate = PriorityGate(1, {"validation": QueuePolicy(priority=1), "enrollment": QueuePolicy()})
+        service = make_service(gate)
+
+        def compute(requests):
+            gate_slots.append(gate.free)
+            return [{"status": "success"} for _ in requests]
+
+        service._compute_validation_batch = compute
+        results = await service._validate_batch([("a",), ("b",)])
+        return gate, results
+
+    gate, results = asyncio.run(run())
+    assert results == [{"status": "success"}, {"status": "success"}]
+    assert gate_slots == [0]
+    assert gate.free == 1
+
+
+def test_validation_batch_waits_for_a_busy_gate():
+    async def run():
+        gate = PriorityGate(1, {"validation": QueuePolicy(priority=1), "enrollment": QueuePolicy()})
+        service = make_service(gate)
+        service._compute_validation_batch = lambda requests: requests
+        await gate.acquire("enrollment")
+        batch = asyncio.ensure_future(service._validate_batch(["a"]))
+        await asyncio.sleep(0.02)
+        assert not batch.done()
+        assert gate.waiting("validation") == 1
+        gate.release()
+        return await asyncio.wait_for(batch, 1), gate.free
+
+    assert asyncio.run(run()) == (["a"], 1)
+
+
+def test_validation_batch_releases_its_slot_on_error():
+    def fail(requests):
+        raise RuntimeError("boom")
+
+    async def run():
+        gate = PriorityGate(1, {"validation": QueuePolicy()})
+        service = make_service(gate)
+        service._compute_validation_batch = fail
+        with pytest.raises(RuntimeError):
+            await service._validate_batch(["a"])
+        return gate.free
+
+    assert asyncio.run(run()) == 1
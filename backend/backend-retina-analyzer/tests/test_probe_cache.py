@@ -0,0 +1,95 @@
+"""
+Tests of the probe feature cache.
+"""
+import numpy as np
+import probe_cache
+from feature_set import FeatureSet
+from probe_cache import ProbeCache, feature_set_bytes
+
+
+def make_features(profile="standard", size=100):
+    return FeatureSet(id="probe", profile=profile, hog_features=np.ones(size), bifurcation_points=[(1, 2)])
+
+
+def test_hit_returns_a_copy_of_the_features():
+    cache = ProbeCache(max_bytes=10 ** 6, ttl=60)
+    cache.put("a.png", "v1", make_features())
+
+    features = cache.get("a.png", "v1", "standard")
+    assert features["hog_features"].tolist() == [1.0] * 100
+    features["person_id"] = "someone"
+    assert "person_id" not in cache.get("a.png", "v1", "standard")
+    assert cache.stats()["hits"] == 2
+
+
+def test_changed_etag_or_profile_is_a_miss():
+    cache = ProbeCache(max_bytes=10 ** 6, ttl=60)
+    cache.put("a.png", "v1", make_features())
+
+    assert cache.get("a.png", "v1", "fast") is None
+    assert cache.contains("a.png", "v1")
+    # The blob was overwritten: its old features are dropped
+    assert cache.get("a.png", "v2", "standard") is None
+    assert not cache.contains("a.png", "v1")
+    assert cache.get("a.png", None, "standard") is None
+    stats = cache.stats()
+    assert (stats["misses"], stats["blobs"], stats["size_bytes"]) == (2, 0, 0)
+
+
+def test_profiles_of_one_blob_version_share_an_entry():
+    cache = ProbeCache(max_bytes=10 ** 6, ttl=60)
+    cache.put("a.png", "v1", make_features("standard"))
+    cache.put("a.png", "v1", make_features("fast", size=50))
+    cache.put("a.png", "v1", make_features("fast", size=50))
+
+    assert cache.get("a.png", "v1", "fast") is not None
+    assert cache.get("a.png", "v1", "standard") is not None
+    expected = feature_set_bytes(make_features("standard")) + feature_set_bytes(make_features("fast", size=50))
+    assert cache.stats()["size_bytes"] == expected
+
+
+def test_least_recently_used_blobs_are_evicted_by_size():
+    entry_bytes = feature_set_bytes(make_features())
+    cache = ProbeCache(max_bytes=int(entry_bytes * 2.5), ttl=60)
+    cache.put("a.png", "v1", make_features())
+    cache.put("b.png", "v1", make_features())
+    cache.get("a.png", "v1", "standard")
+    cache.put("c.png", "v1", make_features())
+
+    assert cache.contains("a.png", "v1")
+    assert not cache.contains("b.png", "v1")
+    assert cache.contains("c.png", "v1")
+    stats = cache.stats()
+    assert (stats["evictions"], stats["blobs"]) == (1, 2)
+    assert stats["size_bytes"] <= cache.max_bytes
+
+
+def test_entry_larger_than_the_cache_is_kept_alone():
+    cache = ProbeCache(max_bytes=10, ttl=60)
+    cache.put("a.png", "v1", make_features())
+    cache.put("b.png", "v1", make_features())
+
+    assert cache.stats()["blobs"] == 1
+    assert cache.contains("b.png", "v1")
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(probe_cache.time, "monotonic", lambda: now[0])
+    cache = ProbeCache(max_bytes=10 ** 6, ttl=30)
+    cache.put("a.png", "v1", make_features())
+
+    now[0] += 29
+    assert cache.get("a.png", "v1", "standard") is not None
+    now[0] += 2
+    assert cache.get("a.png", "v1", "standard") is None
+    assert cache.stats()["size_bytes"] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ProbeCache(max_bytes=0, ttl=60)
+    cache.put("a.png", "v1", make_features())
+
+    assert not cache.is_enabled()
+    assert cache.get("a.png", "v1", "standard") is None
+    assert cache.stats()["blobs"] == 0
@@ -0,0 +1,138 @@
+"""
+Tests of request unit limiting, with fake Cosmos DB operations.
+"""
+import time
+import pytest
+from azure.cosmos import exceptions
+import ru_limiter
+from ru_limiter import RequestUnitLimiter, process_budget, shared_limiter
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+        self.status_code = 429
+        self.reason = "Too Many Requests"
+
+
+def throttled(retry_after_ms="10"):
+    headers = {"x-ms-request-charge": "0"}
+    if retry_after_ms is not None:
+        headers["x-ms-retry-after-ms"] = retry_after_ms
+    return exceptions.CosmosHttpResponseError(status_code=429, message="throttled", response=FakeResponse(headers))
+
+
+class FakeOperation:
+    """Fails with the given errors, then succeeds, reporting its charge through the response hook."""
+    def __init__(self, errors=(), charge=5.0):
+        self.errors = list(errors)
+        self.charge = charge
+        self.calls = 0
+
+    def __call__(self, body, response_hook):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        response_hook({"x-ms-request-charge": str(self.charge)}, None)
+        return body
+
+
+def test_charges_refine_the_expected_cost():
+    limiter = RequestUnitLimiter(ru_per_second=0, concurrency=1, max_retries=0)
+    operation = FakeOperation(charge=20.0)
+    for _ in range(3):
+        assert limiter.execute(operation, body="item") == "item"
+
+    stats = limiter.stats()
+    assert stats["requests"] == 3
+    assert stats["total_charge"] == 60.0
+    assert 10.0 < stats["expected_charge"] < 20.0
+
+
+def test_throttled_requests_are_retried_after_retry_after():
+    limiter = RequestUnitLimiter(ru_per_second=1000, concurrency=1, max_retries=3)
+    operation = FakeOperation(errors=[throttled("50"), throttled("50")])
+
+    start = time.monotonic()
+    assert limiter.execute(operation, body="item") == "item"
+    elapsed = time.monotonic() - start
+
+    assert operation.calls == 3
+    assert elapsed >= 0.1
+    stats = limiter.stats()
+    assert (stats["throttles"], stats["retries"], stats["failures"]) == (2, 2, 0)
+    # Each 429 halves the rate
+    assert stats["rate_ru_per_second"] == pytest.approx(250, abs=1)
+
+
+def test_throttled_request_fails_after_max_retries():
+    limiter = RequestUnitLimiter(ru_per_second=100, concurrency=1, max_retries=1)
+    operation = FakeOperation(errors=[throttled(), throttled(), throttled()])
+
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        limiter.execute(operation, body="item")
+    assert operation.calls == 2
+    stats = limiter.stats()
+    assert (stats["throttles"], stats["retries"], stats["failures"]) == (2, 1, 1)
+    assert stats["rate_ru_per_second"] == pytest.approx(25)
+
+
+def test_missing_retry_after_header_uses_the_default(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ru_limiter.time, "sleep", sleeps.append)
+    error = throttled(retry_after_ms=None)
+    error.headers = None
+    limiter = RequestUnitLimiter(ru_per_second=0, concurrency=1, max_retries=1)
+
+    assert limiter.execute(FakeOperation(errors=[error]), body="item") == "item"
+    assert sleeps == [1.0]
+
+
+def test_other_errors_are_not_retried():
+    limiter = RequestUnitLimiter(ru_per_second=0, concurrency=1, max_retries=5)
+    operation = FakeOperation(errors=[exceptions.CosmosHttpResponseError(status_code=409, message="conflict")])
+
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        limiter.execute(operation, body="item")
+    assert operation.calls == 1
+    assert limiter.stats()["throttles"] == 0
+
+
+def test_requests_are_paced_to_the_budget():
+    limiter = RequestUnitLimiter(ru_per_second=100, concurrency=1, max_retries=0)
+    operation = FakeOperation(charge=25.0)
+    limiter._expected_charge = 25.0
+
+    start = time.monotonic()
+    for _ in range(8):
+        limiter.execute(operation, body="item")
+    # 200 RU at 100 RU/s, of which the full bucket covers the first 100
+    assert time.monotonic() - start == pytest.approx(1.0, abs=0.3)
+
+
+def test_map_returns_errors_in_place():
+    limiter = RequestUnitLimiter(ru_per_second=0, concurrency=2)
+
+    def store(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item * 10
+
+    results = limiter.map(store, [1, 2, 3])
+    assert results[0] == 10 and results[2] == 30
+    assert isinstance(results[1], ValueError)
+
+
+def test_clients_of_a_container_share_one_limiter(monkeypatch):
+    monkeypatch.setattr(ru_limiter, "_shared_limiters", {})
+    monkeypatch.setenv("COSMOS_RU_PER_SECOND", "400")
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.delenv("COSMOS_RU_PROCESSES", raising=False)
+
+    limiter = shared_limiter("endpoint", "db", "features")
+    assert shared_limiter("endpoint", "db", "features") is limiter
+    assert shared_limiter("endpoint", "db", "ledger") is not limiter
+    assert limiter.ru_per_second == 100
+
+    monkeypatch.setenv("COSMOS_RU_PROCESSES", "5")
+    assert process_budget() == 80
@@ -0,0 +1,97 @@
+"""
+Tests of single-flight coalescing.
+"""
+import asyncio
+from single_flight import SingleFlight, make_key
+
+
+def test_make_key_ignores_dict_order():
+    assert make_key("validate", {"a": 1, "b": 2}) == make_key("validate", {"b": 2, "a": 1})
+    assert make_key("validate", "x") != make_key("upload", "x")
+
+
+def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight(ttl=0)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*[flight.do("key", compute) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["result"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"executed": 1, "coalesced": 4, "reused": 0, "in_flight": 0}
+
+
+def test_results_are_reused_within_ttl_only():
+    flight = SingleFlight(ttl=0.05)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        first = await flight.do("key", compute)
+        reused = await flight.do("key", compute)
+        await asyncio.sleep(0.06)
+        expired = await flight.do("key", compute)
+        return first, reused, expired
+
+    assert asyncio.run(run()) == (1, 1, 2)
+    assert flight.reused == 1
+
+
+def test_uncacheable_results_and_failures_are_not_reused():
+    flight = SingleFlight(ttl=10)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("failed")
+        return {"status": "error"}
+
+    async def run():
+        try:
+            await flight.do("key", compute)
+        except RuntimeError:
+            pass
+        await flight.do("key", compute, cacheable=lambda result: result["status"] == "success")
+        await flight.do("key", compute, cacheable=lambda result: result["status"] == "success")
+
+    asyncio.run(run())
+    assert len(calls) == 3
+    assert flight.reused == 0
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_computation():
+    flight = SingleFlight(ttl=0)
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("key", compute))
+        second = asyncio.ensure_future(flight.do("key", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(run()) == ("done", True)
+
+
+def test_max_results_bounds_the_reusable_results():
+    flight = SingleFlight(ttl=10, max_results=2)
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await flight.do(key, lambda: asyncio.sleep(0, result=key))
+
+    asyncio.run(run())
+    assert list(flight._results) == ["b", "c"]
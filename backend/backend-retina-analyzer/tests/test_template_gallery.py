@@ -0,0 +1,174 @@
+"""
+Tests of the quantized template gallery.
+"""
+import threading
+import numpy as np
+import pytest
+from extraction_profiles import EXTRACTOR_VERSION, ProfileMismatchError, get_profile
+from retina_processor import RetinaProcessor
+from template_gallery import TemplateGallery, TemplateIndex
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return RetinaProcessor(profile="standard")
+
+
+def make_features(seed, profile="standard", size=256):
+    rng = np.random.default_rng(seed)
+    return {
+        "profile": profile,
+        "extractor_version": EXTRACTOR_VERSION,
+        "blood_vessel_density": float(rng.uniform(0.05, 0.2)),
+        "avg_vessel_length": float(rng.uniform(10, 40)),
+        "avg_vessel_width": float(rng.uniform(2, 6)),
+        "bifurcation_points": [tuple(point) for point in rng.integers(0, size, (40, 2)).tolist()],
+        "lbp_histogram": rng.random(8).tolist(),
+        "hog_features": rng.random(384).tolist(),
+        "vessel_spatial_distribution": rng.random(64).tolist()
+    }
+
+
+@pytest.mark.parametrize("dtype, tolerance, bytes_per_template", [
+    ("int8", 1e-2, 606), ("int4", 1e-1, 378), ("float16", 1e-3, 1062)
+])
+def test_templates_round_trip_within_quantization_error(processor, dtype, tolerance, bytes_per_template):
+    gallery = TemplateGallery(processor, dtype=dtype)
+    templates = {f"t{seed}": make_features(seed) for seed in range(4)}
+    assert gallery.add_many(templates.items()) == 4
+
+    for template_id, features in templates.items():
+        stored = gallery.get(template_id)
+        for key in ("lbp_histogram", "hog_features", "vessel_spatial_distribution"):
+            assert np.allclose(stored[key], features[key], atol=tolerance)
+        # Only the points comparisons use are kept, exactly
+        assert stored["bifurcation_points"] == features["bifurcation_points"][:gallery.max_points]
+    assert gallery.nbytes / gallery.count == bytes_per_template
+
+
+def test_points_of_larger_profiles_keep_their_coordinates():
+    processor = RetinaProcessor(profile="high_accuracy")
+    gallery = TemplateGallery(processor, profile=get_profile("high_accuracy"))
+    features = make_features(0, profile="high_accuracy", size=512)
+    gallery.add("t", features)
+
+    assert gallery.get("t")["bifurcation_points"] == features["bifurcation_points"][:gallery.max_points]
+    assert gallery.score(features, ["t"])[0] == pytest.approx(
+        processor.compare_features(features, features)["overall_similarity"], abs=0.01
+    )
+
+
+@pytest.mark.parametrize("dtype", ["int8", "int4"])
+def test_search_finds_the_enrolled_template(processor, dtype):
+    gallery = TemplateGallery(processor, dtype=dtype)
+    templates = {f"t{seed}": make_features(seed) for seed in range(20)}
+    gallery.add_many(templates.items())
+
+    results = gallery.search(templates["t7"], top_k=3, threshold=0.0)
+    assert results[0][0] == "t7"
+    assert results[0][1] == pytest.approx(processor.compare_features(templates["t7"], templates["t7"])["overall_similarity"], abs=0.02)
+
+
+def test_employees_are_matched_on_the_packed_rows(processor):
+    gallery = TemplateGallery(processor)
+    templates = {f"t{seed}": make_features(seed) for seed in range(4)}
+    gallery.add_many(templates.items())
+    employees = [{"employeeId": f"e{seed}", "documentId": f"t{seed}"} for seed in range(4)]
+    employees.append({"employeeId": "no-template", "documentId": None})
+
+    result = gallery.match_employees(templates["t2"], employees)
+    expected = processor.match_employees(templates["t2"], employees, lambda document_id, _: templates[document_id])
+    assert result["matchingEmployeeId"] == expected["matchingEmployeeId"] == "e2"
+    assert result["similarity"] == pytest.approx(expected["similarity"], abs=0.01)
+
+    # Templates outside the gallery, or probes it cannot score, are left to the caller
+    assert gallery.match_employees(templates["t2"], [{"employeeId": "e9", "documentId": "t9"}]) is None
+    assert gallery.match_employees(make_features(0, profile="high_accuracy", size=512), employees) is None
+
+
+def test_removed_and_replaced_templates(processor):
+    gallery = TemplateGallery(processor)
+    gallery.add("a", make_features(1))
+    gallery.add("b", make_features(2))
+    gallery.add("a", make_features(3))
+
+    assert len(gallery) == 2
+    assert gallery.get("a")["avg_vessel_width"] == pytest.approx(make_features(3)["avg_vessel_width"])
+    assert gallery.remove("b")
+    assert not gallery.remove("b")
+    assert list(gallery.ids()) == ["a"]
+    assert gallery.score(make_features(2)).tolist()[1] == 0.0
+
+
+def test_columns_round_trip_with_overlay(processor):
+    gallery = TemplateGallery(processor, dtype="int4")
+    for seed in range(3):
+        gallery.add(f"t{seed}", make_features(seed))
+    gallery.remove("t1")
+    ids, columns = gallery.to_columns()
+    assert ids == ["t0", "t2"]
+
+    index = TemplateIndex()
+    for row, template_id in enumerate(ids):
+        index.add(template_id, row)
+    reopened = TemplateGallery.from_columns(processor, gallery.profile, "int4", columns, index)
+    reopened.add("t2", make_features(5))
+
+    assert reopened.get("t0") == gallery.get("t0")
+    assert reopened.get("t2")["avg_vessel_length"] == pytest.approx(make_features(5)["avg_vessel_length"])
+    assert sorted(reopened.ids()) == ["t0", "t2"]
+    # The existing columns were not written
+    assert np.array_equal(columns["statistics"][1], gallery.statistics[2])
+
+
+def test_compatible_templates_are_converted_to_the_gallery_profile(processor):
+    gallery = TemplateGallery(processor)
+    features = make_features(0, profile="fast", size=128)
+    gallery.add("fast", features)
+
+    stored = gallery.get("fast")
+    assert stored["profile"] == "standard"
+    assert stored["bifurcation_points"] == [(2 * x, 2 * y) for x, y in features["bifurcation_points"][:gallery.max_points]]
+    assert stored["avg_vessel_length"] == pytest.approx(2 * features["avg_vessel_length"], rel=1e-3)
+
+
+def test_incompatible_templates_are_refused(processor):
+    gallery = TemplateGallery(processor, dtype="int4")
+    with pytest.raises(ProfileMismatchError):
+        gallery.add("high_accuracy", make_features(0, profile="high_accuracy", size=512))
+    odd = make_features(0)
+    odd["lbp_histogram"] = odd["lbp_histogram"][:7]
+    with pytest.raises(ProfileMismatchError):
+        gallery.add("odd", odd)
+    assert len(gallery) == 0
+
+
+def test_readers_never_see_partly_written_templates(processor):
+    gallery = TemplateGallery(processor, capacity=1)
+    stop = threading.Event()
+
+    def write():
+        # Replacements and new templates, which grow the arrays many times
+        for version in range(1, 400):
+            features = make_features(version)
+            features["avg_vessel_length"] = float(version)
+            features["bifurcation_points"] = [(version, version)] * 5
+            gallery.add("t", features)
+            gallery.add(f"new-{version}", make_features(version))
+        stop.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    reads = 0
+    while not stop.is_set():
+        template = gallery.get("t")
+        if template is not None:
+            version = int(template["avg_vessel_length"])
+            assert template["bifurcation_points"] == [(version, version)] * 5
+            reads += 1
+        assert list(gallery.ids()).count("t") <= 1
+    writer.join()
+
+    assert reads > 0
+    assert len(gallery) == 400
+    assert gallery.get("t")["avg_vessel_length"] == 399.0